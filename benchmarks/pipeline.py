@@ -0,0 +1,270 @@
+"""
+Wall time, throughput and peak memory of the pipeline stages on synthetic
+inputs (see synthetic.py), without a flight, GCS or Docker.
+
+    python3 benchmarks/pipeline.py --scale medium --label v1.4
+    python3 benchmarks/pipeline.py --scale medium --label dev --compare bench_v1.4_medium.jsonl
+
+Every stage runs in a fresh process, so its peak RSS is not inflated by the
+stages before it, and is recorded with metrics.MetricsRecorder: one JSON
+line per stage in bench_<label>_<scale>.jsonl with wall/CPU time, peak RSS
+and the number of items (and bytes) it processed. The table printed at the
+end adds items/s and MB/s; with --compare it also shows the ratios to an
+earlier run and flags stages that got slower or bigger than --tolerance.
+
+Stages: optimize_voronoi_complexity; expand_to_gcps and expand_to_gcps_exact
+for every partition cell; the flight area's GCPs through the KML and
+sjoin and through gcp_store; the manifest selection as the original
+GeoDataFrame sjoin and as manifest_filter.filter_manifest; filter_gcp_list;
+post_process_downstream.mask_to_gdf and its windowed replacement
+ortho_mask.mask_to_cog; and crop_and_save_geotiff and batch_crop_geotiff
+on the orthophoto.
+"""
+import argparse
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from metrics import MetricsRecorder, load_records
+from synthetic import SCALES, generate
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def flight_poly(inputs):
+    from survey_utils import load_kml
+    return load_kml(inputs['paths']['flight_plan']).set_crs(4326, allow_override=True).to_crs(26911).geometry.iloc[0]
+
+def partition_cells(inputs):
+    from partition import clipped_voronoi_cells, sample_points
+    poly = flight_poly(inputs)
+    cells = clipped_voronoi_cells(poly, sample_points(poly, inputs['params']['seeds'], seed=0))
+    return poly, [c for c in cells if not c.is_empty]
+
+def bench_optimize(inputs, metrics, out_dir):
+    from partition import optimize_voronoi_complexity
+    poly, params = flight_poly(inputs), inputs['params']
+    with metrics.stage('optimize_voronoi_complexity', items=params['iterations'], seeds=params['seeds']):
+        optimize_voronoi_complexity(poly, params['seeds'], max_iterations=params['iterations'], seed=0)
+
+def _gcps(inputs):
+    from survey_utils import load_kml
+    return load_kml(inputs['paths']['gcp_grid']).set_crs(4326, allow_override=True).to_crs(26911)
+
+def bench_expand(inputs, metrics, out_dir):
+    import geopandas as gpd
+    from survey_utils import expand_to_gcps
+    _, cells = partition_cells(inputs)
+    gcps = _gcps(inputs)
+    with metrics.stage('expand_to_gcps', items=len(cells), gcps=len(gcps)):
+        for cell in cells:
+            expand_to_gcps(gpd.GeoDataFrame(geometry=[cell], crs=26911), gcps)
+
+def bench_expand_exact(inputs, metrics, out_dir):
+    import geopandas as gpd
+    from survey_utils import expand_to_gcps_exact
+    _, cells = partition_cells(inputs)
+    gcps = _gcps(inputs)
+    with metrics.stage('expand_to_gcps_exact', items=len(cells), gcps=len(gcps)):
+        for cell in cells:
+            expand_to_gcps_exact(gpd.GeoDataFrame(geometry=[cell], crs=26911), gcps)
+
+def bench_gcp_kml_sjoin(inputs, metrics, out_dir):
+    # GCPs of the flight area as the planner selected them before gcp_store
+    import geopandas as gpd
+    from survey_utils import load_kml
+    with metrics.stage('gcp_kml_sjoin', items=1):
+        flight = load_kml(inputs['paths']['flight_plan']).set_crs(4326, allow_override=True).to_crs(26911)
+        gcps = load_kml(inputs['paths']['gcp_grid']).set_crs(4326, allow_override=True).to_crs(26911)
+        gpd.sjoin(gcps, flight, how='inner', predicate='within')
+
+def bench_gcp_store(inputs, metrics, out_dir):
+    # the same selection plus the 5 nearest GCPs of every cell, from a prebuilt store
+    from gcp_store import build_store, open_store
+    poly, cells = partition_cells(inputs)
+    build_store(inputs['paths']['gcp_grid'], os.path.join(out_dir, 'grid.gcps'))
+    with metrics.stage('gcp_store_query', items=1 + len(cells)):
+        store = open_store(os.path.join(out_dir, 'grid.gcps'))
+        store.select(store.within(poly))
+        for cell in cells:
+            store.nearest(cell, 5)
+
+def bench_manifest_sjoin(inputs, metrics, out_dir):
+    # the selection as the workers did it before manifest_filter
+    import geopandas as gpd
+    import pandas as pd
+    _, cells = partition_cells(inputs)
+    path = inputs['paths']['manifest']
+    with metrics.stage('manifest_sjoin', items=inputs['params']['photos'], bytes=os.path.getsize(path)):
+        manifest = pd.read_csv(path)
+        photos = gpd.GeoDataFrame(manifest, geometry=gpd.points_from_xy(manifest['longitude'], manifest['latitude']),
+                                  crs=4326).to_crs(26911)
+        gpd.sjoin(photos, gpd.GeoDataFrame(geometry=cells, crs=26911), how='inner', predicate='within')
+
+def bench_filter_manifest(inputs, metrics, out_dir):
+    from manifest_filter import filter_manifest
+    _, cells = partition_cells(inputs)
+    path = inputs['paths']['manifest']
+    with metrics.stage('filter_manifest', items=inputs['params']['photos'], bytes=os.path.getsize(path)):
+        filter_manifest(path, cells)
+
+def bench_filter_gcp_list(inputs, metrics, out_dir):
+    import geopandas as gpd
+    from survey_utils import filter_gcp_list, load_kml
+    path = inputs['paths']['gcp_list']
+    # the GCP list is in EPSG:4326, and so must the polygon be
+    flight = load_kml(inputs['paths']['flight_plan']).set_crs(4326, allow_override=True)
+    polygon_gdf = gpd.GeoDataFrame(geometry=[flight.geometry.iloc[0]], crs=4326)
+    with metrics.stage('filter_gcp_list', items=inputs['params']['gcp_rows'], bytes=os.path.getsize(path)):
+        filter_gcp_list(path, polygon_gdf, os.path.join(out_dir, 'gcp_list.txt'))
+
+def _mask_cutline(inputs):
+    import geopandas as gpd
+    _, cells = partition_cells(inputs)
+    return gpd.GeoDataFrame(geometry=[max(cells, key=lambda c: c.area)], crs=26911)
+
+def _raster_size(record, path):
+    # pixels and uncompressed bytes of the masked output
+    import numpy as np
+    import rasterio
+    with rasterio.open(path) as dst:
+        record['items'] = dst.width * dst.height
+        record['bytes'] = dst.width * dst.height * dst.count * np.dtype(dst.dtypes[0]).itemsize
+
+def bench_mask(inputs, metrics, out_dir):
+    from ortho_mask import mask_to_cog
+    cutline = _mask_cutline(inputs)
+    output_path = os.path.join(out_dir, 'masked.tif')
+    with metrics.stage('mask_to_cog') as record:
+        mask_to_cog(cutline, inputs['paths']['orthophoto'], output_path)
+        _raster_size(record, output_path)
+
+def bench_mask_gdf(inputs, metrics, out_dir):
+    from post_process_downstream import mask_to_gdf
+    cutline = _mask_cutline(inputs)
+    output_path = os.path.join(out_dir, 'masked.tif')
+    with metrics.stage('mask_to_gdf') as record:
+        mask_to_gdf(cutline, inputs['paths']['orthophoto'], output_path)
+        _raster_size(record, output_path)
+
+def _crop_boxes(inputs):
+    import geopandas as gpd
+    from orthomosaic_crops.batch_crop import get_bounding_boxes
+    from partition import sample_points
+    xy = sample_points(flight_poly(inputs), inputs['params']['boxes'], seed=1)
+    return get_bounding_boxes(gpd.GeoDataFrame(geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=26911))
+
+def bench_crop(inputs, metrics, out_dir):
+    # 'crop geotiff.py' is not an importable module name
+    spec = importlib.util.spec_from_file_location('crop_geotiff', os.path.join(ROOT, 'orthomosaic_crops', 'crop geotiff.py'))
+    crop_geotiff = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(crop_geotiff)
+    boxes = _crop_boxes(inputs)
+    with metrics.stage('crop_and_save_geotiff', items=len(boxes)):
+        crop_geotiff.crop_and_save_geotiff(inputs['paths']['orthophoto'], boxes, os.path.join(out_dir, 'crops'))
+
+def bench_batch_crop(inputs, metrics, out_dir):
+    import numpy as np
+    import rasterio
+    from orthomosaic_crops.batch_crop import batch_crop_geotiff
+    boxes = _crop_boxes(inputs)
+    with rasterio.open(inputs['paths']['orthophoto']) as src:
+        pixel_bytes = src.count * np.dtype(src.dtypes[0]).itemsize
+    with metrics.stage('batch_crop_geotiff', items=len(boxes)) as record:
+        pixels = batch_crop_geotiff(inputs['paths']['orthophoto'], boxes, os.path.join(out_dir, 'batch_crops'))
+        record['bytes'] = pixels * pixel_bytes
+
+STAGES = {
+    'optimize_voronoi_complexity': bench_optimize,
+    'expand_to_gcps': bench_expand,
+    'expand_to_gcps_exact': bench_expand_exact,
+    'gcp_kml_sjoin': bench_gcp_kml_sjoin,
+    'gcp_store_query': bench_gcp_store,
+    'manifest_sjoin': bench_manifest_sjoin,
+    'filter_manifest': bench_filter_manifest,
+    'filter_gcp_list': bench_filter_gcp_list,
+    'mask_to_gdf': bench_mask_gdf,
+    'mask_to_cog': bench_mask,
+    'crop_and_save_geotiff': bench_crop,
+    'batch_crop_geotiff': bench_batch_crop,
+}
+
+def _run_stage(name, inputs, results_path, context):
+    sys.path.insert(0, ROOT)
+    metrics = MetricsRecorder(results_path, sample_interval=0.05, **context)
+    out_dir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+    try:
+        STAGES[name](inputs, metrics, out_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+def run(inputs, results_path, stages=None, **context):
+    # every stage in its own spawned process; a failing stage is recorded and the others still run
+    spawn = mp.get_context('spawn')
+    for name in stages or STAGES:
+        process = spawn.Process(target=_run_stage, args=(name, inputs, results_path, context))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f'{name} failed (exit code {process.exitcode})')
+
+def summarize(records):
+    """
+    One row per stage with wall/CPU time, peak RSS, items/s and MB/s
+    (stages without bytes get no MB/s). Repeated stages keep the last run.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(records).drop_duplicates('stage', keep='last').set_index('stage')
+    for column in ['items', 'bytes']:
+        if column not in df:
+            df[column] = float('nan')
+    table = df[['status', 'wall_s', 'cpu_s', 'peak_rss_mb', 'items']].copy()
+    table['items_per_s'] = df['items'] / df['wall_s']
+    table['mb_per_s'] = df['bytes'] / 2**20 / df['wall_s']
+    return table
+
+def compare(baseline, current, tolerance=0.2, min_seconds=0.1):
+    # ratios current / baseline; a regression is a stage slower or bigger by more than
+    # `tolerance`, ignoring time differences under `min_seconds` (timer noise on tiny stages)
+    table = current[['wall_s', 'peak_rss_mb', 'items_per_s']].join(
+        baseline[['wall_s', 'peak_rss_mb']], rsuffix='_base', how='left')
+    table['wall_ratio'] = table['wall_s'] / table['wall_s_base']
+    table['rss_ratio'] = table['peak_rss_mb'] / table['peak_rss_mb_base']
+    slower = (table['wall_ratio'] > 1 + tolerance) & (table['wall_s'] - table['wall_s_base'] > min_seconds)
+    table['regression'] = slower | (table['rss_ratio'] > 1 + tolerance)
+    return table
+
+def git_label():
+    result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True)
+    return result.stdout.strip() or 'unversioned'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic inputs.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--workdir', default=None, help='inputs directory (default: <tmp>/mpg_bench/<scale>)')
+    parser.add_argument('--label', default=None, help='name of this run (default: git describe)')
+    parser.add_argument('--stages', nargs='+', choices=sorted(STAGES), default=None)
+    parser.add_argument('--compare', default=None, metavar='JSONL', help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    label = args.label or git_label()
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), 'mpg_bench', args.scale)
+    results_path = f'bench_{label}_{args.scale}.jsonl'
+
+    inputs = generate(workdir, args.scale)
+    run(inputs, results_path, args.stages, label=label, scale=args.scale)
+
+    table = summarize(load_records([results_path]))
+    print(table.round(3).to_string())
+    if args.compare:
+        comparison = compare(summarize(load_records([args.compare])), table, args.tolerance)
+        print(comparison.round(3).to_string())
+        regressions = comparison.index[comparison['regression']].tolist()
+        print(f'regressions: {regressions}' if regressions else 'no regressions')
@@ -0,0 +1,164 @@
+"""
+Synthetic survey inputs for the benchmarks, at any scale.
+
+    python3 benchmarks/synthetic.py /tmp/mpg_bench/medium --scale medium
+
+writes into the directory:
+
+- flightplan.kml    a meandering drainage strip, like surveys/*/flightplan.kml
+- manifest.csv      photo manifest (url, longitude, latitude, size, md5)
+- gcp_grid.kml      regular GCP grid over the flight area (gcp_grid.py layout)
+- gcp_list.txt      ODM gcp_list.txt referencing the manifest's photos
+- orthophoto.tif    tiled RGBA orthophoto over the flight area, written
+                    block by block so multi-GB rasters need little memory
+
+Everything is drawn from a seeded generator, so the same scale always
+produces the same inputs. inputs.json records the parameters used; an
+existing directory with the same parameters is reused as is.
+"""
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+import rasterio
+from pyproj import CRS, Transformer
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from partition import sample_points
+from gcp_grid import build_gcp_grid, write_gcp_grid
+
+crs_source = CRS.from_epsg(4326)
+crs_target = CRS.from_epsg(26911)
+
+# photos: manifest rows; raster_mb: uncompressed orthophoto size
+SCALES = {
+    'small': {'length_m': 2000, 'photos': 1000, 'gcp_spacing': 100, 'gcp_rows': 2000,
+              'raster_mb': 64, 'seeds': 8, 'iterations': 20, 'boxes': 500},
+    'medium': {'length_m': 6000, 'photos': 10000, 'gcp_spacing': 50, 'gcp_rows': 20000,
+               'raster_mb': 1024, 'seeds': 16, 'iterations': 50, 'boxes': 5000},
+    'large': {'length_m': 15000, 'photos': 100000, 'gcp_spacing': 25, 'gcp_rows': 200000,
+              'raster_mb': 4096, 'seeds': 40, 'iterations': 100, 'boxes': 20000},
+}
+
+def flight_polygon(length_m, width_m=150, origin=(725000, 5175000)):
+    # meandering strip in UTM metres, the shape of the drainage flight plans
+    x = np.linspace(0, length_m, max(20, int(length_m / 100)))
+    y = 400 * np.sin(x / 700)
+    return LineString(np.column_stack([x + origin[0], y + origin[1]])).buffer(width_m / 2)
+
+def write_flight_plan(poly, path):
+    import geopandas as gpd
+    import fiona
+    fiona.drvsupport.supported_drivers['KML'] = 'rw'
+    gpd.GeoDataFrame({'id': [0.0]}, geometry=[poly], crs=crs_target).to_crs(crs_source).to_file(path, driver='KML')
+
+def write_manifest(poly, path, photos, rng):
+    xy = sample_points(poly.buffer(20), photos, seed=rng)
+    lon, lat = Transformer.from_crs(crs_target, crs_source, always_xy=True).transform(xy[:, 0], xy[:, 1])
+    names = [f'DJI_20230612{i:06d}_{i % 10000:04d}_D.JPG' for i in range(photos)]
+    pd.DataFrame({
+        'url': [f'https://storage.googleapis.com/mpg-aerial-survey/synthetic/{name}' for name in names],
+        'longitude': lon,
+        'latitude': lat,
+        'size': rng.integers(8_000_000, 14_000_000, photos),
+        'md5': [f'{v:032x}' for v in rng.integers(0, 2**63, photos, dtype=np.int64)],
+    }).to_csv(path, index=False)
+    return names
+
+def write_gcp_list(gcps, names, path, rows, rng):
+    # each row ties a GCP to a photo; GCPs are drawn near the flight area
+    pick = rng.integers(0, len(gcps), rows)
+    data = pd.DataFrame({
+        'longitude': gcps['longitude'].to_numpy()[pick],
+        'latitude': gcps['latitude'].to_numpy()[pick],
+        'elevation': rng.uniform(960, 1100, rows).round(3),
+        'px': rng.uniform(0, 5280, rows),
+        'py': rng.uniform(0, 3956, rows),
+        'image': np.asarray(names)[rng.integers(0, len(names), rows)],
+        'name': gcps['name'].to_numpy()[pick],
+    })
+    with open(path, 'w') as f:
+        f.write('EPSG:4326\n')
+    data.to_csv(path, sep='\t', header=False, index=False, mode='a')
+
+def write_orthophoto(poly, path, raster_mb, rng, block_size=512, rows_per_write=1024):
+    """
+    Opaque RGBA orthophoto of about `raster_mb` MiB (uncompressed) covering
+    `poly`'s bounds, written in strips of `rows_per_write` rows.
+    """
+    minx, miny, maxx, maxy = poly.bounds
+    res = np.sqrt((maxx - minx) * (maxy - miny) / (raster_mb * 2**20 / 4))
+    width, height = int(np.ceil((maxx - minx) / res)), int(np.ceil((maxy - miny) / res))
+    profile = {
+        'driver': 'GTiff', 'width': width, 'height': height, 'count': 4, 'dtype': 'uint8',
+        'crs': crs_target, 'transform': from_origin(minx, maxy, res, res), 'tiled': True,
+        'blockxsize': block_size, 'blockysize': block_size, 'compress': 'none', 'bigtiff': 'IF_SAFER',
+    }
+    noise = rng.integers(0, 32, (rows_per_write, width), dtype=np.uint8)
+    cols = np.arange(width)
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.colorinterp = [rasterio.enums.ColorInterp(c) for c in (3, 4, 5, 6)]
+        for row in range(0, height, rows_per_write):
+            n = min(rows_per_write, height - row)
+            rows = np.arange(row, row + n)[:, None]
+            # smooth gradients plus noise compress and predict like real imagery
+            strip = np.empty((4, n, width), dtype=np.uint8)
+            strip[0] = ((cols // 7 + rows // 5) % 160 + noise[:n]).astype(np.uint8)
+            strip[1] = ((cols // 11 + rows // 3) % 140 + noise[:n]).astype(np.uint8)
+            strip[2] = ((cols // 13 + rows // 9) % 120 + noise[:n]).astype(np.uint8)
+            strip[3] = 255
+            dst.write(strip, window=Window(0, row, width, n))
+    return path
+
+def generate(workdir, scale='small', seed=0, **overrides):
+    """
+    Write the synthetic inputs for `scale` (a SCALES key; `overrides`
+    replace single parameters) into `workdir` and return their paths and
+    parameters. Reuses the directory when it was built with the same ones.
+    """
+    params = dict(SCALES[scale], scale=scale, seed=seed, **overrides)
+    paths = {name: os.path.join(workdir, file) for name, file in [
+        ('flight_plan', 'flightplan.kml'), ('manifest', 'manifest.csv'), ('gcp_grid', 'gcp_grid.kml'),
+        ('gcp_list', 'gcp_list.txt'), ('orthophoto', 'orthophoto.tif')]}
+    inputs = dict(paths=paths, params=params)
+
+    record = os.path.join(workdir, 'inputs.json')
+    if os.path.exists(record):
+        with open(record) as f:
+            if json.load(f)['params'] == params:
+                return inputs
+
+    os.makedirs(workdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    poly = flight_polygon(params['length_m'])
+    write_flight_plan(poly, paths['flight_plan'])
+    names = write_manifest(poly, paths['manifest'], params['photos'], rng)
+
+    gcps = build_gcp_grid(poly.buffer(500).envelope, params['gcp_spacing'])
+    write_gcp_grid(gcps, paths['gcp_grid'][:-len('.kml')], formats=('kml',))
+    write_gcp_list(gcps, names, paths['gcp_list'], params['gcp_rows'], rng)
+    write_orthophoto(poly, paths['orthophoto'], params['raster_mb'], rng)
+
+    with open(record, 'w') as f:
+        json.dump(inputs, f, indent=1)
+    return inputs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic benchmark inputs.')
+    parser.add_argument('workdir')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--photos', type=int, default=None, help='override the number of manifest rows')
+    parser.add_argument('--raster-mb', type=int, default=None, help='override the orthophoto size in MiB')
+    args = parser.parse_args()
+
+    overrides = {k: v for k, v in [('photos', args.photos), ('raster_mb', args.raster_mb)] if v is not None}
+    inputs = generate(args.workdir, args.scale, args.seed, **overrides)
+    for name, path in inputs['paths'].items():
+        print(f'{name:>12}: {path} ({os.path.getsize(path) / 2**20:.1f} MiB)')
@@ -0,0 +1,47 @@
+"""
+Calls per second of calculate_voronoi_complexity for the vectorized and
+legacy tessellation paths.
+
+    python3 benchmarks/voronoi_kernel.py [flightplan.kml]
+
+Without a KML a long, thin synthetic polygon (similar to the drainage flight
+plans) is used.
+"""
+import os
+import sys
+import time
+import numpy as np
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from partition import calculate_voronoi_complexity, generate_points
+
+def load_poly(path=None):
+    if path is None:
+        # ~6 km meandering strip, 150 m wide, in UTM metres
+        x = np.linspace(0, 6000, 60)
+        y = 400 * np.sin(x / 700)
+        return LineString(np.column_stack([x + 725000, y + 5175000])).buffer(75)
+
+    import fiona
+    import geopandas as gpd
+    fiona.drvsupport.supported_drivers['KML'] = 'rw'
+    return gpd.read_file(path, driver='KML').set_crs(4326, allow_override=True).to_crs(26911).geometry.iloc[0]
+
+def calls_per_second(poly, points, method, min_time=1.0):
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        calculate_voronoi_complexity(poly, points, method=method)
+        calls += 1
+    return calls / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    poly = load_poly(sys.argv[1] if len(sys.argv) > 1 else None)
+
+    print(f"{'seeds':>6} {'legacy/s':>10} {'vectorized/s':>13} {'speedup':>8}")
+    for num in [10, 50, 200]:
+        points = generate_points(poly, num, seed=0)
+        legacy = calls_per_second(poly, points, 'legacy')
+        vectorized = calls_per_second(poly, points, 'vectorized')
+        print(f'{num:>6} {legacy:>10.1f} {vectorized:>13.1f} {vectorized / legacy:>7.1f}x')
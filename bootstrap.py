@@ -0,0 +1,138 @@
+"""
+Worker bootstrap: make sure the pipeline's dependencies are importable
+before the heavy imports run.
+
+    import bootstrap
+    bootstrap.ensure_requirements()
+
+compares the installed distributions with REQUIREMENTS and returns at once
+when all of them are satisfied, which is the normal case on a node whose
+image or previous boot already installed them. Otherwise only the missing
+or outdated packages are installed, in a single pip call: from the local
+wheelhouse when there is one (no package index needed), from the index
+otherwise. GDAL's system packages are only installed before an index
+install, and only when gdalinfo is missing.
+
+    python3 bootstrap.py --build-wheelhouse /var/cache/mpg_aerial_survey/wheelhouse [--venv DIR]
+
+prebuilds the wheelhouse to bake into the instance image (and optionally a
+virtualenv from it; pass venv= to ensure_requirements to re-run the worker
+under that environment).
+
+`started_at` is taken when this module is first imported, i.e. as the
+worker starts; elapsed() and since_boot() time the startup, e.g. up to the
+first photo download.
+"""
+import argparse
+import importlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from importlib import metadata
+
+started_at = time.time()
+
+# minimum versions; shapely 2.1 for constrained_delaunay_triangles, geopandas 1.0 for union_all
+REQUIREMENTS = {
+    'numpy': '1.25',
+    'pandas': '1.5',
+    'shapely': '2.1',
+    'pyproj': '3.4',
+    'fiona': '1.9',
+    'geopandas': '1.0',
+    'rasterio': '1.3',
+    'scipy': '1.10',
+    'requests': '2.28',
+    'pyarrow': '12.0', # parquet manifests and GCP grids
+}
+
+DEFAULT_WHEELHOUSE = os.environ.get('MPG_WHEELHOUSE', '/var/cache/mpg_aerial_survey/wheelhouse')
+
+def _version_tuple(version):
+    return tuple(int(part) for part in re.findall(r'\d+', version)[:3])
+
+def missing_requirements(requirements=REQUIREMENTS):
+    # pip specifiers of the packages that are absent or older than required
+    missing = []
+    for name, minimum in requirements.items():
+        try:
+            installed = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            installed = None
+        if installed is None or _version_tuple(installed) < _version_tuple(minimum):
+            missing.append(f'{name}>={minimum}')
+    return missing
+
+def _pip(python, *args):
+    return subprocess.run([python, '-m', 'pip', *args]).returncode == 0
+
+def ensure_requirements(requirements=REQUIREMENTS, wheelhouse=DEFAULT_WHEELHOUSE, venv=None):
+    """
+    Install whatever REQUIREMENTS are not satisfied and return their pip
+    specifiers (an empty list when nothing had to be installed). With
+    `venv` pointing at an existing virtualenv the running script is
+    re-executed under its interpreter first.
+    """
+    if venv is not None:
+        python = os.path.join(venv, 'bin', 'python')
+        if os.path.exists(python) and os.path.realpath(sys.prefix) != os.path.realpath(venv):
+            os.execv(python, [python] + sys.argv)
+
+    missing = missing_requirements(requirements)
+    if not missing:
+        return []
+
+    print(f'Installing {" ".join(missing)}')
+    installed = False
+    if wheelhouse and os.path.isdir(wheelhouse):
+        installed = _pip(sys.executable, 'install', '--no-index', '--find-links', wheelhouse, *missing)
+
+    if not installed:
+        if shutil.which('gdalinfo') is None:
+            subprocess.run(['sudo', 'apt-get', 'install', 'gdal-bin', 'libgdal-dev', 'libspatialindex-dev'],
+                           check=True, input=b'y\n')
+        if not _pip(sys.executable, 'install', *missing):
+            raise RuntimeError(f'Could not install {" ".join(missing)}')
+
+    importlib.invalidate_caches()
+    return missing
+
+def elapsed():
+    # seconds since the worker started
+    return time.time() - started_at
+
+def since_boot():
+    # seconds since the machine booted, None where /proc/uptime is not available
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except OSError:
+        return None
+
+def build_wheelhouse(path, requirements=REQUIREMENTS):
+    specs = [f'{name}>={minimum}' for name, minimum in requirements.items()]
+    if not _pip(sys.executable, 'wheel', '--wheel-dir', path, *specs):
+        raise RuntimeError(f'Could not build the wheelhouse in {path}')
+
+def build_venv(path, wheelhouse, requirements=REQUIREMENTS):
+    specs = [f'{name}>={minimum}' for name, minimum in requirements.items()]
+    subprocess.run([sys.executable, '-m', 'venv', path], check=True)
+    if not _pip(os.path.join(path, 'bin', 'python'), 'install', '--no-index', '--find-links', wheelhouse, *specs):
+        raise RuntimeError(f'Could not install the wheelhouse into {path}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check or prebuild the worker dependencies.')
+    parser.add_argument('--build-wheelhouse', metavar='DIR', help='download/build wheels for REQUIREMENTS into DIR')
+    parser.add_argument('--venv', metavar='DIR', help='also create a virtualenv in DIR from the wheelhouse')
+    args = parser.parse_args()
+
+    if args.build_wheelhouse:
+        build_wheelhouse(args.build_wheelhouse)
+        if args.venv:
+            build_venv(args.venv, args.build_wheelhouse)
+    else:
+        missing = missing_requirements()
+        print('missing: ' + ' '.join(missing) if missing else 'all requirements satisfied')
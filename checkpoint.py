@@ -0,0 +1,79 @@
+"""
+Stage checkpoints for preemptible array nodes.
+
+A checkpoint records that a pipeline stage finished for a given input hash,
+together with whatever the stage needs to be skipped on a rerun (e.g. the
+node's partition). A restarted worker asks the store before each stage and
+only runs the stages whose (stage, key) has no record yet.
+
+LocalCheckpointStore keeps records in a directory and is what single-host
+runs use. GCSCheckpointStore mirrors the same records to a
+bucket prefix with gsutil, so they survive the instance itself.
+"""
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+from survey_utils import copy_to_gcs
+
+def input_hash(*items):
+    # stable short hash of JSON-serializable inputs
+    payload = json.dumps(items, sort_keys=True, default=str).encode()
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+class NullCheckpointStore:
+    # stand-in when checkpointing is off: nothing is ever complete
+    def get(self, stage, key):
+        return None
+
+    def put(self, stage, key, record=None):
+        pass
+
+class LocalCheckpointStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, stage, key):
+        return os.path.join(self.root, f'{stage}_{key}.json')
+
+    def get(self, stage, key):
+        path = self._path(stage, key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, stage, key, record=None):
+        record = dict(record or {}, stage=stage, key=key, completed_at=time.time())
+        path = self._path(stage, key)
+        # write-then-rename so a preemption never leaves a truncated record
+        with open(path + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.replace(path + '.tmp', path)
+        return path
+
+class GCSCheckpointStore(LocalCheckpointStore):
+    """
+    Records under gs://<bucket_prefix>/, cached in `cache_dir`. Reads fall
+    back to the bucket when the local cache misses (e.g. on a fresh disk).
+    """
+    def __init__(self, bucket_prefix, cache_dir):
+        super().__init__(cache_dir)
+        self.bucket_prefix = bucket_prefix
+
+    def get(self, stage, key):
+        record = super().get(stage, key)
+        if record is None:
+            path = self._path(stage, key)
+            uri = f'gs://{self.bucket_prefix}/{os.path.basename(path)}'
+            if subprocess.run(['gsutil', '-q', 'cp', uri, path]).returncode == 0:
+                record = super().get(stage, key)
+        return record
+
+    def put(self, stage, key, record=None):
+        path = super().put(stage, key, record)
+        copy_to_gcs(path, self.bucket_prefix)
+        return path
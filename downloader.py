@@ -0,0 +1,147 @@
+"""
+Bounded-concurrency photo downloader.
+
+Replaces the serial `wget` loop in process_images. A thread pool shares one
+pooled requests.Session; every file is written to `<name>.part` and renamed
+once verified, so an interrupted run resumes from the bytes already on disk
+with an HTTP Range request instead of starting over. Files that fail are
+retried with exponential backoff and reported, not silently skipped.
+"""
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+
+def manifest_checks(manifest_df):
+    """
+    Expected size/md5 per url from the optional `size` (bytes) and `md5`
+    (hex) manifest columns. Returns an empty dict when neither is present.
+    """
+    columns = [c for c in ['size', 'md5'] if c in manifest_df.columns]
+    if not columns:
+        return {}
+    checks = manifest_df.set_index('url')[columns]
+    return {url: {k: v for k, v in row.items() if v == v} for url, row in checks.to_dict('index').items()}
+
+def make_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _md5(path, chunk_size=1 << 20):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _verify(path, check):
+    if 'size' in check and os.path.getsize(path) != int(check['size']):
+        raise IOError(f"{path}: {os.path.getsize(path)} bytes, expected {int(check['size'])}")
+    if 'md5' in check and _md5(path) != check['md5']:
+        raise IOError(f'{path}: md5 mismatch')
+
+def _fetch(session, url, path, chunk_size, timeout):
+    # returns the number of bytes transferred in this attempt
+    part = path + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # the partial file already holds everything the server has
+            os.replace(part, path)
+            return 0
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0 # server ignored the range, start over
+
+        expected = response.headers.get('Content-Length')
+        expected = None if expected is None else offset + int(expected)
+
+        transferred = 0
+        with open(part, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                transferred += len(chunk)
+
+    if expected is not None and os.path.getsize(part) != expected:
+        raise IOError(f'{url}: connection closed after {os.path.getsize(part)} of {expected} bytes')
+    os.replace(part, path)
+    return transferred
+
+def download_one(session, url, dest_dir, check=None, retries=5, backoff=1.0, chunk_size=1 << 20, timeout=60):
+    path = os.path.join(dest_dir, os.path.basename(url))
+    check = check or {}
+
+    if os.path.exists(path):
+        try:
+            _verify(path, check)
+            return 0 # already downloaded by an earlier run
+        except IOError:
+            os.remove(path)
+
+    transferred = 0
+    for attempt in range(retries + 1):
+        try:
+            transferred += _fetch(session, url, path, chunk_size, timeout)
+            _verify(path, check)
+            return transferred
+        except (requests.RequestException, IOError) as e:
+            if os.path.exists(path):
+                # complete but wrong content: drop it so the retry starts clean
+                os.remove(path)
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if attempt == retries or status in (401, 403, 404):
+                raise
+            print(f'Retrying {url} after error: {e}')
+            time.sleep(backoff * 2 ** attempt)
+
+def download_batch(urls, dest_dir, checks=None, workers=16, retries=5, backoff=1.0, chunk_size=1 << 20, timeout=60,
+                   pool=None):
+    """
+    Download `urls` into `dest_dir` with at most `workers` concurrent
+    transfers. `checks` maps url -> {'size': ..., 'md5': ...} (see
+    manifest_checks). With a `pool` (a ThreadPoolExecutor shared by several
+    batches) the transfers run on it instead and `workers` only sizes the
+    connection pool. Returns a summary with the failed urls and the
+    aggregate throughput.
+    """
+    checks = checks or {}
+    os.makedirs(dest_dir, exist_ok=True)
+    session = make_session(workers)
+
+    start = time.time()
+    total_bytes = 0
+    failed = []
+    own_pool = pool is None
+    pool = ThreadPoolExecutor(max_workers=workers) if own_pool else pool
+    futures = {pool.submit(download_one, session, url, dest_dir, checks.get(url),
+                           retries, backoff, chunk_size, timeout): url for url in urls}
+    for future in as_completed(futures):
+        url = futures[future]
+        try:
+            total_bytes += future.result()
+        except Exception as e:
+            print(f'Error occurred while downloading file from {url}:')
+            print(e)
+            failed.append(url)
+    if own_pool:
+        pool.shutdown()
+    session.close()
+
+    seconds = time.time() - start
+    summary = {
+        'files': len(futures),
+        'failed': failed,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'mb_per_s': total_bytes / 1e6 / seconds if seconds > 0 else 0.0,
+    }
+    print(f"Downloaded {summary['files'] - len(failed)}/{summary['files']} files, "
+          f"{total_bytes / 1e6:.1f} MB in {seconds:.1f} s ({summary['mb_per_s']:.1f} MB/s)")
+    return summary
@@ -0,0 +1,118 @@
+"""
+Regular GCP grid over the ranch uplands (the bounding box of the drainage
+buffer minus the drainage polygons).
+
+    python3 gcp_grid.py --drainage drainage_buffer.kml --elevation ellipsoidal_height_ranch.tif \
+        --spacing 25 50 100 200 --out gcp_kmls
+
+writes gcp_kmls/upland_gcps_<spacing>m.{csv,kml,parquet}. Candidates come
+from one meshgrid and a single vectorized containment test; elevations are
+sampled block by block, each raster block read once.
+"""
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+import shapely
+from pyproj import CRS, Transformer
+from rasterio.windows import Window
+from shapely.geometry import box
+
+from survey_utils import download_file, load_kml
+
+crs_source = CRS.from_epsg(4326)
+crs_target = CRS.from_epsg(26911)
+
+def upland_region(drainage_path):
+    # bounding box of the drainage buffer with the drainages cut out
+    drainage_poly = load_kml(drainage_path).to_crs(crs_target)
+    drainage = drainage_poly.geometry.union_all()
+    return box(*drainage_poly.total_bounds).difference(drainage)
+
+def grid_points(region, dist_m):
+    # x-major order, like the nested loops of the original notebook cell
+    minx, miny, maxx, maxy = region.bounds
+    x, y = np.meshgrid(np.arange(minx, maxx, dist_m), np.arange(miny, maxy, dist_m), indexing='ij')
+    x, y = x.ravel(), y.ravel()
+
+    shapely.prepare(region)
+    inside = shapely.contains_xy(region, x, y)
+    return x[inside], y[inside]
+
+def sample_raster(raster_path, x, y, crs=crs_target):
+    """
+    Band 1 of `raster_path` at the points (x, y) given in `crs`. Points are
+    grouped by the raster block they fall in and every block is read once,
+    in file order. Points outside the raster or on nodata get NaN.
+    """
+    values = np.full(len(x), np.nan)
+
+    with rasterio.open(raster_path) as src:
+        xs, ys = Transformer.from_crs(crs, src.crs, always_xy=True).transform(x, y)
+        cols, rows = ~src.transform * (np.asarray(xs), np.asarray(ys))
+        rows, cols = np.floor(rows).astype(int), np.floor(cols).astype(int)
+        valid = np.flatnonzero((rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width))
+
+        block_h, block_w = src.block_shapes[0]
+        block_cols = -(-src.width // block_w)
+        block_id = (rows[valid] // block_h) * block_cols + cols[valid] // block_w
+        order = np.argsort(block_id, kind='stable')
+        valid, block_id = valid[order], block_id[order]
+
+        starts = np.flatnonzero(np.r_[True, block_id[1:] != block_id[:-1]])
+        for group in np.split(valid, starts[1:]):
+            row_off = (rows[group[0]] // block_h) * block_h
+            col_off = (cols[group[0]] // block_w) * block_w
+            window = Window(col_off, row_off, min(block_w, src.width - col_off), min(block_h, src.height - row_off))
+            block = src.read(1, window=window, masked=True).astype(float).filled(np.nan)
+            values[group] = block[rows[group] - row_off, cols[group] - col_off]
+
+    return values
+
+def build_gcp_grid(region, dist_m, elevation_file=None):
+    x, y = grid_points(region, dist_m)
+    lon, lat = Transformer.from_crs(crs_target, crs_source, always_xy=True).transform(x, y)
+    elevation = sample_raster(elevation_file, x, y) if elevation_file is not None else np.full(len(x), np.nan)
+
+    return gpd.GeoDataFrame({
+        'name': np.arange(len(x)),
+        'longitude': lon,
+        'latitude': lat,
+        'ellipsoidal_height': elevation,
+        'x': x, # projected coordinates, kept in the columnar copy only
+        'y': y,
+    }, geometry=gpd.points_from_xy(lon, lat), crs=crs_source)
+
+def write_gcp_grid(gcp_gdf, output_base, formats=('csv', 'kml', 'parquet')):
+    columns = ['name', 'longitude', 'latitude', 'ellipsoidal_height']
+    if 'kml' in formats:
+        gcp_gdf[columns + ['geometry']].to_file(output_base + '.kml', driver='KML')
+    if 'csv' in formats:
+        pd.DataFrame(gcp_gdf[columns]).to_csv(output_base + '.csv', index=False)
+    if 'parquet' in formats:
+        pd.DataFrame(gcp_gdf.drop(columns='geometry')).to_parquet(output_base + '.parquet', index=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the upland GCP grid at one or more spacings.')
+    parser.add_argument('--drainage', default='https://storage.googleapis.com/mpg-aerial-survey/supporting_data/drainage_buffer.kml',
+                        help='drainage buffer KML path or URL')
+    parser.add_argument('--elevation', default=None, help='ellipsoidal height raster; heights are left empty without it')
+    parser.add_argument('--spacing', type=float, nargs='+', default=[100, 200], help='grid spacing(s) in metres')
+    parser.add_argument('--out', default='gcp_kmls')
+    parser.add_argument('--formats', nargs='+', default=['csv', 'kml', 'parquet'])
+    args = parser.parse_args()
+
+    drainage = args.drainage
+    if not os.path.exists(drainage):
+        drainage = os.path.basename(args.drainage)
+        download_file(args.drainage, drainage)
+
+    region = upland_region(drainage)
+    os.makedirs(args.out, exist_ok=True)
+    for dist_m in args.spacing:
+        gcp_gdf = build_gcp_grid(region, dist_m, args.elevation)
+        output_base = os.path.join(args.out, f'upland_gcps_{dist_m:g}m')
+        write_gcp_grid(gcp_gdf, output_base, args.formats)
+        print(f'{output_base}: {len(gcp_gdf)} GCPs')
@@ -0,0 +1,218 @@
+"""
+Binary GCP grid store with a persisted spatial index.
+
+    python3 gcp_store.py build gcp_kmls/upland_gcps_100m.csv   # -> gcp_kmls/upland_gcps_100m.gcps/
+
+A store is a directory holding
+
+    points.npy   one record per GCP (projected x/y, longitude/latitude,
+                 height, name), sorted by index cell
+    cells.npy    CSR offsets: the points of cell (row, col) are
+                 points[cells[row * ncols + col]:cells[row * ncols + col + 1]]
+    meta.json    CRS, grid origin, cell size and shape, source checksum
+
+Both arrays are opened memory-mapped, so opening a store reads no points and
+a query only touches the index cells under its polygon: within() cuts the
+candidate rows to the polygon's bounds and tests them with contains_xy,
+nearest() widens a search box until the k-th distance is inside it. Both
+return positions into the store; select() turns them into the projected
+GeoDataFrame that expand_to_gcps and expand_to_gcps_exact expect.
+
+cached_store(path) builds a store from a grid CSV or KML the first time it
+sees that file's content and opens the cached copy afterwards, so planners
+stop reparsing and reprojecting the KML on every run.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+
+crs_source = CRS.from_epsg(4326)
+crs_target = CRS.from_epsg(26911)
+
+STORE_VERSION = 1
+DEFAULT_CACHE = os.environ.get('MPG_GCP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'mpg_aerial_survey', 'gcps'))
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+def read_grid(path):
+    """
+    Names, longitudes, latitudes and heights of a GCP grid CSV (gcp_grid.py
+    layout) or KML. Heights are NaN where the source has none.
+    """
+    import pandas as pd
+
+    if path.lower().endswith('.csv'):
+        df = pd.read_csv(path)
+        lon, lat = df['longitude'].to_numpy(float), df['latitude'].to_numpy(float)
+    else:
+        from survey_utils import load_kml
+        df = load_kml(path)
+        lon, lat = df.geometry.x.to_numpy(), df.geometry.y.to_numpy()
+        # the KML driver reads the placemark names as 'Name'; a 'name' attribute may come along too
+        if 'Name' in df and df['Name'].notna().all():
+            df['name'] = df['Name']
+        elif 'name' not in df:
+            df['name'] = np.arange(len(df))
+    height = df['ellipsoidal_height'].to_numpy(float) if 'ellipsoidal_height' in df else np.full(len(df), np.nan)
+    return np.array([str(n) for n in df['name']]), lon, lat, height
+
+def build_store(source, store_path, cell_size=None, crs=crs_target):
+    """
+    Build a store at `store_path` from the grid file `source`. The index
+    cell size defaults to about four points per cell.
+    """
+    names, lon, lat, height = read_grid(source)
+    x, y = Transformer.from_crs(crs_source, crs, always_xy=True).transform(lon, lat)
+    x, y = np.asarray(x), np.asarray(y)
+
+    minx, miny, maxx, maxy = x.min(), y.min(), x.max(), y.max()
+    if cell_size is None:
+        cell_size = max(np.sqrt((maxx - minx) * (maxy - miny) / max(len(x), 1) * 4), 1.0)
+    ncols = int((maxx - minx) // cell_size) + 1
+    nrows = int((maxy - miny) // cell_size) + 1
+    cell = ((y - miny) // cell_size).astype(np.int64) * ncols + ((x - minx) // cell_size).astype(np.int64)
+    order = np.argsort(cell, kind='stable')
+
+    points = np.empty(len(x), dtype=[('x', 'f8'), ('y', 'f8'), ('lon', 'f8'), ('lat', 'f8'), ('height', 'f4'),
+                                     ('name', f'U{max(1, max((len(n) for n in names), default=1))}')])
+    points['x'], points['y'], points['lon'], points['lat'] = x[order], y[order], lon[order], lat[order]
+    points['height'], points['name'] = height[order], names[order]
+    cells = np.searchsorted(cell[order], np.arange(nrows * ncols + 1)).astype(np.int64)
+
+    os.makedirs(store_path, exist_ok=True)
+    np.save(os.path.join(store_path, 'points.npy'), points)
+    np.save(os.path.join(store_path, 'cells.npy'), cells)
+    meta = {'version': STORE_VERSION, 'crs': CRS.from_user_input(crs).to_string(), 'origin': [float(minx), float(miny)],
+            'cell_size': float(cell_size), 'shape': [nrows, ncols], 'count': len(x),
+            'source': os.path.basename(source), 'source_hash': _file_hash(source)}
+    with open(os.path.join(store_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return GCPStore(store_path)
+
+class GCPStore:
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError(f"GCP store {path} has version {self.meta.get('version')}, expected {STORE_VERSION}")
+        self.path = path
+        self.crs = CRS.from_user_input(self.meta['crs'])
+        self.points = np.load(os.path.join(path, 'points.npy'), mmap_mode='r')
+        self.cells = np.load(os.path.join(path, 'cells.npy'), mmap_mode='r')
+        self._origin = self.meta['origin']
+        self._size = self.meta['cell_size']
+        self._nrows, self._ncols = self.meta['shape']
+
+    def __len__(self):
+        return self.meta['count']
+
+    def candidates(self, bounds):
+        # positions of the points in the index cells overlapping `bounds`
+        minx, miny, maxx, maxy = bounds
+        c0 = max(int((minx - self._origin[0]) // self._size), 0)
+        c1 = min(int((maxx - self._origin[0]) // self._size), self._ncols - 1)
+        r0 = max(int((miny - self._origin[1]) // self._size), 0)
+        r1 = min(int((maxy - self._origin[1]) // self._size), self._nrows - 1)
+        if c0 > c1 or r0 > r1:
+            return np.empty(0, dtype=np.int64)
+        # the cells of one index row are contiguous, so each row is one slice
+        rows = np.arange(r0, r1 + 1) * self._ncols
+        starts, stops = self.cells[rows + c0], self.cells[rows + c1 + 1]
+        return np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])
+
+    def within(self, poly):
+        # positions of the GCPs inside `poly` (in the store's CRS)
+        idx = self.candidates(poly.bounds)
+        pts = self.points[idx]
+        shapely.prepare(poly)
+        return idx[shapely.contains_xy(poly, pts['x'], pts['y'])]
+
+    def nearest(self, poly, k):
+        """
+        Positions of the `k` GCPs closest to `poly` (0 inside it), nearest
+        first, with their distances.
+        """
+        k = min(k, len(self))
+        minx, miny, maxx, maxy = poly.bounds
+        shapely.prepare(poly)
+        radius = self._size
+        while True:
+            idx = self.candidates((minx - radius, miny - radius, maxx + radius, maxy + radius))
+            pts = self.points[idx]
+            # exact distances only for the points outside; the prepared test settles the rest
+            distance = np.zeros(len(idx))
+            outside = ~shapely.contains_xy(poly, pts['x'], pts['y'])
+            distance[outside] = shapely.distance(poly, shapely.points(pts['x'][outside], pts['y'][outside]))
+            # anything outside the search box is farther than `radius`
+            close = distance <= radius
+            if close.sum() >= k or len(idx) == len(self):
+                order = np.argsort(distance, kind='stable')[:k]
+                return idx[order], distance[order]
+            radius *= 2
+
+    def select(self, idx=None):
+        # GCPs at positions `idx` (all by default) as a GeoDataFrame in the store's CRS
+        import geopandas as gpd
+
+        pts = self.points if idx is None else self.points[np.asarray(idx)]
+        return gpd.GeoDataFrame({
+            'name': pts['name'],
+            'longitude': pts['lon'],
+            'latitude': pts['lat'],
+            'ellipsoidal_height': pts['height'],
+        }, geometry=gpd.points_from_xy(pts['x'], pts['y']), crs=self.crs)
+
+def open_store(path):
+    return GCPStore(path)
+
+def cached_store(source, cache_dir=DEFAULT_CACHE):
+    # store for the grid file `source`, built on the first use of its content
+    store_path = os.path.join(cache_dir, f"{os.path.basename(source).rsplit('.', 1)[0]}_{_file_hash(source)}.gcps")
+    if os.path.exists(os.path.join(store_path, 'meta.json')):
+        return GCPStore(store_path)
+    tmp_path = f'{store_path}.{os.getpid()}.tmp'
+    build_store(source, tmp_path)
+    try:
+        os.replace(tmp_path, store_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True) # another process finished the same store first
+    return GCPStore(store_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query a binary GCP grid store.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='build a store from a grid CSV or KML')
+    build.add_argument('source')
+    build.add_argument('--out', default=None, help='store directory (default: <source without extension>.gcps)')
+    build.add_argument('--cell-size', type=float, default=None)
+    query = sub.add_parser('query', help='GCPs within a flight plan KML')
+    query.add_argument('store')
+    query.add_argument('flight_plan')
+    query.add_argument('--nearest', type=int, default=None, metavar='K', help='the K nearest instead')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        out = args.out or args.source.rsplit('.', 1)[0] + '.gcps'
+        store = build_store(args.source, out, args.cell_size)
+        print(f"{out}: {len(store)} GCPs, {store.meta['shape'][0]}x{store.meta['shape'][1]} index cells "
+              f"of {store.meta['cell_size']:.0f} m")
+    else:
+        from survey_utils import load_kml
+
+        store = open_store(args.store)
+        poly = load_kml(args.flight_plan).set_crs(crs_source, allow_override=True).to_crs(store.crs).geometry.iloc[0]
+        if args.nearest:
+            idx, distance = store.nearest(poly, args.nearest)
+        else:
+            idx = store.within(poly)
+        print(store.select(idx).drop(columns='geometry').to_string())
@@ -0,0 +1,206 @@
+"""
+Node-local, content-addressed photo cache shared by partitions and reruns.
+
+Neighbouring partitions share the photos their GCP buffers overlap, and a
+rerun of a survey needs the same photos again. ImageCache keeps every
+downloaded photo under
+
+    <root>/objects/<key[:2]>/<key>     key = sha256 of the url and its manifest size/md5
+
+and fetch_images fills a project's images/ directory with hardlinks to those
+files, downloading (see downloader.download_batch) only the misses, which are
+then linked into the cache in turn. A photo in the cache and in any number
+of images/ directories takes its disk space once; ODM only reads them.
+
+The cache is bounded by `max_bytes`: evict() removes the least recently used
+photos (by the mtime a hit refreshes) that no project links to any more
+(st_nlink == 1) until the cache fits. Several workers on one host may share
+a cache; eviction and the hit counters hold a lock file.
+
+preflight() checks before ODM starts that the project's disk has room for
+ODM's outputs, evicting cached photos first if that makes room.
+
+    python3 image_cache.py /var/tmp/mpg_aerial_survey/image_cache            # size and hit ratio
+    python3 image_cache.py /var/tmp/mpg_aerial_survey/image_cache --evict 0  # empty what is unused
+"""
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+from downloader import download_batch
+
+ODM_DISK_FACTOR = 5 # ODM's outputs as a multiple of its input photos
+DEFAULT_CACHE_FRACTION = 0.25 # of the cache disk, when no max_bytes is given
+
+def _link(src, dst):
+    # hardlink, or a copy when src and dst are on different filesystems
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dst)
+
+class ImageCache:
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        if max_bytes is None:
+            max_bytes = int(shutil.disk_usage(root).total * DEFAULT_CACHE_FRACTION)
+        self.max_bytes = max_bytes
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.root, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def key(self, url, check=None):
+        check = check or {}
+        payload = json.dumps([url, check.get('size'), check.get('md5')], default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, url, check=None):
+        key = self.key(url, check)
+        return os.path.join(self.objects, key[:2], key)
+
+    def link(self, url, dest, check=None):
+        # link the cached copy of `url` to `dest`; its size on a hit, None on a miss
+        path = self.path(url, check)
+        try:
+            _link(path, dest)
+        except FileNotFoundError:
+            return None # not cached, or evicted since
+        os.utime(path) # most recently used
+        return os.path.getsize(dest)
+
+    def add(self, url, src, check=None):
+        # cache the verified download `src` (hardlinked, so it costs no space while src exists)
+        path = self.path(url, check)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        _link(src, tmp)
+        os.replace(tmp, path)
+
+    def _entries(self):
+        for sub in os.scandir(self.objects):
+            for entry in os.scandir(sub.path):
+                if not entry.name.endswith('.tmp'):
+                    yield entry.path, entry.stat()
+
+    def size(self):
+        return sum(st.st_size for _, st in self._entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used photos that no project links to until
+        the cache holds at most `max_bytes` (self.max_bytes by default).
+        Returns the bytes freed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._locked():
+            entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+            total = sum(st.st_size for _, st in entries)
+            freed = 0
+            for path, st in entries:
+                if total <= max_bytes:
+                    break
+                if st.st_nlink > 1:
+                    continue # still in an images/ directory
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= st.st_size
+                freed += st.st_size
+        return freed
+
+    def stats(self):
+        path = os.path.join(self.root, 'stats.json')
+        if not os.path.exists(path):
+            return {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+        with open(path) as f:
+            return json.load(f)
+
+    def count(self, hits, misses, bytes_saved):
+        # add to the lifetime counters
+        with self._locked():
+            stats = self.stats()
+            stats['hits'] += hits
+            stats['misses'] += misses
+            stats['bytes_saved'] += bytes_saved
+            path = os.path.join(self.root, 'stats.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(stats, f)
+            os.replace(path + '.tmp', path)
+
+def fetch_images(urls, dest_dir, cache, checks=None, **download_options):
+    """
+    Put the photos `urls` into `dest_dir`: hardlinks to the cached copies
+    where there are any, downloads for the rest, which are added to the
+    cache. Returns download_batch's summary with the cache hits, misses,
+    hit ratio and the bytes the hits saved.
+    """
+    checks = checks or {}
+    os.makedirs(dest_dir, exist_ok=True)
+    hits, saved, missing = 0, 0, []
+    for url in urls:
+        dest = os.path.join(dest_dir, os.path.basename(url))
+        size = None if os.path.exists(dest) else cache.link(url, dest, checks.get(url))
+        if size is None:
+            missing.append(url)
+        else:
+            hits += 1
+            saved += size
+
+    summary = download_batch(missing, dest_dir, checks=checks, **download_options)
+    failed = set(summary['failed'])
+    for url in missing:
+        if url not in failed:
+            cache.add(url, os.path.join(dest_dir, os.path.basename(url)), checks.get(url))
+    cache.evict()
+    cache.count(hits, len(missing), saved)
+
+    summary.update(files=len(urls), cache_hits=hits, cache_misses=len(missing),
+                   cache_hit_ratio=hits / len(urls) if urls else 0.0, bytes_saved=saved)
+    print(f"Image cache: {hits}/{len(urls)} photos linked from the cache, {saved / 1e6:.1f} MB not downloaded")
+    return summary
+
+def preflight(project_dir, input_bytes, cache=None, factor=ODM_DISK_FACTOR):
+    """
+    Raise OSError(ENOSPC) unless the disk of `project_dir` has room for
+    `factor` times `input_bytes` of ODM outputs, after evicting what the
+    cache can spare.
+    """
+    need = int(input_bytes * factor)
+    free = shutil.disk_usage(project_dir).free
+    if free < need and cache is not None:
+        cache.evict(max(cache.size() - (need - free), 0))
+        free = shutil.disk_usage(project_dir).free
+    if free < need:
+        raise OSError(errno.ENOSPC, f'{free / 1e9:.1f} GB free for ODM, about {need / 1e9:.1f} GB needed', project_dir)
+    return free
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report on or trim a node-local image cache.')
+    parser.add_argument('root')
+    parser.add_argument('--evict', type=float, default=None, metavar='GB', help='evict unused photos down to GB')
+    args = parser.parse_args()
+
+    cache = ImageCache(args.root)
+    if args.evict is not None:
+        print(f'freed {cache.evict(int(args.evict * 1e9)) / 1e9:.1f} GB')
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    print(f'{cache.size() / 1e9:.1f} GB cached (limit {cache.max_bytes / 1e9:.1f} GB); '
+          f"{stats['hits']}/{lookups} hits ({stats['hits'] / lookups if lookups else 0:.0%}), "
+          f"{stats['bytes_saved'] / 1e9:.1f} GB not downloaded")
@@ -0,0 +1,237 @@
+"""
+Run several partitions at once on one large host.
+
+    python3 local_executor.py surveys/<survey>/config_file.json --work-root /data/odm --max-concurrency 4
+    python3 local_executor.py config.json --work-root /tmp/run --output-root /tmp/out --stub-odm
+
+The array gives every partition its own GCE instance. On a big workstation
+or VM this executor runs post_process_downstream.run_partition for many
+partitions side by side instead:
+
+- the plan is computed once (plan_job.build_plan, written under
+  <work_root>/plans) unless --plan-uri names a published one,
+- the host's cores are split into `max_concurrency` disjoint CPU sets and
+  its memory evenly between them; every ODM container is pinned to one set
+  (docker --cpuset-cpus and --memory, ODM --max-concurrency),
+- partitions start longest first (by photo count) on that many threads,
+  which share one download pool, one uploader and the image cache; the COG
+  compression of each partition uses its slot's cores,
+- each partition writes metrics_<idx>.jsonl as the array nodes do.
+
+A slot is free again once its partition's mask is written; the uploads of
+finished partitions continue in the background.
+
+--stub-odm replaces ODM with StubOdm, which writes a small orthophoto over
+the partition's cutline and a report, and --output-root uploads into a local
+directory (uploader.LocalBackend) with the plan checkpoints kept on disk, so
+the whole flow runs without docker or buckets.
+
+The peak RSS and CPU time in the metrics are the executor process's, so they
+overlap between partitions running at the same time; peak_host_mem_mb
+covers the containers.
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+
+from checkpoint import LocalCheckpointStore
+from metrics import MetricsRecorder
+from plan_job import load_config, fetch_inputs, plan_params, plan_key, build_plan, write_plan, fetch_partition, crs_target
+from post_process_downstream import run_partition, run_odm_docker
+from uploader import Uploader, GCSBackend, LocalBackend
+
+def host_memory_mb():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) // 1024
+    raise RuntimeError('MemTotal missing from /proc/meminfo')
+
+def slot_resources(slots, cpus=None, memory_mb=None, memory_fraction=0.9, oversubscribe=False):
+    """
+    CPU set and memory limit of each of `slots` concurrent ODM runs: the
+    cores (this process's affinity by default) in contiguous, disjoint
+    chunks and `memory_fraction` of the host's memory split evenly. With
+    more slots than cores, `oversubscribe` (e.g. for the stub runner)
+    shares the cores round-robin instead of raising.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if cpus is None else sorted(cpus)
+    memory_mb = host_memory_mb() if memory_mb is None else memory_mb
+    memory = int(memory_mb * memory_fraction / slots)
+    if slots > len(cpus):
+        if not oversubscribe:
+            raise ValueError(f'{slots} concurrent partitions but only {len(cpus)} cores')
+        print(f'{slots} concurrent partitions share {len(cpus)} cores')
+        return [{'cpus': [int(cpus[i % len(cpus)])], 'memory_mb': memory} for i in range(slots)]
+    return [{'cpus': [int(c) for c in chunk], 'memory_mb': memory} for chunk in np.array_split(cpus, slots)]
+
+def docker_runner(resources):
+    # odm_runner for process_images that pins the container to one slot's cores and memory
+    def run(project_dir, odm_flags):
+        docker_options = ['--cpuset-cpus', ','.join(map(str, resources['cpus'])),
+                          '--memory', f"{resources['memory_mb']}m"]
+        run_odm_docker(project_dir, list(odm_flags) + ['--max-concurrency', f"{len(resources['cpus'])}"],
+                       docker_options)
+    return run
+
+class StubOdm:
+    """
+    Stand-in for ODM: after `seconds` it writes an RGBA orthophoto of
+    `resolution` metres covering `bounds` and a report into the project,
+    where process_images expects them. The calls are kept in `calls`.
+    """
+    def __init__(self, bounds, resources=None, resolution=1.0, seconds=0.0, crs=crs_target):
+        self.bounds = bounds
+        self.resources = resources
+        self.resolution = resolution
+        self.seconds = seconds
+        self.crs = crs
+        self.calls = []
+
+    def __call__(self, project_dir, odm_flags):
+        import rasterio
+        from rasterio.transform import from_origin
+
+        self.calls.append({'project_dir': project_dir, 'odm_flags': list(odm_flags), 'resources': self.resources,
+                           'photos': len(os.listdir(os.path.join(project_dir, 'images'))), 'start': time.time()})
+        time.sleep(self.seconds)
+
+        minx, miny, maxx, maxy = self.bounds
+        width = max(int(np.ceil((maxx - minx) / self.resolution)), 1)
+        height = max(int(np.ceil((maxy - miny) / self.resolution)), 1)
+        ortho_dir = os.path.join(project_dir, 'odm_orthophoto')
+        report_dir = os.path.join(project_dir, 'odm_report')
+        os.makedirs(ortho_dir, exist_ok=True)
+        os.makedirs(report_dir, exist_ok=True)
+
+        data = np.full((4, height, width), 255, dtype=np.uint8)
+        data[:3] = np.random.default_rng(0).integers(0, 255, (3, height, width), dtype=np.uint8)
+        profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 4, 'dtype': 'uint8',
+                   'crs': self.crs, 'transform': from_origin(minx, maxy, self.resolution, self.resolution),
+                   'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+        with rasterio.open(os.path.join(ortho_dir, 'odm_orthophoto.tif'), 'w', **profile) as dst:
+            dst.write(data)
+        with open(os.path.join(report_dir, 'report.pdf'), 'wb') as f:
+            f.write(b'%PDF-1.4\n% stub ODM report\n')
+
+def plan_once(config, work_root, branch='main', history=()):
+    # compute and write the plan for all partitions; returns its directory
+    paths = fetch_inputs(config, branch, tempfile.mkdtemp(dir=work_root))
+    params = plan_params(config)
+    partitions = build_plan(paths, params, history=history)
+    return write_plan(partitions, plan_key(paths, params), params, os.path.join(work_root, 'plans'))
+
+def run_local(config, plan_uri, work_root, max_concurrency=None, indices=None, uploader=None, branch='main',
+              plan_checkpoints=None, stub_seconds=None, download_workers=32, resources=None):
+    """
+    Run the partitions `indices` (all of the plan by default) of `plan_uri`
+    with at most `max_concurrency` at a time. With `stub_seconds` ODM is
+    replaced by StubOdm. Returns {index: None or the error} and the
+    uploads still in flight.
+    """
+    work_root = os.path.abspath(work_root)
+    parts_dir = os.path.join(work_root, 'partitions')
+    os.makedirs(parts_dir, exist_ok=True)
+    if indices is None:
+        indices = range(config['compute_array_sz'])
+    partitions = {idx: fetch_partition(plan_uri, idx, parts_dir) for idx in indices}
+    order = sorted(partitions, key=lambda idx: len(partitions[idx]['photos']), reverse=True)
+
+    if resources is None:
+        cores = len(os.sched_getaffinity(0))
+        slots = max_concurrency or max(min(len(order), cores // 8), 1)
+        resources = slot_resources(min(slots, len(order)), oversubscribe=stub_seconds is not None)
+    free_slots = queue.Queue()
+    for slot in range(len(resources)):
+        free_slots.put(slot)
+
+    for idx in order:
+        need = (partitions[idx].get('odm') or {}).get('predicted_mem_mb')
+        if need and need > resources[0]['memory_mb']:
+            print(f"partition {idx}: ODM predicted to need {need / 1024:.0f} GB, a slot has "
+                  f"{resources[0]['memory_mb'] / 1024:.0f} GB")
+
+    uploader = uploader or Uploader(GCSBackend())
+    log_bucket = config['output_bucket'] + '/logs'
+    host = socket.gethostname()
+    download_pool = ThreadPoolExecutor(max_workers=download_workers)
+
+    def run(idx):
+        slot = free_slots.get()
+        try:
+            metrics = MetricsRecorder(os.path.join(work_root, f'metrics_{idx}.jsonl'), array_idx=idx,
+                                      node=f'{host}/slot{slot}', slot_cpus=len(resources[slot]['cpus']))
+            metrics.on_record = lambda path: uploader.submit(path, log_bucket)
+            if stub_seconds is None:
+                runner = docker_runner(resources[slot])
+            else:
+                runner = StubOdm(partitions[idx]['buffered'].bounds, resources[slot], seconds=stub_seconds)
+            print(f"partition {idx}: {len(partitions[idx]['photos'])} photos on cores "
+                  f"{resources[slot]['cpus'][0]}-{resources[slot]['cpus'][-1]}")
+            return run_partition(idx, config, plan_uri, work_root, metrics, branch, uploader,
+                                 plan_checkpoints=plan_checkpoints, odm_runner=runner, download_pool=download_pool,
+                                 num_threads=len(resources[slot]['cpus']))
+        finally:
+            free_slots.put(slot)
+
+    errors, uploads = {}, []
+    with ThreadPoolExecutor(max_workers=len(resources)) as pool:
+        futures = {pool.submit(run, idx): idx for idx in order}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                uploads.extend(future.result())
+                errors[idx] = None
+            except Exception as e:
+                traceback.print_exception(e)
+                print(f'Partition {idx} failed: {e!r}')
+                errors[idx] = e
+    download_pool.shutdown()
+    return errors, uploads
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several partitions in parallel on one host.')
+    parser.add_argument('config', help='config_file.json path or URL')
+    parser.add_argument('--work-root', default='/var/tmp/mpg_aerial_survey')
+    parser.add_argument('--plan-uri', default=None, help='published plan (default: plan once under <work-root>/plans)')
+    parser.add_argument('--indices', type=int, nargs='+', default=None)
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help='partitions at a time (default: one per 8 cores)')
+    parser.add_argument('--download-workers', type=int, default=32)
+    parser.add_argument('--output-root', default=None, help='upload into this directory instead of the buckets')
+    parser.add_argument('--stub-odm', action='store_true', help='replace ODM with a stub that writes a small orthophoto')
+    parser.add_argument('--stub-seconds', type=float, default=0.0)
+    parser.add_argument('--branch', default='main')
+    args = parser.parse_args()
+
+    work_root = os.path.abspath(args.work_root)
+    os.makedirs(work_root, exist_ok=True)
+    config = load_config(os.path.abspath(args.config) if os.path.exists(args.config) else args.config)
+
+    plan_uri = args.plan_uri or plan_once(config, work_root, args.branch)
+    indices = args.indices
+    if indices is None and os.path.isdir(plan_uri):
+        with open(os.path.join(plan_uri, 'plan.json')) as f:
+            indices = [p['index'] for p in json.load(f)['partitions']]
+
+    plan_checkpoints = None
+    if args.output_root:
+        uploader = Uploader(LocalBackend(args.output_root))
+        plan_checkpoints = LocalCheckpointStore(os.path.join(work_root, 'checkpoints'))
+    else:
+        uploader = Uploader(GCSBackend())
+
+    start = time.time()
+    errors, _ = run_local(config, plan_uri, work_root, args.max_concurrency, indices, uploader, args.branch,
+                          plan_checkpoints, args.stub_seconds if args.stub_odm else None, args.download_workers)
+    uploader.close()
+    failed = sorted(idx for idx, e in errors.items() if e is not None)
+    print(f'{len(errors) - len(failed)}/{len(errors)} partitions done in {time.time() - start:.0f} s'
+          + (f', failed: {failed}' if failed else ''))
@@ -0,0 +1,293 @@
+"""
+Build or extend a photo manifest from the images' EXIF/XMP headers.
+
+    python3 manifest_builder.py /data/230612/m3m manifest.csv \
+        --url-prefix https://storage.googleapis.com/mpg-aerial-survey/surveys/230612_spurgepoly/data_collection/m3m
+    python3 manifest_builder.py gs://mpg-aerial-survey/surveys/230612_spurgepoly/data_collection/m3m manifest.csv
+
+The source is a local image directory (searched recursively), a gs:// prefix
+(listed with `gsutil ls -l`) or a file holding such a listing. Only the
+header of every JPG/TIF is read, in 64 KiB blocks: from disk, or with HTTP
+Range requests against the public storage.googleapis.com URL, spread over a
+process pool. From it come the GPS position and altitude, the capture time,
+DJI's XMP relative altitude and gimbal/flight angles and, for the
+multispectral TIFs, the band name.
+
+An existing manifest is extended, not rebuilt: images whose name, size and
+modification time match a row are skipped, changed ones are re-read. The
+CSV (url, longitude, latitude, ... as the scripts expect) is written with a
+columnar copy next to it (manifest.parquet) that also holds the projected
+x/y, so manifest_filter can select photos without parsing or projecting.
+"""
+import argparse
+import os
+import re
+import struct
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from pyproj import CRS, Transformer
+
+crs_source = CRS.from_epsg(4326)
+crs_target = CRS.from_epsg(26911)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.tif', '.tiff')
+BLOCK = 1 << 16
+
+# DJI XMP attributes kept, by manifest column
+XMP_FIELDS = {
+    'relative_altitude': 'drone-dji:RelativeAltitude',
+    'absolute_altitude': 'drone-dji:AbsoluteAltitude',
+    'gimbal_yaw': 'drone-dji:GimbalYawDegree',
+    'gimbal_pitch': 'drone-dji:GimbalPitchDegree',
+    'flight_yaw': 'drone-dji:FlightYawDegree',
+}
+COLUMNS = ['url', 'longitude', 'latitude', 'altitude', *XMP_FIELDS, 'band', 'datetime', 'name', 'size', 'mtime']
+
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8, 11: 4, 12: 8}
+
+class _Header:
+    # random access to the start of a file through `fetch(offset, length)`, cached in BLOCK-sized blocks
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.blocks = {}
+
+    def read(self, offset, length):
+        out = b''
+        while length > 0:
+            block, start = divmod(offset, BLOCK)
+            if block not in self.blocks:
+                self.blocks[block] = self.fetch(block * BLOCK, BLOCK)
+            chunk = self.blocks[block][start:start + length]
+            if not chunk:
+                break # end of file
+            out += chunk
+            offset, length = offset + len(chunk), length - len(chunk)
+        return out
+
+def _ifd(header, base, offset, endian):
+    # {tag: value} of the TIFF IFD at `offset` (relative to the TIFF header at `base`)
+    count, = struct.unpack(endian + 'H', header.read(base + offset, 2))
+    entries = header.read(base + offset + 2, 12 * count)
+    tags = {}
+    for i in range(count):
+        tag, kind, n = struct.unpack(endian + 'HHI', entries[12 * i:12 * i + 8])
+        size = _TYPE_SIZES.get(kind, 1) * n
+        raw = entries[12 * i + 8:12 * i + 12]
+        if size > 4:
+            raw = header.read(base + struct.unpack(endian + 'I', raw)[0], size)
+        raw = raw[:size]
+        if kind == 2:
+            tags[tag] = raw.rstrip(b'\0').decode('ascii', 'replace')
+        elif kind in (5, 10):
+            parts = struct.unpack(endian + ('I' if kind == 5 else 'i') * (2 * n), raw)
+            tags[tag] = [a / b if b else 0.0 for a, b in zip(parts[::2], parts[1::2])]
+        elif kind in (3, 4, 9):
+            values = struct.unpack(endian + {3: 'H', 4: 'I', 9: 'i'}[kind] * n, raw)
+            tags[tag] = values[0] if n == 1 else list(values)
+        else:
+            tags[tag] = raw
+    return tags
+
+def _tiff_tags(header, base):
+    # IFD0, EXIF and GPS tags of the TIFF structure at `base`
+    endian = '<' if header.read(base, 2) == b'II' else '>'
+    first, = struct.unpack(endian + 'I', header.read(base + 4, 4))
+    tags = _ifd(header, base, first, endian)
+    gps = _ifd(header, base, tags[0x8825], endian) if 0x8825 in tags else {}
+    exif = _ifd(header, base, tags[0x8769], endian) if 0x8769 in tags else {}
+    return tags, exif, gps
+
+def _jpeg_segments(header):
+    # (TIFF header offset of the EXIF APP1, XMP packet) of a JPEG, stopping at the image data
+    offset, tiff_base, xmp = 2, None, None
+    while True:
+        marker = header.read(offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] in (0xDA, 0xD9):
+            return tiff_base, xmp
+        length, = struct.unpack('>H', marker[2:])
+        if marker[1] == 0xE1:
+            start = header.read(offset + 4, 29)
+            if start.startswith(b'Exif\0\0'):
+                tiff_base = offset + 10
+            elif start.startswith(b'http://ns.adobe.com/xap/1.0/\0'):
+                xmp = header.read(offset + 33, length - 31).decode('utf-8', 'replace')
+        offset += 2 + length
+
+def _xmp_value(xmp, name):
+    match = re.search(rf'{name}="([^"]*)"', xmp) or re.search(rf'<{name}>([^<]*)</{name}>', xmp)
+    return match.group(1) if match else None
+
+def parse_header(fetch):
+    """
+    Position, altitude, capture time, DJI angles and band of the image
+    readable through `fetch(offset, length)`. Missing values are None.
+    """
+    header = _Header(fetch)
+    magic = header.read(0, 4)
+    xmp = None
+    if magic[:2] == b'\xff\xd8':
+        base, xmp = _jpeg_segments(header)
+    elif magic in (b'II*\0', b'MM\0*'):
+        base = 0
+    else:
+        raise ValueError('Not a JPEG or TIFF image')
+
+    tags, exif, gps = _tiff_tags(header, base) if base is not None else ({}, {}, {})
+    if xmp is None and 700 in tags:
+        # TIFFs carry their XMP packet as tag 700
+        xmp = tags[700].decode('utf-8', 'replace') if isinstance(tags[700], bytes) else None
+
+    def coordinate(value_tag, ref_tag, negative):
+        if value_tag not in gps:
+            return None
+        d, m, s = (list(gps[value_tag]) + [0, 0, 0])[:3]
+        return -(d + m / 60 + s / 3600) if gps.get(ref_tag, '').upper() == negative else d + m / 60 + s / 3600
+
+    altitude = gps.get(6, [None])[0]
+    if altitude is not None and gps.get(5) == b'\x01':
+        altitude = -altitude # below sea level
+    record = {
+        'longitude': coordinate(4, 3, 'W'),
+        'latitude': coordinate(2, 1, 'S'),
+        'altitude': altitude,
+        'datetime': exif.get(0x9003),
+        'band': None,
+    }
+    for column, name in XMP_FIELDS.items():
+        value = _xmp_value(xmp, name) if xmp else None
+        record[column] = float(value) if value not in (None, '') else None
+    if xmp:
+        record['band'] = _xmp_value(xmp, 'Camera:BandName')
+    return record
+
+def list_directory(root):
+    # (path, size, mtime in ns) of every image below `root`
+    entries = []
+    for dirpath, _, files in os.walk(root):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, file)
+                stat = os.stat(path)
+                entries.append((path, stat.st_size, stat.st_mtime_ns))
+    return entries
+
+def parse_listing(text):
+    # (https url, size, updated) of the images in `gsutil ls -l` output
+    entries = []
+    for line in text.splitlines():
+        match = re.match(r'\s*(\d+)\s+(\S+)\s+gs://(\S+)$', line)
+        if match and match.group(3).lower().endswith(IMAGE_EXTENSIONS):
+            entries.append((f'https://storage.googleapis.com/{match.group(3)}', int(match.group(1)), match.group(2)))
+    return entries
+
+def list_source(source):
+    if source.startswith('gs://'):
+        result = subprocess.run(['gsutil', 'ls', '-l', source.rstrip('/') + '/**'],
+                                capture_output=True, text=True, check=True)
+        return parse_listing(result.stdout)
+    if os.path.isdir(source):
+        return list_directory(source)
+    with open(source) as f:
+        return parse_listing(f.read())
+
+_session = None
+
+def _fetcher(location):
+    if location.startswith(('http://', 'https://')):
+        global _session
+        if _session is None:
+            import requests
+            _session = requests.Session()
+
+        def fetch(offset, length):
+            response = _session.get(location, headers={'Range': f'bytes={offset}-{offset + length - 1}'}, timeout=60)
+            if response.status_code == 416:
+                return b''
+            response.raise_for_status()
+            if response.status_code == 200:
+                # the server ignored the range and sent the whole file
+                return response.content[offset:offset + length]
+            return response.content
+        return fetch
+
+    def fetch(offset, length):
+        with open(location, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+    return fetch
+
+def _read_entries(entries):
+    # one worker task: a batch of (location, size, mtime); unreadable images are reported, not fatal
+    records = []
+    for location, size, mtime in entries:
+        try:
+            record = parse_header(_fetcher(location))
+        except Exception as e:
+            print(f'Skipping {location}: {e}')
+            continue
+        records.append(dict(record, location=location, name=os.path.basename(location), size=size, mtime=mtime))
+    return records
+
+def _columnar_path(manifest_path):
+    return os.path.splitext(manifest_path)[0] + '.parquet'
+
+def build_manifest(source, manifest_path, url_prefix=None, processes=None, batch_size=64):
+    """
+    Add the images of `source` that `manifest_path` does not list yet (or
+    lists with another size or modification time) and rewrite the CSV and
+    its columnar copy. Local files get `url_prefix` + their path relative to
+    `source` as url when given. Returns (images read, rows in the manifest).
+    """
+    entries = list_source(source)
+    existing = pd.read_csv(manifest_path) if os.path.exists(manifest_path) else pd.DataFrame(columns=COLUMNS)
+    known = set(zip(existing['name'].astype(str), existing['size'].astype(str), existing['mtime'].astype(str))) \
+        if {'name', 'size', 'mtime'} <= set(existing.columns) else set()
+
+    todo = [e for e in entries if (os.path.basename(e[0]), str(e[1]), str(e[2])) not in known]
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    records = []
+    if batches:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for batch in pool.map(_read_entries, batches):
+                records.extend(batch)
+
+    new = pd.DataFrame(records)
+    if len(new):
+        if url_prefix is not None and os.path.isdir(source):
+            new['url'] = [f"{url_prefix.rstrip('/')}/{os.path.relpath(p, source).replace(os.sep, '/')}"
+                          for p in new['location']]
+        else:
+            new['url'] = new['location']
+        new = new.drop(columns='location')
+        # re-read images replace their old rows
+        existing = existing[~existing['name'].astype(str).isin(new['name'])] if 'name' in existing else existing
+    manifest = pd.concat([existing, new], ignore_index=True) if len(existing) else new
+    if not len(manifest):
+        manifest = pd.DataFrame(columns=COLUMNS)
+    manifest = manifest.reindex(columns=COLUMNS + [c for c in manifest.columns if c not in COLUMNS])
+    manifest = manifest.sort_values('name', kind='stable').reset_index(drop=True)
+
+    manifest.drop(columns=['x', 'y'], errors='ignore').to_csv(manifest_path, index=False)
+    write_columnar(manifest, _columnar_path(manifest_path))
+    return len(records), len(manifest)
+
+def write_columnar(manifest, path, crs=crs_target):
+    # parquet copy with the projected coordinates, see manifest_filter
+    x, y = Transformer.from_crs(crs_source, crs, always_xy=True).transform(
+        manifest['longitude'].to_numpy(float), manifest['latitude'].to_numpy(float))
+    columnar = manifest.drop(columns=['x', 'y'], errors='ignore').assign(x=np.asarray(x), y=np.asarray(y))
+    columnar.attrs['crs'] = CRS.from_user_input(crs).to_string()
+    columnar.to_parquet(path, index=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or extend a photo manifest from image headers.')
+    parser.add_argument('source', help='image directory, gs:// prefix or saved `gsutil ls -l` listing')
+    parser.add_argument('manifest', help='manifest CSV to create or extend')
+    parser.add_argument('--url-prefix', default=None, help='public URL of the local directory')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    read, rows = build_manifest(args.source, args.manifest, args.url_prefix, args.processes)
+    print(f'{args.manifest}: {read} images read, {rows} rows ({_columnar_path(args.manifest)} alongside)')
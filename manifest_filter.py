@@ -0,0 +1,89 @@
+"""
+Streaming spatial filter for photo manifests.
+
+The manifest CSV is read in chunks and only the columns needed for the
+selection are kept. Each chunk's longitude/latitude columns are projected
+with one pyproj call, cut to each partition's bounding box and tested
+against the prepared partition polygon with shapely.contains_xy, so a
+single pass yields the photos of every partition.
+
+A columnar copy of the manifest (manifest.parquet, see manifest_builder)
+can be passed instead of the CSV; its projected x/y columns are used as is
+when they are in the requested CRS.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS, Transformer
+
+crs_source = CRS.from_epsg(4326)
+crs_target = CRS.from_epsg(26911)
+
+# columns carried through to the selection when the manifest has them
+# (size/md5 are used to verify downloads, see downloader.manifest_checks;
+# relative_altitude/gimbal_yaw to estimate footprints, see photo_subset)
+optional_columns = ['size', 'md5', 'relative_altitude', 'gimbal_yaw']
+
+def _columns(manifest_path):
+    if manifest_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_schema(manifest_path).names
+    return pd.read_csv(manifest_path, nrows=0).columns
+
+def _chunks(manifest_path, usecols, crs, chunksize):
+    # (rows, x, y) in `crs` for chunks of the manifest's `usecols`
+    if manifest_path.endswith('.parquet'):
+        columns = _columns(manifest_path)
+        projected = {'x', 'y'} <= set(columns)
+        usecols = [c for c in columns if c in usecols] # file order, as read_csv keeps it
+        df = pd.read_parquet(manifest_path, columns=usecols + (['x', 'y'] if projected else []))
+        if projected and CRS.from_user_input(df.attrs.get('crs', crs_target)) == CRS.from_user_input(crs):
+            yield df[usecols], df['x'].to_numpy(), df['y'].to_numpy()
+            return
+        chunks = [df[usecols]]
+    else:
+        chunks = pd.read_csv(manifest_path, usecols=usecols, chunksize=chunksize)
+
+    transformer = Transformer.from_crs(crs_source, crs, always_xy=True)
+    for chunk in chunks:
+        x, y = transformer.transform(chunk['longitude'].to_numpy(), chunk['latitude'].to_numpy())
+        yield chunk, np.asarray(x), np.asarray(y)
+
+def filter_manifest(manifest_path, polygons, crs=crs_target, chunksize=100000, keep_xy=False):
+    """
+    Photos of the manifest at `manifest_path` falling within each of
+    `polygons` (shapely geometries in `crs`). Returns one DataFrame per
+    polygon, with the url column plus any optional_columns, and the
+    projected x/y columns with keep_xy=True.
+    """
+    header = _columns(manifest_path)
+    usecols = ['url', 'longitude', 'latitude'] + [c for c in optional_columns if c in header]
+
+    polygons = list(polygons)
+    shapely.prepare(polygons)
+    bounds = shapely.bounds(polygons)
+    selections = [[] for _ in polygons]
+
+    for chunk, x, y in _chunks(manifest_path, usecols, crs, chunksize):
+        rows = chunk.drop(columns=['longitude', 'latitude'])
+        if keep_xy:
+            rows = rows.assign(x=x, y=y)
+
+        for p, (poly, (minx, miny, maxx, maxy)) in enumerate(zip(polygons, bounds)):
+            # cheap bounding-box cut first, exact test only for the candidates
+            candidates = (x > minx) & (x < maxx) & (y > miny) & (y < maxy)
+            inside = shapely.contains_xy(poly, x[candidates], y[candidates])
+            if inside.any():
+                selections[p].append(rows[candidates].iloc[inside])
+
+    empty = pd.DataFrame(columns=[c for c in usecols if c not in ('longitude', 'latitude')] + (['x', 'y'] if keep_xy else []))
+    return [pd.concat(s, ignore_index=True) if s else empty.copy() for s in selections]
+
+def select_urls(manifest_path, polygon, crs=crs_target, chunksize=100000):
+    # single-polygon convenience wrapper
+    return filter_manifest(manifest_path, [polygon], crs=crs, chunksize=chunksize)[0]['url'].tolist()
+
+def manifest_xy(manifest_path, crs=crs_target, chunksize=100000):
+    # projected positions of every photo as an (n, 2) array, e.g. to balance partitions
+    xy = [np.column_stack([x, y]) for _, x, y in _chunks(manifest_path, ['longitude', 'latitude'], crs, chunksize)]
+    return np.vstack(xy) if xy else np.empty((0, 2))
@@ -0,0 +1,178 @@
+"""
+Per-stage timing and resource metrics.
+
+    metrics = MetricsRecorder('metrics_3.jsonl', array_idx=3)
+    with metrics.stage('download', photos=len(batch)) as record:
+        summary = download_batch(...)
+        record['bytes'] = summary['bytes']
+
+appends one JSON line per stage with wall and CPU time, the peak RSS of the
+process tree while the stage ran, the peak memory in use on the whole host
+(which includes docker containers, e.g. ODM), its status and any counts the
+stage adds to `record`. `on_record` is called with the file path after every record
+(the workers use it to copy the file to the log bucket).
+
+    python3 metrics.py metrics_*.jsonl
+
+summarizes a whole array run: per-partition stage times and the straggler
+partitions that held the job up.
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+def _tree_rss(root_pid):
+    # RSS in bytes of root_pid and all of its descendants, read from /proc
+    parents, rss = {}, {}
+    page = os.sysconf('SC_PAGE_SIZE')
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue # process exited while scanning
+        parents[int(entry)] = int(fields[1])
+        rss[int(entry)] = int(fields[21]) * page
+
+    total, frontier = 0, [root_pid]
+    while frontier:
+        pid = frontier.pop()
+        total += rss.get(pid, 0)
+        frontier.extend(child for child, parent in parents.items() if parent == pid)
+    return total
+
+def _host_used():
+    # bytes in use on the host (MemTotal - MemAvailable), read from /proc/meminfo
+    fields = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            fields[name] = int(value.split()[0]) * 1024
+    return fields['MemTotal'] - fields['MemAvailable']
+
+class _PeakRSS(threading.Thread):
+    # samples the process tree's RSS and the host's used memory until stopped, keeping the maxima
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.host_peak = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        self.peak = max(self.peak, _tree_rss(os.getpid()))
+        self.host_peak = max(self.host_peak, _host_used())
+
+    def run(self):
+        while not self._done.is_set():
+            self._sample()
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self._sample()
+
+class NullMetricsRecorder:
+    # stand-in when metrics are off; stages still get a record to fill
+    @contextmanager
+    def stage(self, name, **counts):
+        yield dict(counts)
+
+    def record(self, name, **fields):
+        pass
+
+class MetricsRecorder:
+    def __init__(self, path, on_record=None, sample_interval=0.5, **context):
+        self.path = path
+        self.on_record = on_record
+        self.sample_interval = sample_interval
+        self.context = context
+        self._lock = threading.Lock() # records may come from upload threads too
+
+    def _write(self, record):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+            if self.on_record is not None:
+                self.on_record(self.path)
+
+    def record(self, name, **fields):
+        # a stage measured elsewhere, e.g. a background upload; fields override the context
+        self._write(dict(self.context, stage=name, status='ok', start=time.time(), **fields))
+
+    def _cpu_seconds(self):
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        return sum(u.ru_utime + u.ru_stime for u in usage)
+
+    @contextmanager
+    def stage(self, name, **counts):
+        record = dict(counts)
+        sampler = _PeakRSS(self.sample_interval) if os.path.isdir('/proc') else None
+        if sampler is not None:
+            sampler.start()
+
+        start, wall, cpu = time.time(), time.perf_counter(), self._cpu_seconds()
+        status = 'ok'
+        try:
+            yield record
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                peak, host_peak = sampler.peak, sampler.host_peak / 2**20
+            else:
+                peak, host_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, None
+
+            self._write(dict(self.context, stage=name, status=status, start=start,
+                             wall_s=time.perf_counter() - wall, cpu_s=self._cpu_seconds() - cpu,
+                             peak_rss_mb=peak / 2**20, peak_host_mem_mb=host_peak, **record))
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+def summarize(records, straggler_factor=1.5):
+    """
+    Wall time per partition (rows) and stage (columns), with a total and a
+    `straggler` flag for partitions slower than `straggler_factor` times the
+    median partition.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    table = df.pivot_table(index='array_idx', columns='stage', values='wall_s', aggfunc='sum')
+    table['total_s'] = table.sum(axis=1)
+    table['peak_rss_mb'] = df.groupby('array_idx')['peak_rss_mb'].max()
+    for count in ['photos', 'gcps', 'bytes']:
+        if count in df:
+            table[count] = df.groupby('array_idx')[count].max()
+    if 'since_start_s' in df:
+        # time from worker start (see bootstrap.started_at) to its first photo download
+        table['first_download_s'] = df.groupby('array_idx')['since_start_s'].min()
+    table['straggler'] = table['total_s'] > straggler_factor * table['total_s'].median()
+    return table.sort_values('total_s', ascending=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize per-stage metrics of an array run.')
+    parser.add_argument('paths', nargs='+', help='metrics_*.jsonl files (globs are expanded)')
+    parser.add_argument('--straggler-factor', type=float, default=1.5)
+    args = parser.parse_args()
+
+    paths = sorted(p for pattern in args.paths for p in glob.glob(pattern))
+    table = summarize(load_records(paths), args.straggler_factor)
+    print(table.round(1).to_string())
+    stragglers = table.index[table['straggler']].tolist()
+    print(f'stragglers: {stragglers}' if stragglers else 'no stragglers')
@@ -0,0 +1,301 @@
+"""
+Survey-wide mosaic of the per-partition orthophotos.
+
+    python3 mosaic.py mosaic.tif odm_orthophoto_*.tif --plan plans/<key> --vrt mosaic.vrt
+
+build_vrt writes a VRT index over the partition outputs that viewers can
+open directly (masked pixels of one partition never hide another). The
+merge streams a seamless mosaic from the same sources: the output grid is
+cut into blocks, each block is composited from the partitions overlapping
+it on a thread pool (each thread with its own dataset handles) and written
+to a tiled working GeoTIFF, which is then published as a COG with
+ortho_mask.to_cog. Memory stays at a few blocks per worker whatever the
+survey size.
+
+Overlaps along the cutlines: with the plan's cutlines a pixel belongs to
+the partition whose cutline contains its centre, and only falls back to
+another partition where the owner has no valid pixel; without cutlines the
+higher partition index wins.
+
+The working GeoTIFF and a manifest of its sources are kept next to the
+output. A later merge with the same grid only recomposites the blocks
+overlapping the sources that changed (e.g. one reprocessed partition).
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+import numpy as np
+import rasterio
+from rasterio.enums import ColorInterp, Resampling
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+from rasterio.windows import Window, bounds as window_bounds, from_bounds, transform as window_transform
+
+from ortho_mask import to_cog
+
+def partition_index(path):
+    # odm_orthophoto_<idx>.tif -> idx
+    match = re.search(r'_(\d+)\.tif+$', os.path.basename(path))
+    if match is None:
+        raise ValueError(f'No partition index in {path}')
+    return int(match.group(1))
+
+def source_index(paths):
+    """
+    Bounds and properties of every source, in partition order, plus the
+    output grid covering all of them at the first source's resolution.
+    """
+    sources = []
+    for path in sorted(paths, key=partition_index):
+        with rasterio.open(path) as src:
+            sources.append({
+                'path': path,
+                'index': partition_index(path),
+                'bounds': tuple(src.bounds),
+                'res': src.res,
+                'crs': src.crs.to_string(),
+                'count': src.count,
+                'dtype': src.dtypes[0],
+                'nodata': src.nodata,
+                'alpha': ColorInterp.alpha in src.colorinterp,
+                'colorinterp': [c.name for c in src.colorinterp],
+                'stat': [os.path.getsize(path), os.path.getmtime(path)] if os.path.exists(path) else None,
+            })
+
+    first = sources[0]
+    for s in sources[1:]:
+        if s['crs'] != first['crs'] or not np.allclose(s['res'], first['res']) or s['count'] != first['count']:
+            raise ValueError(f"{s['path']} does not match the CRS, resolution or bands of {first['path']}")
+
+    bounds = np.array([s['bounds'] for s in sources])
+    xres, yres = first['res']
+    left, top = bounds[:, 0].min(), bounds[:, 3].max()
+    grid = {
+        'crs': first['crs'],
+        'transform': list(from_origin(left, top, xres, yres))[:6],
+        'width': int(np.ceil((bounds[:, 2].max() - left) / xres)),
+        'height': int(np.ceil((top - bounds[:, 1].min()) / yres)),
+    }
+    return sources, grid
+
+def build_vrt(paths, vrt_path):
+    # VRT index over the partition outputs; UseMaskBand keeps masked pixels transparent
+    sources, grid = source_index(paths)
+    first = sources[0]
+    transform = rasterio.Affine(*grid['transform'])
+    dtype = {'uint8': 'Byte', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32',
+             'float32': 'Float32', 'float64': 'Float64'}[first['dtype']]
+
+    lines = [f'<VRTDataset rasterXSize="{grid["width"]}" rasterYSize="{grid["height"]}">',
+             f'  <SRS>{escape(rasterio.crs.CRS.from_string(grid["crs"]).to_wkt())}</SRS>',
+             f'  <GeoTransform>{", ".join(repr(float(v)) for v in transform.to_gdal())}</GeoTransform>']
+    for band in range(1, first['count'] + 1):
+        lines.append(f'  <VRTRasterBand dataType="{dtype}" band="{band}">')
+        lines.append(f'    <ColorInterp>{first["colorinterp"][band - 1].capitalize()}</ColorInterp>')
+        if first['nodata'] is not None:
+            lines.append(f'    <NoDataValue>{first["nodata"]}</NoDataValue>')
+        for s in sources:
+            with rasterio.open(s['path']) as src:
+                width, height = src.width, src.height
+            dst = from_bounds(*s['bounds'], transform=transform)
+            lines += ['    <ComplexSource>',
+                      f'      <SourceFilename relativeToVRT="0">{escape(os.path.abspath(s["path"]))}</SourceFilename>',
+                      f'      <SourceBand>{band}</SourceBand>',
+                      f'      <SrcRect xOff="0" yOff="0" xSize="{width}" ySize="{height}"/>',
+                      f'      <DstRect xOff="{float(dst.col_off)!r}" yOff="{float(dst.row_off)!r}" xSize="{float(dst.width)!r}" ySize="{float(dst.height)!r}"/>',
+                      '      <UseMaskBand>true</UseMaskBand>',
+                      '    </ComplexSource>']
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+
+    with open(vrt_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return vrt_path
+
+class _Compositor:
+    # composites output blocks; every pool thread keeps its own dataset handles
+    def __init__(self, sources, grid, cutlines=None):
+        self.sources = sources
+        self.transform = rasterio.Affine(*grid['transform'])
+        self.bounds = np.array([s['bounds'] for s in sources])
+        self.cutlines = cutlines # {partition index: geometry in the grid CRS}
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def _open(self, path):
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            handles = self._local.handles = {}
+        if path not in handles:
+            handles[path] = rasterio.open(path)
+            with self._lock:
+                self._opened.append(handles[path])
+        return handles[path]
+
+    def close(self):
+        for ds in self._opened:
+            ds.close()
+
+    def overlapping(self, block):
+        left, bottom, right, top = window_bounds(block, self.transform)
+        b = self.bounds
+        return np.flatnonzero((b[:, 0] < right) & (b[:, 2] > left) & (b[:, 1] < top) & (b[:, 3] > bottom))
+
+    def __call__(self, block):
+        shape = (int(block.height), int(block.width))
+        first = self.sources[0]
+        out = np.zeros((first['count'],) + shape, dtype=first['dtype'])
+        if first['nodata'] is not None:
+            out[:] = first['nodata']
+        filled = np.zeros(shape, dtype=bool)
+
+        block_transform = window_transform(block, self.transform)
+        block_bounds = window_bounds(block, self.transform)
+        owner = None
+        if self.cutlines:
+            owner = rasterize([(geom, idx + 1) for idx, geom in self.cutlines.items()], out_shape=shape,
+                              transform=block_transform, fill=0, dtype='int32')
+
+        # highest index first, so without cutlines the higher index wins overlaps
+        reads = []
+        for k in self.overlapping(block)[::-1]:
+            src = self._open(self.sources[k]['path'])
+            window = from_bounds(*block_bounds, transform=src.transform)
+            data = src.read(window=window, out_shape=(src.count,) + shape, boundless=True,
+                            fill_value=first['nodata'] or 0, resampling=Resampling.nearest)
+            valid = src.read_masks(1, window=window, out_shape=shape, boundless=True,
+                                   resampling=Resampling.nearest) > 0
+            reads.append((self.sources[k]['index'], data, valid))
+
+        for idx, data, valid in reads:
+            take = valid & ~filled
+            if owner is not None:
+                take &= owner == idx + 1
+            out[:, take] = data[:, take]
+            filled |= take
+        if owner is not None:
+            # pixels whose owner has no data (edges of the cutline) come from any neighbour
+            for idx, data, valid in reads:
+                take = valid & ~filled
+                out[:, take] = data[:, take]
+                filled |= take
+        return block, out, filled
+
+def _manifest_path(output_path):
+    return output_path + '.sources.json'
+
+def _cutline_key(cutlines):
+    if not cutlines:
+        return None
+    return hashlib.sha256(json.dumps({str(k): g.wkt for k, g in sorted(cutlines.items())}).encode()).hexdigest()[:16]
+
+def merge_mosaic(paths, output_path, cutlines=None, block_size=1024, workers=4, compress='deflate',
+                 predictor=2, incremental=True, cog=True):
+    """
+    Stream the partition orthophotos `paths` into one seamless mosaic at
+    `output_path` (a COG unless cog=False). `cutlines` maps partition
+    indices to their cutline in the rasters' CRS. Returns the number of
+    blocks composited, which is only those touching changed sources when an
+    incremental re-merge applies.
+    """
+    sources, grid = source_index(paths)
+    first = sources[0]
+    work_path = output_path + '.tiles.tif'
+    manifest_path = _manifest_path(output_path)
+    manifest = {'grid': grid, 'cutlines': _cutline_key(cutlines),
+                'sources': {s['path']: {'stat': s['stat'], 'bounds': s['bounds']} for s in sources}}
+
+    previous = None
+    if incremental and os.path.exists(work_path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous['grid'] != json.loads(json.dumps(grid)) or previous['cutlines'] != manifest['cutlines']:
+            previous = None # new grid or cutlines: merge from scratch
+
+    compositor = _Compositor(sources, grid, cutlines)
+    transform = rasterio.Affine(*grid['transform'])
+    blocks = [Window(col, row, min(block_size, grid['width'] - col), min(block_size, grid['height'] - row))
+              for row in range(0, grid['height'], block_size) for col in range(0, grid['width'], block_size)]
+
+    if previous is None:
+        blocks = [b for b in blocks if len(compositor.overlapping(b))]
+    else:
+        # blocks under the old or new footprint of every added, changed or removed source
+        old, new = previous['sources'], manifest['sources']
+        changed = [new[path]['bounds'] for path in new if old.get(path, {}).get('stat') != new[path]['stat']]
+        changed += [old[path]['bounds'] for path in old if new.get(path, {}).get('stat') != old[path]['stat']]
+        changed = np.array(changed, dtype=float).reshape(-1, 4)
+        def touches(block):
+            left, bottom, right, top = window_bounds(block, transform)
+            return bool(((changed[:, 0] < right) & (changed[:, 2] > left) &
+                         (changed[:, 1] < top) & (changed[:, 3] > bottom)).any())
+        blocks = [b for b in blocks if touches(b)]
+
+    write_mask = first['nodata'] is None and not first['alpha']
+    profile = {
+        'driver': 'GTiff', 'width': grid['width'], 'height': grid['height'], 'count': first['count'],
+        'dtype': first['dtype'], 'crs': grid['crs'], 'transform': transform, 'nodata': first['nodata'],
+        'tiled': True, 'blockxsize': block_size, 'blockysize': block_size, 'compress': compress,
+        'predictor': predictor, 'bigtiff': 'IF_SAFER', 'sparse_ok': True, 'num_threads': 'ALL_CPUS',
+    }
+
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True):
+        dst = rasterio.open(work_path, 'r+') if previous is not None else rasterio.open(work_path, 'w', **profile)
+        try:
+            if previous is None:
+                dst.colorinterp = [ColorInterp[c] for c in first['colorinterp']]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # bounded look-ahead: at most 2 * workers blocks in memory
+                for i in range(0, len(blocks), 2 * workers):
+                    for block, data, filled in pool.map(compositor, blocks[i:i + 2 * workers]):
+                        dst.write(data, window=block)
+                        if write_mask:
+                            dst.write_mask(filled.astype('uint8') * 255, window=block)
+        finally:
+            dst.close()
+            compositor.close()
+
+    if cog:
+        to_cog(work_path, output_path, block_size=512, compress=compress, predictor=predictor, num_threads='ALL_CPUS')
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return len(blocks)
+
+def load_cutlines(plan_dir, crs):
+    # cutlines of a job plan (see plan_job.write_plan) reprojected to `crs`
+    import geopandas as gpd
+    from plan_job import load_partition, crs_target
+
+    cutlines = {}
+    for file in os.listdir(plan_dir):
+        if re.fullmatch(r'partition_\d+\.json', file):
+            part = load_partition(os.path.join(plan_dir, file))
+            cutlines[part['index']] = gpd.GeoSeries([part['cutline']], crs=crs_target).to_crs(crs).iloc[0]
+    return cutlines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge per-partition orthophotos into one mosaic.')
+    parser.add_argument('output_path')
+    parser.add_argument('paths', nargs='+', help='odm_orthophoto_<idx>.tif files')
+    parser.add_argument('--plan', default=None, help='local plan directory whose cutlines resolve overlaps')
+    parser.add_argument('--vrt', default=None, help='also write a VRT index to this path')
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--full', action='store_true', help='recomposite every block')
+    args = parser.parse_args()
+
+    if args.vrt:
+        build_vrt(args.paths, args.vrt)
+    cutlines = None
+    if args.plan:
+        with rasterio.open(args.paths[0]) as src:
+            cutlines = load_cutlines(args.plan, src.crs)
+    blocks = merge_mosaic(args.paths, args.output_path, cutlines, args.block_size, args.workers,
+                          incremental=not args.full)
+    print(f'{args.output_path}: {blocks} blocks composited')
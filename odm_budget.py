@@ -0,0 +1,243 @@
+"""
+ODM settings per partition that fit the array into a wall-clock budget.
+
+    python3 odm_budget.py plan plans/<key> --hours 8 --history 'metrics_*.jsonl'   # dry run over a job plan
+    python3 odm_budget.py report plans/<key> 'metrics_*.jsonl'                     # predicted vs. actual per partition
+    python3 odm_budget.py validate 'metrics_*.jsonl'                               # cross-validate the model
+
+OdmCostModel predicts the ODM stage's wall time (and the node's peak memory)
+from the photo count, orthophoto resolution and options as a log-linear
+model, time ~ k * photos^a * (one factor per option). The coefficients start
+from rough priors (ultra about 4 h for 1000 photos, fast-orthophoto about
+halving it, ...) and are fitted to the 'odm' records of earlier runs
+(metrics.MetricsRecorder logs) by ridge regression towards those priors, so
+a few runs already correct the scale and more runs the individual factors.
+
+plan_settings starts every partition at the best settings of LADDER and,
+while the predicted finish time of the array exceeds the budget, steps the
+longest partition of the busiest node down the ladder. With fewer nodes than
+partitions (work queue) nodes take the partitions longest first.
+
+The chosen options go into the plan's partition records ('odm') and
+process_images passes them to ODM with odm_args. plan_report joins the
+plan's predictions with the 'odm' stage each partition then recorded.
+"""
+import argparse
+import glob
+import json
+import os
+import numpy as np
+
+# best first; resize_to None keeps the full 5280 px M3M images
+LADDER = [
+    {'feature_quality': 'ultra', 'resize_to': None, 'fast_orthophoto': False},
+    {'feature_quality': 'high', 'resize_to': None, 'fast_orthophoto': False},
+    {'feature_quality': 'high', 'resize_to': None, 'fast_orthophoto': True},
+    {'feature_quality': 'medium', 'resize_to': None, 'fast_orthophoto': True},
+    {'feature_quality': 'medium', 'resize_to': 2048, 'fast_orthophoto': True},
+    {'feature_quality': 'low', 'resize_to': 2048, 'fast_orthophoto': True},
+]
+DEFAULT_OPTIONS = LADDER[0] # what process_images always ran before
+FULL_SIZE_PX = 5280
+QUALITIES = ['high', 'medium', 'low', 'lowest'] # relative to ultra
+
+# [intercept, log photos, high, medium, low, lowest, fast orthophoto, log resize ratio, log resolution]
+TIME_PRIOR = np.array([np.log(14400 / 1000 ** 1.1), 1.1, np.log(0.55), np.log(0.35), np.log(0.25), np.log(0.2),
+                       np.log(0.5), 1.5, -0.3])
+MEMORY_PRIOR = np.array([np.log(40000 / 1000 ** 0.7), 0.7, np.log(0.7), np.log(0.5), np.log(0.4), np.log(0.35),
+                         np.log(0.6), 1.0, -0.3])
+
+def odm_args(options=None, ortho_res=None):
+    # ODM command-line flags for `options` (DEFAULT_OPTIONS when None)
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    args = []
+    if ortho_res is not None:
+        args += ['--orthophoto-resolution', f'{ortho_res}']
+    args += ['--feature-quality', options['feature_quality']]
+    if options['resize_to']:
+        args += ['--resize-to', f"{options['resize_to']}"]
+    if options['fast_orthophoto']:
+        args.append('--fast-orthophoto')
+    return args + ['--force-gps']
+
+def _features(photos, options, ortho_res):
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    ratio = min((options['resize_to'] or FULL_SIZE_PX) / FULL_SIZE_PX, 1.0)
+    return np.array([1.0, np.log(max(photos, 1))] +
+                    [float(options['feature_quality'] == q) for q in QUALITIES] +
+                    [float(bool(options['fast_orthophoto'])), np.log(ratio), np.log(ortho_res or 1.0)])
+
+def odm_records(records):
+    # successful ODM stages with their options (records from before the options were logged ran DEFAULT_OPTIONS)
+    keys = list(DEFAULT_OPTIONS)
+    return [dict(r, options={k: r.get(k, DEFAULT_OPTIONS[k]) for k in keys})
+            for r in records if r.get('stage') == 'odm' and r.get('status') == 'ok' and r.get('photos')]
+
+class OdmCostModel:
+    def __init__(self, prior_weight=1.0):
+        self.prior_weight = prior_weight
+        self.time_coef = TIME_PRIOR.copy()
+        self.memory_coef = MEMORY_PRIOR.copy()
+        self.n_time = self.n_memory = 0
+
+    def _ridge(self, X, y, prior):
+        # least squares pulled towards `prior`
+        A = X.T @ X + self.prior_weight * np.eye(len(prior))
+        return np.linalg.solve(A, X.T @ y + self.prior_weight * prior)
+
+    def fit(self, records):
+        runs = odm_records(records)
+        timed = [r for r in runs if r.get('wall_s')]
+        if timed:
+            X = np.array([_features(r['photos'], r['options'], r.get('ortho_res')) for r in timed])
+            self.time_coef = self._ridge(X, np.log([r['wall_s'] for r in timed]), TIME_PRIOR)
+        sized = [r for r in runs if r.get('peak_host_mem_mb')]
+        if sized:
+            X = np.array([_features(r['photos'], r['options'], r.get('ortho_res')) for r in sized])
+            self.memory_coef = self._ridge(X, np.log([r['peak_host_mem_mb'] for r in sized]), MEMORY_PRIOR)
+        self.n_time, self.n_memory = len(timed), len(sized)
+        return self
+
+    def predict(self, photos, options=None, ortho_res=None):
+        # (seconds, peak memory in MB) of one ODM run
+        x = _features(photos, options, ortho_res)
+        return float(np.exp(x @ self.time_coef)), float(np.exp(x @ self.memory_coef))
+
+def _schedule(seconds, nodes):
+    # node of each partition and node finish times, longest partitions first onto the least busy node
+    loads = np.zeros(nodes)
+    assignment = {}
+    for idx in sorted(seconds, key=seconds.get, reverse=True):
+        node = int(np.argmin(loads))
+        assignment[idx] = node
+        loads[node] += seconds[idx]
+    return assignment, loads
+
+def plan_settings(photo_counts, budget_s, model=None, ortho_res=None, nodes=None, memory_mb=None):
+    """
+    ODM options for every partition ({index: photo count}) so that the
+    array finishes within `budget_s` on `nodes` nodes (one per partition by
+    default), never predicting more than `memory_mb` on a node. Returns
+    {index: {'options', 'predicted_s', 'predicted_mem_mb', 'node'}} and the
+    predicted finish time; a partition that cannot fit is left at the
+    cheapest settings and the finish time shows the overrun.
+    """
+    model = model or OdmCostModel()
+    nodes = nodes or len(photo_counts)
+    predictions = {idx: [model.predict(n, options, ortho_res) for options in LADDER]
+                   for idx, n in photo_counts.items()}
+
+    # highest rung that fits in memory to begin with
+    level = {}
+    for idx, rungs in predictions.items():
+        fits = [i for i, (_, mem) in enumerate(rungs) if memory_mb is None or mem <= memory_mb]
+        level[idx] = fits[0] if fits else len(LADDER) - 1
+
+    while True:
+        seconds = {idx: predictions[idx][level[idx]][0] for idx in level}
+        assignment, loads = _schedule(seconds, nodes)
+        finish = float(loads.max()) if len(loads) else 0.0
+        if finish <= budget_s:
+            break
+        busiest = int(np.argmax(loads))
+        movable = [idx for idx, node in assignment.items() if node == busiest and level[idx] < len(LADDER) - 1]
+        if not movable:
+            break
+        level[max(movable, key=seconds.get)] += 1
+
+    settings = {idx: {'options': LADDER[level[idx]], 'predicted_s': predictions[idx][level[idx]][0],
+                      'predicted_mem_mb': predictions[idx][level[idx]][1], 'node': assignment[idx]}
+                for idx in level}
+    return settings, finish
+
+def loo_report(records, prior_weight=1.0):
+    """
+    Predicted vs. actual seconds of every recorded ODM run, each predicted
+    by a model fitted to the other runs.
+    """
+    runs = [r for r in odm_records(records) if r.get('wall_s')]
+    rows = []
+    for i, run in enumerate(runs):
+        model = OdmCostModel(prior_weight).fit(runs[:i] + runs[i + 1:])
+        predicted, _ = model.predict(run['photos'], run['options'], run.get('ortho_res'))
+        rows.append({'array_idx': run.get('array_idx'), 'photos': run['photos'], **run['options'],
+                     'actual_s': run['wall_s'], 'predicted_s': predicted, 'error': predicted / run['wall_s'] - 1})
+    return rows
+
+def plan_report(plan_partitions, records):
+    """
+    Predicted vs. actual ODM seconds of every partition of a plan
+    (plan.json's 'partitions', with the 'odm' entry plan_settings wrote)
+    from the metrics records of its run; the last successful 'odm' stage
+    of a partition counts. Partitions without a record have actual_s None.
+    """
+    actual = {}
+    for r in odm_records(records):
+        if r.get('wall_s') and (r['array_idx'] not in actual or r.get('start', 0) >= actual[r['array_idx']].get('start', 0)):
+            actual[r['array_idx']] = r
+    rows = []
+    for part in plan_partitions:
+        odm = part.get('odm') or {}
+        run = actual.get(part['index'])
+        predicted = odm.get('predicted_s')
+        rows.append({'index': part['index'], 'photos': part['n_photos'], **dict(DEFAULT_OPTIONS, **odm.get('options', {})),
+                     'predicted_s': predicted, 'actual_s': run['wall_s'] if run else None,
+                     'error': predicted / run['wall_s'] - 1 if run and predicted else None})
+    return rows
+
+def _load(patterns):
+    from metrics import load_records
+    return load_records(sorted(p for pattern in patterns for p in glob.glob(pattern)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan ODM settings for a wall-clock budget.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    plan = sub.add_parser('plan', help='dry run: settings and predicted times for the partitions of a job plan')
+    plan.add_argument('plan_dir')
+    plan.add_argument('--hours', type=float, required=True)
+    plan.add_argument('--nodes', type=int, default=None)
+    plan.add_argument('--memory-gb', type=float, default=None)
+    plan.add_argument('--ortho-res', type=float, default=None)
+    plan.add_argument('--history', nargs='*', default=[], help='metrics_*.jsonl files of earlier runs')
+    report = sub.add_parser('report', help="predicted vs. actual ODM time of every partition of a plan's run")
+    report.add_argument('plan_dir')
+    report.add_argument('metrics', nargs='+', help='metrics_*.jsonl files of the run')
+    validate = sub.add_parser('validate', help='leave-one-out predicted vs. actual ODM times of recorded runs')
+    validate.add_argument('history', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        with open(os.path.join(args.plan_dir, 'plan.json')) as f:
+            summary = json.load(f)
+        counts = {p['index']: p['n_photos'] for p in summary['partitions']}
+        model = OdmCostModel().fit(_load(args.history))
+        settings, finish = plan_settings(counts, args.hours * 3600, model, args.ortho_res, args.nodes,
+                                         args.memory_gb * 1024 if args.memory_gb else None)
+        print(f'model fitted to {model.n_time} timed runs')
+        for idx, s in sorted(settings.items()):
+            o = s['options']
+            print(f"partition {idx}: {counts[idx]} photos, {o['feature_quality']}, resize {o['resize_to'] or 'full'}, "
+                  f"fast-orthophoto {o['fast_orthophoto']} -> {s['predicted_s'] / 3600:.1f} h, "
+                  f"{s['predicted_mem_mb'] / 1024:.0f} GB (node {s['node']})")
+        print(f'predicted finish {finish / 3600:.1f} h of {args.hours:g} h')
+    elif args.command == 'report':
+        with open(os.path.join(args.plan_dir, 'plan.json')) as f:
+            summary = json.load(f)
+        rows = plan_report(summary['partitions'], _load(args.metrics))
+        for r in rows:
+            predicted = 'no prediction' if r['predicted_s'] is None else f"predicted {r['predicted_s'] / 60:.0f} min"
+            actual = 'not run' if r['actual_s'] is None else f"actual {r['actual_s'] / 60:.0f} min"
+            error = '' if r['error'] is None else f" ({r['error']:+.0%})"
+            print(f"partition {r['index']}: {r['photos']} photos, {r['feature_quality']}"
+                  f"{' fast' if r['fast_orthophoto'] else ''}: {predicted}, {actual}{error}")
+        errors = [abs(r['error']) for r in rows if r['error'] is not None]
+        if errors:
+            print(f'median absolute error {np.median(errors):.0%} over {len(errors)} partitions')
+    else:
+        rows = loo_report(_load(args.history))
+        for r in rows:
+            print(f"array {r['array_idx']}: {r['photos']} photos, {r['feature_quality']}"
+                  f"{' fast' if r['fast_orthophoto'] else ''}: actual {r['actual_s'] / 60:.0f} min, "
+                  f"predicted {r['predicted_s'] / 60:.0f} min ({r['error']:+.0%})")
+        if rows:
+            print(f"median absolute error {np.median([abs(r['error']) for r in rows]):.0%} over {len(rows)} runs")
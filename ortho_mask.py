@@ -0,0 +1,193 @@
+"""
+Windowed cutline masking of ODM orthophotos.
+
+mask_to_gdf reads the whole cropped orthophoto into memory before writing
+it. mask_to_cog walks the output block by block instead: each block is read
+from the orthophoto, the cutline is rasterized for that block only, and the
+masked block is written to a tiled intermediate. The intermediate is then
+translated into a compressed Cloud-Optimized GeoTIFF with internal
+overviews by GDAL's COG driver. Peak memory is one block per band plus the
+GDAL block cache (`cache_mb`), whatever the orthophoto size.
+
+Outside the cutline pixels are always masked the same way: through the
+alpha band when the orthophoto has one (ODM's RGBA output), through the
+nodata value when it has one, and through an internal mask band otherwise.
+
+    python3 ortho_mask.py publish odm_orthophoto_3.tif odm_orthophoto_3_cog.tif
+    python3 ortho_mask.py report odm_orthophoto_3.tif odm_orthophoto_3_cog.tif
+
+converts an already masked orthophoto (e.g. one written by mask_to_gdf) to
+a COG, and compares the file sizes and the read amplification of typical
+viewer requests (see read_amplification) of two rasters.
+"""
+import argparse
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import ColorInterp
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+
+def mask_to_cog(gdf, raster_path, output_path, block_size=512, compress='deflate', predictor=2,
+                num_threads=None, cache_mb=256, overview_resampling='average', report=False):
+    """
+    Crop `raster_path` to the geometries of `gdf` and write the result to
+    `output_path` as a Cloud-Optimized GeoTIFF. Pixels outside the cutline
+    are set to the raster's nodata value (0 if it has none), as
+    rasterio.mask.mask does. `num_threads` (e.g. 'ALL_CPUS') enables
+    multi-threaded compression. With `report` the cog_report of the
+    intermediate (same extent and mask, tiled GTiff without overviews)
+    against the COG is returned, so it measures the COG layout alone.
+    """
+    threads = {} if num_threads is None else {'num_threads': str(num_threads)}
+    tmp_path = output_path + '.blocks.tif'
+
+    with rasterio.Env(GDAL_CACHEMAX=cache_mb, GDAL_TIFF_INTERNAL_MASK=True), rasterio.open(raster_path) as src:
+        geoms = list(gdf.to_crs(src.crs).geometry)
+        window = geometry_window(src, geoms)
+        window = Window(int(window.col_off), int(window.row_off), int(window.width), int(window.height))
+        fill = src.nodata if src.nodata is not None else 0
+        # without alpha or nodata the cutline goes into an internal mask band
+        write_mask = src.nodata is None and ColorInterp.alpha not in src.colorinterp
+
+        profile = src.profile.copy()
+        profile.update({
+            'driver': 'GTiff',
+            'width': window.width,
+            'height': window.height,
+            'transform': src.window_transform(window),
+            'tiled': True,
+            'blockxsize': block_size,
+            'blockysize': block_size,
+            'compress': compress,
+            'predictor': predictor,
+            'bigtiff': 'IF_SAFER',
+            'sparse_ok': True, # blocks entirely outside the cutline are never written
+        })
+        profile.update(threads)
+
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for _, block in dst.block_windows(1):
+                inside = geometry_mask(geoms, out_shape=(block.height, block.width),
+                                       transform=dst.window_transform(block), invert=True)
+                if not inside.any():
+                    continue # sparse: reads back as nodata / transparent / masked
+
+                src_block = Window(block.col_off + window.col_off, block.row_off + window.row_off,
+                                   block.width, block.height)
+                # masked read so alpha/nodata pixels are filled like rasterio.mask does
+                data = src.read(window=src_block, masked=True).filled(fill)
+                data[:, ~inside] = fill
+                dst.write(data, window=block)
+                if write_mask:
+                    dst.write_mask(inside.astype('uint8') * 255, window=block)
+
+    to_cog(tmp_path, output_path, block_size, compress, predictor, num_threads, cache_mb, overview_resampling)
+    result = cog_report(tmp_path, output_path) if report else None
+    os.remove(tmp_path)
+    return result
+
+def to_cog(raster_path, output_path, block_size=512, compress='deflate', predictor=2,
+           num_threads=None, cache_mb=256, overview_resampling='average'):
+    """
+    Translate a GeoTIFF into a Cloud-Optimized GeoTIFF: `block_size` tiles,
+    `compress`/`predictor` compression and internal overviews down to one
+    tile, keeping the raster's alpha band, nodata value or mask band.
+    """
+    threads = {} if num_threads is None else {'num_threads': str(num_threads)}
+    with rasterio.Env(GDAL_CACHEMAX=cache_mb, GDAL_TIFF_INTERNAL_MASK=True):
+        rasterio.shutil.copy(raster_path, output_path, driver='COG', blocksize=block_size,
+                             compress=compress, predictor=predictor, bigtiff='IF_SAFER',
+                             overview_resampling=overview_resampling, **threads)
+
+def _fetched_bytes(ds, window):
+    # compressed bytes of every block a window read touches
+    block_h, block_w = ds.block_shapes[0]
+    rows = range(int(window.row_off) // block_h, -(-int(window.row_off + window.height) // block_h))
+    cols = range(int(window.col_off) // block_w, -(-int(window.col_off + window.width) // block_w))
+    # pixel-interleaved blocks hold every band
+    bands = [1] if ds.profile.get('interleave') == 'pixel' else ds.indexes
+    return sum(ds.block_size(b, i, j) for b in bands for i in rows for j in cols)
+
+def read_amplification(raster_path, window_px=512, view_px=1024, samples=64, seed=0):
+    """
+    Bytes a viewer fetches from `raster_path` for two kinds of request,
+    from the compressed sizes of the blocks they touch:
+
+    - zoom_in: `samples` random `window_px` windows at full resolution,
+    - zoom_out: the whole extent drawn `view_px` wide, from the coarsest
+      overview at least that wide (full resolution without overviews).
+
+    Amplification is fetched bytes over the uncompressed size of the
+    pixels that are displayed.
+    """
+    rng = np.random.default_rng(seed)
+    with rasterio.open(raster_path) as src:
+        pixel_bytes = src.count * np.dtype(src.dtypes[0]).itemsize
+        width, height = min(window_px, src.width), min(window_px, src.height)
+        cols = rng.integers(0, src.width - width + 1, samples)
+        rows = rng.integers(0, src.height - height + 1, samples)
+        zoom_in = np.mean([_fetched_bytes(src, Window(c, r, width, height)) for c, r in zip(cols, rows)])
+
+        factors = src.overviews(1)
+        usable = [i for i, f in enumerate(factors) if src.width / f >= view_px]
+        view_w, view_h = min(view_px, src.width), max(1, round(min(view_px, src.width) * src.height / src.width))
+        report = {
+            'file_bytes': os.path.getsize(raster_path),
+            'overviews': factors,
+            'zoom_in_bytes': float(zoom_in),
+            'zoom_in_amplification': float(zoom_in / (width * height * pixel_bytes)),
+        }
+
+    if usable:
+        with rasterio.open(raster_path, overview_level=usable[-1]) as ovr:
+            zoom_out = _fetched_bytes(ovr, Window(0, 0, ovr.width, ovr.height))
+    else:
+        with rasterio.open(raster_path) as full:
+            zoom_out = _fetched_bytes(full, Window(0, 0, full.width, full.height))
+    report.update({'zoom_out_bytes': float(zoom_out),
+                   'zoom_out_amplification': float(zoom_out / (view_w * view_h * pixel_bytes))})
+    return report
+
+def cog_report(before_path, after_path, **kwargs):
+    # size and read amplification of a raster before and after publishing
+    before = read_amplification(before_path, **kwargs)
+    after = read_amplification(after_path, **kwargs)
+    return {
+        'before': before,
+        'after': after,
+        'size_ratio': after['file_bytes'] / before['file_bytes'],
+        'zoom_in_gain': before['zoom_in_amplification'] / after['zoom_in_amplification'],
+        'zoom_out_gain': before['zoom_out_amplification'] / after['zoom_out_amplification'],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish orthophotos as COGs and compare read costs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    publish = subparsers.add_parser('publish', help='convert a GeoTIFF to a COG')
+    publish.add_argument('raster_path')
+    publish.add_argument('output_path')
+    publish.add_argument('--block-size', type=int, default=512)
+    publish.add_argument('--compress', default='deflate')
+    publish.add_argument('--predictor', type=int, default=2)
+    publish.add_argument('--overview-resampling', default='average')
+    report = subparsers.add_parser('report', help='compare two rasters')
+    report.add_argument('before_path')
+    report.add_argument('after_path')
+    args = parser.parse_args()
+
+    if args.command == 'publish':
+        to_cog(args.raster_path, args.output_path, args.block_size, args.compress, args.predictor,
+               num_threads='ALL_CPUS', overview_resampling=args.overview_resampling)
+        before_path, after_path = args.raster_path, args.output_path
+    else:
+        before_path, after_path = args.before_path, args.after_path
+
+    result = cog_report(before_path, after_path)
+    for name in ['before', 'after']:
+        r = result[name]
+        print(f"{name}: {r['file_bytes'] / 2**20:.1f} MB, overviews {r['overviews']}, "
+              f"zoom-in read x{r['zoom_in_amplification']:.2f}, zoom-out read x{r['zoom_out_amplification']:.2f}")
+    print(f"size x{result['size_ratio']:.2f}, zoom-in reads {result['zoom_in_gain']:.1f}x smaller, "
+          f"zoom-out reads {result['zoom_out_gain']:.1f}x smaller")
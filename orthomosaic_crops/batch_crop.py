@@ -0,0 +1,154 @@
+"""
+Batch crop engine for GeoTIFF orthomosaics.
+
+`crop_and_save_geotiff` reprojects and masks one bounding box at a time.
+`batch_crop_geotiff` instead:
+
+- reprojects all boxes with a single `to_crs` call,
+- turns each box directly into a pixel window (no polygon rasterization),
+- orders the windows by the raster's internal block layout so neighbouring
+  crops reuse the same blocks, and
+- spreads contiguous runs of windows over a process pool, each worker
+  holding its own dataset handle.
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio.windows import Window
+
+_src = None  # per-worker dataset handle
+
+
+def get_bounding_boxes(gdf, side_len_m=1):
+    """
+    Vectorized equivalent of `get_bounding_boxes` in `crop geotiff.py`: a
+    square with sides of `side_len_m` around every point of `gdf`.
+    """
+    half_side = side_len_m / 2
+    x, y = gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy()
+    boxes = shapely.box(x - half_side, y - half_side, x + half_side, y + half_side)
+    return gpd.GeoDataFrame(geometry=boxes, crs=gdf.crs)
+
+
+def boxes_to_windows(bounding_boxes, src):
+    """
+    Pixel windows of `src` covering each box (in `src.crs` after one
+    reprojection). A pixel belongs to the crop when its centre falls inside
+    the box's envelope. Windows are clipped to the raster; boxes entirely
+    outside it get a zero-sized window.
+    """
+    bounds = bounding_boxes.to_crs(src.crs).bounds.to_numpy()
+    inv = ~src.transform
+    cols_a, rows_a = inv * (bounds[:, 0], bounds[:, 3])
+    cols_b, rows_b = inv * (bounds[:, 2], bounds[:, 1])
+
+    col_start = np.clip(np.round(np.minimum(cols_a, cols_b)), 0, src.width).astype(int)
+    col_stop = np.clip(np.round(np.maximum(cols_a, cols_b)), 0, src.width).astype(int)
+    row_start = np.clip(np.round(np.minimum(rows_a, rows_b)), 0, src.height).astype(int)
+    row_stop = np.clip(np.round(np.maximum(rows_a, rows_b)), 0, src.height).astype(int)
+
+    return np.column_stack([col_start, row_start, col_stop - col_start, row_stop - row_start])
+
+
+def block_order(windows, block_shape):
+    """
+    Indices of `windows` sorted by the (row, column) of the internal block
+    holding each window's top-left pixel.
+    """
+    block_h, block_w = block_shape
+    block_rows = windows[:, 1] // block_h
+    block_cols = windows[:, 0] // block_w
+    return np.lexsort((windows[:, 0], block_cols, windows[:, 1], block_rows))
+
+
+def _open_worker(geotiff_path):
+    global _src
+    _src = rasterio.open(geotiff_path)
+
+
+def _crop_chunk(args):
+    items, output_folder, write_images, prefix, compression_level = args
+    meta = _src.meta.copy()
+    meta.update({"driver": "GTiff", "compress": "DEFLATE", "zlevel": compression_level})
+
+    pixels = 0
+    for i, col_off, row_off, width, height in items:
+        if width == 0 or height == 0:
+            continue
+        window = Window(col_off, row_off, width, height)
+        out_image = _src.read(window=window)
+        pixels += width * height
+
+        if write_images:
+            meta.update({"height": height, "width": width, "transform": _src.window_transform(window)})
+            output_path = os.path.join(output_folder, f"{prefix}_{i}.tif")
+            with rasterio.open(output_path, "w", **meta) as dest:
+                dest.write(out_image)
+    return pixels
+
+
+def batch_crop_geotiff(
+    geotiff_path,
+    bounding_boxes,
+    output_folder,
+    write_images=True,
+    prefix="cropped",
+    compression_level=6,
+    processes=None,
+    chunk_size=256,
+):
+    """
+    Crops the GeoTIFF to every bounding box and saves each crop as
+    `{prefix}_{i}.tif` with DEFLATE compression, like crop_and_save_geotiff.
+    With `write_images=False` nothing is written (not even the output folder),
+    which makes it a dry run for timing the reads. Returns the number of
+    pixels read.
+    """
+    if write_images and not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    with rasterio.open(geotiff_path) as src:
+        windows = boxes_to_windows(bounding_boxes, src)
+        order = block_order(windows, src.block_shapes[0])
+
+    # contiguous runs in block order keep each worker on neighbouring blocks
+    items = np.column_stack([np.arange(len(windows)), windows])[order].tolist()
+    chunks = [
+        (items[i:i + chunk_size], output_folder, write_images, prefix, compression_level)
+        for i in range(0, len(items), chunk_size)
+    ]
+
+    if processes == 1:
+        _open_worker(geotiff_path)
+        try:
+            return sum(_crop_chunk(chunk) for chunk in chunks)
+        finally:
+            _src.close()
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_open_worker, initargs=(geotiff_path,)) as pool:
+        return sum(pool.map(_crop_chunk, chunks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crop a GeoTIFF around every point of a shapefile.")
+    parser.add_argument("shapefile_path")
+    parser.add_argument("geotiff_path")
+    parser.add_argument("output_folder")
+    parser.add_argument("--side-len-m", type=float, default=1)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="read the crops without writing them")
+    args = parser.parse_args()
+
+    points_gdf = gpd.read_file(args.shapefile_path)
+    bounding_boxes = get_bounding_boxes(points_gdf, args.side_len_m)
+    batch_crop_geotiff(
+        args.geotiff_path,
+        bounding_boxes,
+        args.output_folder,
+        write_images=not args.dry_run,
+        processes=args.processes,
+    )
@@ -78,10 +78,11 @@ def crop_and_save_geotiff(
                     dest.write(out_image)
 
 
-shapefile_path = "./points.shp"
-geotiff_path = "./orthomosaic.tif"
-output_folder = "./folder/"
+if __name__ == "__main__":
+    shapefile_path = "./points.shp"
+    geotiff_path = "./orthomosaic.tif"
+    output_folder = "./folder/"
 
-points_gdf = load_shapefile(shapefile_path)
-bounding_boxes = get_bounding_boxes(points_gdf)
-crop_and_save_geotiff(geotiff_path, bounding_boxes, output_folder)
+    points_gdf = load_shapefile(shapefile_path)
+    bounding_boxes = get_bounding_boxes(points_gdf)
+    crop_and_save_geotiff(geotiff_path, bounding_boxes, output_folder)
@@ -0,0 +1,461 @@
+import numpy as np
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from shapely.geometry import Point, Polygon, MultiPoint, box
+from shapely.ops import nearest_points
+
+def voronoi_finite_polygons_2d(vor, radius=None):
+    """
+    Reconstruct infinite voronoi regions in a 2D diagram to finite
+    regions.
+
+    Source: https://gist.github.com/pv/8036995
+    """
+
+    if vor.points.shape[1] != 2:
+        raise ValueError("Requires 2D input")
+
+    new_regions = []
+    new_vertices = vor.vertices.tolist()
+
+    center = vor.points.mean(axis=0)
+    if radius is None:
+        radius = np.ptp(vor.points).max()*2
+
+    # Construct a map containing all ridges for a given point
+    all_ridges = {}
+    for (p1, p2), (v1, v2) in zip(vor.ridge_points, vor.ridge_vertices):
+        all_ridges.setdefault(p1, []).append((p2, v1, v2))
+        all_ridges.setdefault(p2, []).append((p1, v1, v2))
+
+    # Reconstruct infinite regions
+    for p1, region in enumerate(vor.point_region):
+        vertices = vor.regions[region]
+
+        if all(v >= 0 for v in vertices):
+            # finite region
+            new_regions.append(vertices)
+            continue
+
+        # reconstruct a non-finite region
+        ridges = all_ridges[p1]
+        new_region = [v for v in vertices if v >= 0]
+
+        for p2, v1, v2 in ridges:
+            if v2 < 0:
+                v1, v2 = v2, v1
+            if v1 >= 0:
+                # finite ridge: already in the region
+                continue
+
+            # Compute the missing endpoint of an infinite ridge
+
+            t = vor.points[p2] - vor.points[p1] # tangent
+            t /= np.linalg.norm(t)
+            n = np.array([-t[1], t[0]])  # normal
+
+            midpoint = vor.points[[p1, p2]].mean(axis=0)
+            direction = np.sign(np.dot(midpoint - center, n)) * n
+            far_point = vor.vertices[v2] + direction * radius
+
+            new_region.append(len(new_vertices))
+            new_vertices.append(far_point.tolist())
+
+        # sort region counterclockwise
+        vs = np.asarray([new_vertices[v] for v in new_region])
+        c = vs.mean(axis=0)
+        angles = np.arctan2(vs[:,1] - c[1], vs[:,0] - c[0])
+        new_region = np.array(new_region)[np.argsort(angles)]
+
+        # finish
+        new_regions.append(new_region.tolist())
+
+    return new_regions, np.asarray(new_vertices)
+
+def generate_points(poly, num, seed=None):
+    np.random.seed(seed)
+    points = []
+    minx, miny, maxx, maxy = poly.bounds
+    while len(points) < num:
+        random_point = Point(np.random.uniform(minx, maxx), np.random.uniform(miny, maxy))
+        if (random_point.within(poly)):
+            points.append(random_point)
+    return [point.coords[0] for point in points]
+
+def sample_points(poly, num, seed=None, method='triangulation', batch_factor=1.5):
+    """
+    Draw `num` uniform random points inside `poly` as an (num, 2) array.
+
+    method='triangulation' picks triangles of a constrained Delaunay
+    triangulation of the polygon weighted by area, then a uniform point in
+    each, so thin drainage polygons cost no more than compact ones.
+    method='rejection' draws candidates from the bounding box in vectorized
+    batches and keeps those inside the prepared polygon. `seed` may be
+    anything numpy.random.default_rng accepts, including a Generator; the
+    global numpy random state is left alone.
+    """
+    rng = np.random.default_rng(seed)
+
+    if method == 'triangulation':
+        triangles = shapely.get_parts(shapely.constrained_delaunay_triangles(poly))
+        areas = shapely.area(triangles)
+        corners = shapely.get_coordinates(triangles).reshape(-1, 4, 2)[:, :3]
+
+        picks = rng.choice(len(triangles), size=num, p=areas / areas.sum())
+        u, v = rng.random((2, num))
+        flip = u + v > 1 # fold the unit square onto the triangle
+        u[flip], v[flip] = 1 - u[flip], 1 - v[flip]
+        a, b, c = corners[picks, 0], corners[picks, 1], corners[picks, 2]
+        return a + u[:, None] * (b - a) + v[:, None] * (c - a)
+
+    if method != 'rejection':
+        raise ValueError(f"Unknown method '{method}', expected 'triangulation' or 'rejection'")
+
+    shapely.prepare(poly)
+    minx, miny, maxx, maxy = poly.bounds
+    fill = poly.area / ((maxx - minx) * (maxy - miny))
+    points = np.empty((0, 2))
+    while len(points) < num:
+        batch = int(batch_factor * (num - len(points)) / fill) + 1
+        xy = rng.uniform((minx, miny), (maxx, maxy), size=(batch, 2))
+        points = np.vstack([points, xy[shapely.contains_xy(poly, xy[:, 0], xy[:, 1])]])
+    return points[:num]
+
+def calculate_voronoi_complexity(poly, points, method='vectorized'):
+    """
+    Perimeter/area of every Voronoi cell of `points` clipped to `poly`.
+
+    method='vectorized' clips all cells in one shapely call and returns NumPy
+    arrays; method='legacy' is the original per-region implementation, kept
+    so the two can be compared.
+    """
+    if method == 'legacy':
+        return _calculate_voronoi_complexity_legacy(poly, points)
+
+    cells = clipped_voronoi_cells(poly, points, method=method)
+    areas = shapely.area(cells)
+    keep = areas > 0
+    complexity = shapely.length(cells[keep]) / areas[keep]
+
+    return complexity, cells[keep]
+
+def _calculate_voronoi_complexity_legacy(poly, points):
+    from scipy.spatial import Voronoi # only the legacy paths need scipy
+
+    # compute Voronoi tesselation
+    vor = Voronoi(points)
+
+    # create finite Voronoi polygons
+    regions, vertices = voronoi_finite_polygons_2d(vor)
+
+    # construct the polygons and intersect with the original one
+    voronoi_polygons = [poly.intersection(Polygon(vertices[region])) for region in regions]
+
+    # return only the valid ones (completely inside the original polygon)
+    valid_polygons = [p for p in voronoi_polygons if p.is_valid]
+
+    # calculate the perimeter and areas of each valid polygon
+    perimeters = [p.length for p in valid_polygons]
+    areas = [p.area for p in valid_polygons]
+    complexity = [x / y for x, y in zip(perimeters, areas)]
+
+    return complexity, valid_polygons
+
+def optimize_voronoi_complexity(poly, num, max_iterations=1000, learning_rate=0.1, seed=None, method='legacy'):
+    # method='legacy' by default so reruns reproduce existing partitions; 'vectorized' is opt-in
+    points = generate_points(poly, num, seed)
+    np.random.seed(seed)
+    mns = [] # to store complexity means at each iteration
+
+    for i in range(max_iterations):
+        complexity, polygons = calculate_voronoi_complexity(poly, points, method=method)
+        mn = np.mean(complexity)
+        mns.append(mn) # append current std dev to the list
+
+        # randomly select a point
+        point_idx = np.random.randint(0, len(points))
+        current_point = Point(points[point_idx])
+
+        # Compute gradients by trying small movements in each direction
+        min_mn = mn
+        min_mn_direction = None
+        for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+            new_point = Point(current_point.x + dx * learning_rate, current_point.y + dy * learning_rate)
+            new_points = points.copy()
+            new_points[point_idx] = (new_point.x, new_point.y)
+
+            new_complexity, _ = calculate_voronoi_complexity(poly, new_points, method=method)
+            new_mn = np.mean(new_complexity)
+
+            if new_mn < min_mn:
+                min_mn = new_mn
+                min_mn_direction = (dx, dy)
+
+        # If we found a direction that decreases the mean complexity, move the point
+        if min_mn_direction is not None:
+            dx, dy = min_mn_direction
+            points[point_idx] = (current_point.x + dx * learning_rate, current_point.y + dy * learning_rate)
+
+    return polygons, mns
+
+def clipped_voronoi_cells(poly, points, method='vectorized'):
+    """
+    Voronoi cells of `points` clipped to `poly`, one per point and in the
+    same order as `points`, so cells can be matched back to their seeds.
+    """
+    if method == 'legacy':
+        from scipy.spatial import Voronoi
+
+        vor = Voronoi(points)
+        regions, vertices = voronoi_finite_polygons_2d(vor)
+        cells = [poly.intersection(Polygon(vertices[region])) for region in regions]
+        return np.array(cells, dtype=object)
+    if method != 'vectorized':
+        raise ValueError(f"Unknown method '{method}', expected 'vectorized' or 'legacy'")
+
+    # extend_to makes every cell reach past the flight polygon's envelope,
+    # ordered keeps cells in the order of the input points
+    diagram = shapely.voronoi_polygons(MultiPoint(np.asarray(points)), extend_to=box(*poly.bounds), ordered=True)
+    return shapely.intersection(shapely.get_parts(diagram), poly)
+
+def _reseed_empty(poly, points, cells, rng):
+    """
+    Move the seeds whose clipped cells are empty (seeds outside `poly` or
+    crowded out by their neighbours) to random points inside the largest
+    cell, so every seed owns a cell again. Returns the new seeds and
+    whether any moved.
+    """
+    empty = shapely.area(cells) <= 0
+    if not empty.any():
+        return points, False
+    points = np.array(points, dtype=float)
+    for j in np.flatnonzero(empty):
+        largest = cells[np.argmax(shapely.area(cells))]
+        points[j] = sample_points(largest, 1, rng)[0]
+        cells = clipped_voronoi_cells(poly, points)
+    return points, True
+
+def _cell_targets(cells, points):
+    # centroid of each cell, pulled back onto the cell for non-convex flight
+    # polygons where the centroid can fall outside; empty cells stay put
+    targets = shapely.get_coordinates(shapely.centroid(cells))
+    empty = shapely.is_empty(cells)
+    out = np.array(points, dtype=float)
+    out[~empty] = targets
+
+    outside = ~empty & ~shapely.contains_xy(cells, out[:, 0], out[:, 1])
+    for j in np.flatnonzero(outside):
+        out[j] = nearest_points(cells[j], Point(out[j]))[0].coords[0]
+    return out
+
+def lloyd_relaxation(poly, num, max_iterations=100, tol=0.5, seed=None, method='vectorized'):
+    """
+    Centroidal Voronoi (Lloyd) relaxation of `num` seeds inside `poly`.
+
+    Every iteration moves all seeds to the centroids of their clipped cells,
+    which is what drives cells towards compact, low perimeter/area shapes.
+    Stops once no seed moves more than `tol` map units. Returns the `num`
+    polygons of the best iteration seen (seeds whose cell comes out empty
+    are re-seeded, see _reseed_empty), the mean complexity of every
+    iteration and that of the returned polygons.
+    """
+    rng = np.random.default_rng(seed)
+    points = sample_points(poly, num, rng)
+    mns = [] # to store complexity means at each iteration
+    best_mn = np.inf
+    best_polygons = None
+
+    for i in range(max_iterations):
+        cells = clipped_voronoi_cells(poly, points, method=method)
+        areas = shapely.area(cells)
+        mn = np.mean(shapely.length(cells[areas > 0]) / areas[areas > 0])
+        mns.append(mn)
+
+        points, reseeded = _reseed_empty(poly, points, cells, rng)
+        if reseeded:
+            continue # only iterations where every seed has a cell count
+        if mn < best_mn:
+            best_mn = mn
+            best_polygons = cells
+
+        targets = _cell_targets(cells, points)
+        shift = np.hypot(*(targets - points).T).max()
+        points = targets
+        if shift < tol:
+            break
+
+    if best_polygons is None:
+        raise ValueError(f'No iteration gave all {num} cells a non-empty area')
+    return best_polygons, mns, best_mn
+
+def _lloyd_run(args):
+    poly, num, max_iterations, tol, seed = args
+    return lloyd_relaxation(poly, num, max_iterations=max_iterations, tol=tol, seed=seed)
+
+def optimize_partition(poly, num, restarts=4, max_iterations=100, tol=0.5, seed=None, processes=None):
+    """
+    Multi-start Lloyd relaxation. Each restart draws its own initial seeds
+    and the restarts run across a process pool; the run reaching the lowest
+    mean complexity wins.
+
+    Drop-in for optimize_voronoi_complexity: returns (polygons, mns) where
+    `mns` is the convergence history of the winning run.
+    """
+    # independent, reproducible initial seeds for every restart
+    seeds = np.random.SeedSequence(seed).spawn(restarts)
+    jobs = [(poly, num, max_iterations, tol, s) for s in seeds]
+
+    if restarts == 1 or processes == 1:
+        results = [_lloyd_run(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_lloyd_run, jobs))
+
+    # compared on the returned polygons: the history also has the re-seeded iterations
+    polygons, mns, _ = min(results, key=lambda r: r[2])
+    return polygons, mns
+
+def partition_load(cells, photo_xy, gcp_xy=None, gcp_cutoff=5, base_buffer=50, quad_segs=16):
+    """
+    Predicted ODM load of each cell: the number of photos (an (n, 2) array
+    of projected positions) inside the cell once it is buffered the way
+    survey_utils.expand_to_gcps_exact buffers it, i.e. by the distance to
+    its `gcp_cutoff`-th nearest GCP and at least `base_buffer`. Without
+    `gcp_xy` every cell is buffered by `base_buffer`. Returns the photo
+    counts and the buffer distances; empty cells count zero photos.
+    """
+    cells = np.asarray(cells)
+    photo_xy = np.asarray(photo_xy, dtype=float)
+    distances = np.full(len(cells), float(base_buffer))
+    empty = shapely.is_empty(cells)
+
+    if gcp_xy is not None:
+        if len(gcp_xy) < gcp_cutoff:
+            raise ValueError(f'Only {len(gcp_xy)} GCPs available, {gcp_cutoff} required')
+        gcps = shapely.points(np.asarray(gcp_xy, dtype=float))
+        gcp_distances = shapely.distance(cells[~empty, None], gcps[None, :])
+        kth = np.partition(gcp_distances, gcp_cutoff - 1, axis=1)[:, gcp_cutoff - 1]
+        distances[~empty] = np.maximum(base_buffer, kth)
+
+    buffered = shapely.buffer(cells, distances, quad_segs=quad_segs)
+    shapely.prepare(buffered)
+    loads = np.zeros(len(cells), dtype=int)
+    for j in np.flatnonzero(~empty):
+        minx, miny, maxx, maxy = buffered[j].bounds
+        x, y = photo_xy[:, 0], photo_xy[:, 1]
+        candidates = (x > minx) & (x < maxx) & (y > miny) & (y < maxy)
+        loads[j] = shapely.contains_xy(buffered[j], x[candidates], y[candidates]).sum()
+    return loads, distances
+
+def balance_objective(cells, loads, compactness=0.1):
+    """
+    Load imbalance (largest load over the mean, minus one: the array waits
+    for its slowest node) plus `compactness` times the mean isoperimetric
+    ratio of the cells minus one (zero for circles), so balancing does not
+    produce long, thin partitions.
+    """
+    areas = shapely.area(cells)
+    keep = areas > 0
+    isoperimetric = shapely.length(cells[keep]) / (2 * np.sqrt(np.pi * areas[keep]))
+    imbalance = loads.max() / max(loads.mean(), 1e-9) - 1
+    return imbalance + compactness * (isoperimetric.mean() - 1)
+
+def balanced_partition(poly, num, photo_xy, gcp_xy=None, compactness=0.1, max_sweeps=30, step=None,
+                       min_step=1.0, seed=None, gcp_cutoff=5, base_buffer=50):
+    """
+    Partition `poly` into `num` Voronoi cells with about the same number of
+    photos each, counting the photos the GCP buffer adds (see
+    partition_load).
+
+    Seeds start from a photo-weighted k-means, which puts more, smaller
+    cells where the flight lines are dense. A coordinate descent then moves
+    one seed at a time, most loaded cell first, by `step` map units in each
+    direction and keeps moves that lower balance_objective without emptying
+    a cell; the step is halved after a sweep without improvement, down to
+    `min_step`. Seeds that start with an empty cell are re-seeded, so all
+    `num` cells are returned.
+
+    Drop-in for optimize_partition: returns (polygons, history) where
+    `history` holds the objective after every sweep.
+    """
+    from scipy.spatial import cKDTree
+
+    rng = np.random.default_rng(seed)
+    photo_xy = np.asarray(photo_xy, dtype=float)
+    shapely.prepare(poly)
+    inside = np.unique(photo_xy[shapely.contains_xy(poly, photo_xy[:, 0], photo_xy[:, 1])], axis=0)
+
+    if len(inside) >= num:
+        points = inside[rng.choice(len(inside), size=num, replace=False)]
+        for i in range(10):
+            owner = cKDTree(points).query(inside)[1]
+            counts = np.bincount(owner, minlength=num)
+            sums = np.column_stack([np.bincount(owner, weights=inside[:, d], minlength=num) for d in (0, 1)])
+            moved = counts > 0 # seeds without photos stay put
+            points[moved] = sums[moved] / counts[moved, None]
+    else:
+        points = sample_points(poly, num, rng)
+
+    # e.g. a k-means seed outside a non-convex flight polygon
+    for attempt in range(num):
+        points, reseeded = _reseed_empty(poly, points, clipped_voronoi_cells(poly, points), rng)
+        if not reseeded:
+            break
+
+    def evaluate(points):
+        cells = clipped_voronoi_cells(poly, points)
+        if (shapely.area(cells) <= 0).any():
+            return np.inf, cells, None # a partition without area
+        loads, _ = partition_load(cells, photo_xy, gcp_xy, gcp_cutoff, base_buffer)
+        return balance_objective(cells, loads, compactness), cells, loads
+
+    best, cells, loads = evaluate(points)
+    if loads is None:
+        raise ValueError(f'Could not give all {num} cells a non-empty area')
+    history = [best]
+    step = np.sqrt(poly.area / num) / 4 if step is None else step
+
+    for sweep in range(max_sweeps):
+        improved = False
+        for j in np.argsort(-loads):
+            for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+                trial = points.copy()
+                trial[j] += (dx * step, dy * step)
+                value, trial_cells, trial_loads = evaluate(trial)
+                if value < best:
+                    best, points, cells, loads = value, trial, trial_cells, trial_loads
+                    improved = True
+                    break
+        history.append(best)
+
+        if not improved:
+            step /= 2
+            if step < min_step:
+                break
+
+    return cells, history
+
+def size_report(poly, photo_xy, sizes, gcp_xy=None, compactness=0.1, seed=None, **kwargs):
+    """
+    Predicted per-node photo loads of a balanced partition for each
+    candidate compute_array_sz in `sizes`, to pick the array size. The
+    overhead is the share of photos processed twice because buffers overlap.
+    """
+    photo_xy = np.asarray(photo_xy, dtype=float)
+    shapely.prepare(poly)
+    total = shapely.contains_xy(poly, photo_xy[:, 0], photo_xy[:, 1]).sum()
+
+    report = []
+    for size in sizes:
+        cells, history = balanced_partition(poly, size, photo_xy, gcp_xy, compactness, seed=seed, **kwargs)
+        loads, distances = partition_load(cells, photo_xy, gcp_xy)
+        report.append({
+            'compute_array_sz': size,
+            'max_photos': int(loads.max()),
+            'mean_photos': float(loads.mean()),
+            'min_photos': int(loads.min()),
+            'imbalance': float(loads.max() / loads.mean() - 1),
+            'overhead': float(loads.sum() / max(total, 1) - 1),
+            'loads': loads.tolist(),
+        })
+    return report
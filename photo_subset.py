@@ -0,0 +1,189 @@
+"""
+Overlap-aware photo subset per partition.
+
+The M3M missions fly with more front and side overlap than ODM needs, and
+the GCP buffer adds more photos still. select_subset estimates every
+photo's ground footprint from the manifest (position, altitude above
+ground, heading and the camera's field of view) and keeps a small subset
+that still covers every point of the cutline with `target` photos:
+
+- the cutline is sampled on a regular grid,
+- photos referenced by the GCP list are always kept,
+- the rest are picked greedily, each time the photo covering the most grid
+  points still short of the target (points that fewer photos cover than
+  the target keep every photo that covers them).
+
+The target follows from the overlap ODM should still see, e.g. 70% front
+and 60% side overlap is 1 / (0.3 * 0.4), about 9 photos over each point.
+
+Manifest columns: `relative_altitude` (m above the take-off point) and
+`gimbal_yaw` (degrees clockwise from north) are used when present; otherwise
+the mission altitude from the config and the heading along the flight line
+(from the neighbouring photos in capture order) are assumed. The footprint
+is the camera's ground rectangle with its long side across the track.
+
+The report gives the photo counts and the expected ODM time as a fraction of
+the full set, assuming time grows as photos ** time_exponent.
+"""
+import argparse
+import heapq
+import os
+import numpy as np
+import shapely
+
+# sensor size and focal length in mm
+CAMERAS = {
+    'm3m': {'sensor_mm': (17.3, 13.0), 'focal_mm': 12.29}, # Mavic 3 Multispectral RGB camera
+}
+
+def coverage_target(front_overlap=0.7, side_overlap=0.6):
+    # photos over each ground point of a regular mission flown with these overlaps
+    return int(np.ceil(1 / ((1 - front_overlap) * (1 - side_overlap)) - 1e-9))
+
+def track_heading(x, y):
+    """
+    Heading in degrees clockwise from north at every photo, from the photos
+    before and after it (in the given order, i.e. capture order).
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if len(x) < 2:
+        return np.zeros(len(x))
+    prev_i = np.r_[0, np.arange(len(x) - 1)]
+    next_i = np.r_[np.arange(1, len(x)), len(x) - 1]
+    return np.degrees(np.arctan2(x[next_i] - x[prev_i], y[next_i] - y[prev_i])) % 360
+
+def footprints(x, y, altitude, heading, camera='m3m'):
+    """
+    Ground footprint of every photo as shapely polygons: a rectangle of the
+    camera's field of view at `altitude` metres, long side across `heading`.
+    """
+    spec = CAMERAS[camera]
+    width_mm, height_mm = spec['sensor_mm']
+    altitude = np.broadcast_to(np.asarray(altitude, dtype=float), np.shape(x))
+    half_across = altitude * width_mm / spec['focal_mm'] / 2
+    half_along = altitude * height_mm / spec['focal_mm'] / 2
+
+    theta = np.radians(heading)
+    along = np.column_stack([np.sin(theta), np.cos(theta)]) # unit vector of the heading
+    across = np.column_stack([along[:, 1], -along[:, 0]])
+    centre = np.column_stack([x, y])
+    corners = [centre + sa * half_along[:, None] * along + sc * half_across[:, None] * across
+               for sa, sc in [(1, 1), (1, -1), (-1, -1), (-1, 1)]]
+    return shapely.polygons(np.stack(corners, axis=1))
+
+def _grid(poly, spacing):
+    minx, miny, maxx, maxy = poly.bounds
+    gx, gy = np.meshgrid(np.arange(minx + spacing / 2, maxx, spacing), np.arange(miny + spacing / 2, maxy, spacing))
+    gx, gy = gx.ravel(), gy.ravel()
+    shapely.prepare(poly)
+    inside = shapely.contains_xy(poly, gx, gy)
+    return gx[inside], gy[inside]
+
+def select_subset(photos, cutline, keep=(), target=None, altitude=None, camera='m3m', spacing=None, time_exponent=1.2):
+    """
+    Subset of `photos` (a DataFrame with projected x/y, optionally
+    relative_altitude and gimbal_yaw, and url; in capture order) covering
+    `cutline` with `target` photos (coverage_target() by default). Photos
+    whose file name is in `keep` are always selected. Returns a boolean
+    array over `photos` and a report.
+    """
+    target = coverage_target() if target is None else target
+    n = len(photos)
+    x, y = photos['x'].to_numpy(float), photos['y'].to_numpy(float)
+    if 'relative_altitude' in photos and photos['relative_altitude'].notna().all():
+        altitude = photos['relative_altitude'].to_numpy(float)
+    elif altitude is None:
+        raise ValueError('The manifest has no relative_altitude column; pass the mission altitude')
+    if 'gimbal_yaw' in photos and photos['gimbal_yaw'].notna().all():
+        heading = photos['gimbal_yaw'].to_numpy(float)
+    else:
+        heading = track_heading(x, y)
+
+    names = photos['url'].map(os.path.basename).to_numpy()
+    forced = np.isin(names, list(keep))
+    selected = forced.copy()
+    report = {'photos': n, 'forced': int(forced.sum()), 'target': target}
+    if n == 0 or cutline.is_empty:
+        report.update(kept=int(selected.sum()), reduction=0.0, time_fraction=1.0, min_coverage=None)
+        return selected, report
+
+    polys = footprints(x, y, altitude, heading, camera)
+    if spacing is None:
+        # several grid points across the narrowest footprint side
+        spacing = float(np.median(altitude)) * min(CAMERAS[camera]['sensor_mm']) / CAMERAS[camera]['focal_mm'] / 8
+    gx, gy = _grid(cutline, spacing)
+
+    # (photo, grid point) pairs for every point inside a footprint
+    tree = shapely.STRtree(shapely.points(gx, gy))
+    photo_idx, point_idx = tree.query(polys, predicate='contains')
+    order = np.argsort(photo_idx, kind='stable')
+    photo_idx, point_idx = photo_idx[order], point_idx[order]
+    starts = np.searchsorted(photo_idx, np.arange(n + 1))
+    points_of = [point_idx[starts[i]:starts[i + 1]] for i in range(n)]
+
+    # a point covered by fewer photos than the target needs all of them
+    available = np.bincount(point_idx, minlength=len(gx))
+    deficit = np.minimum(available, target)
+    for i in np.flatnonzero(forced):
+        deficit[points_of[i]] -= 1
+    np.maximum(deficit, 0, out=deficit)
+
+    # lazy greedy: gains only shrink, so a popped photo whose recomputed gain
+    # still beats the next best one is the best pick
+    heap = [(-len(points_of[i]), i) for i in range(n) if not selected[i] and len(points_of[i])]
+    heapq.heapify(heap)
+    while heap and deficit.any():
+        _, i = heapq.heappop(heap)
+        gain = int((deficit[points_of[i]] > 0).sum())
+        if gain == 0:
+            continue
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, i))
+            continue
+        selected[i] = True
+        deficit[points_of[i]] -= 1
+        np.maximum(deficit, 0, out=deficit)
+
+    coverage = np.bincount(point_idx[selected[photo_idx]], minlength=len(gx))
+    kept = int(selected.sum())
+    report.update(kept=kept, reduction=1 - kept / n, time_fraction=(kept / n) ** time_exponent,
+                  grid_points=len(gx), min_coverage=int(coverage.min()) if len(gx) else None,
+                  mean_coverage_before=float(available.mean()) if len(gx) else None,
+                  mean_coverage_after=float(coverage.mean()) if len(gx) else None)
+    return selected, report
+
+def gcp_images(gcp_list):
+    # file names of the photos a gcp_list.txt (its text) references
+    rows = [line.split('\t') for line in gcp_list.splitlines()[1:] if line.strip()]
+    return {row[5] for row in rows if len(row) > 5}
+
+def format_report(report):
+    text = (f"{report['kept']} of {report['photos']} photos ({report['reduction']:.0%} fewer, "
+            f"{report['forced']} kept for GCPs), expected ODM time {report['time_fraction']:.0%} of the full set")
+    if report.get('min_coverage') is not None:
+        text += (f"; coverage {report['mean_coverage_before']:.1f} -> {report['mean_coverage_after']:.1f} photos "
+                 f"per point (min {report['min_coverage']}, target {report['target']})")
+    return text
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the photo subset of every partition of a job plan.')
+    parser.add_argument('plan_dir', help='local plan directory (see plan_job.py)')
+    parser.add_argument('manifest', help='photo manifest CSV')
+    parser.add_argument('--altitude', type=float, default=None, help='mission altitude above ground in metres')
+    parser.add_argument('--front-overlap', type=float, default=0.7)
+    parser.add_argument('--side-overlap', type=float, default=0.6)
+    parser.add_argument('--camera', choices=sorted(CAMERAS), default='m3m')
+    args = parser.parse_args()
+
+    from plan_job import load_partition
+    from manifest_filter import filter_manifest
+
+    parts = [load_partition(os.path.join(args.plan_dir, f)) for f in sorted(os.listdir(args.plan_dir))
+             if f.startswith('partition_')]
+    selections = filter_manifest(args.manifest, [p['buffered'] for p in parts], keep_xy=True)
+    target = coverage_target(args.front_overlap, args.side_overlap)
+    for part, photos in zip(parts, selections):
+        photos = photos.sort_values('url', kind='stable')
+        keep = gcp_images(part['gcp_list']) if part['gcp_list'] else ()
+        _, report = select_subset(photos, part['cutline'], keep, target, args.altitude, args.camera)
+        print(f"partition {part['index']}: {format_report(report)}")
@@ -0,0 +1,309 @@
+"""
+Compute the survey partition once and publish it as a job plan.
+
+    python3 plan_job.py <config_url_or_path> [--out DIR] [--upload]
+
+Every odm-array-N node used to repeat the same seeded partitioning,
+expand_to_gcps, manifest sjoin and filter_gcp_list only to keep its own
+slice. The planner does that work once and writes
+
+    <key>/plan.json            summary of the whole plan
+    <key>/partition_<idx>.json cutline, buffered polygon, photo URLs and the
+                               trimmed GCP list for one array index
+
+where <key> hashes the flight plan, manifest, GCP grid, GCP list and the
+partition parameters, so a changed input never reuses a stale plan. With
+--upload the plan is copied to gs://<output_bucket>/plans/<key> and that URI
+is printed last; pass it to the workers as the `plan_uri` instance metadata.
+
+With `"partition_engine": "balanced"` in the config the cells are balanced by
+photo count (including the photos their GCP buffer adds) instead of shape.
+The default descent engine keeps its original per-cell Voronoi kernel so
+reruns reproduce existing partitions; `"voronoi_kernel": "vectorized"` opts
+in to the vectorized one. Likewise partitions are buffered with the
+incremental expand_to_gcps unless `"gcp_buffer": "exact"` buffers them by the
+distance to their k-th nearest GCP (expand_to_gcps_exact).
+
+    python3 plan_job.py <config_url_or_path> --size-report 8 12 16
+
+prints the predicted photos per node for each candidate compute_array_sz.
+
+A `"photo_subset"` config entry (mission altitude and the front/side overlap
+to keep) thins each partition's photos to those needed for that overlap
+over its cutline, see photo_subset.py.
+
+An `"odm_budget"` config entry (e.g. {"hours": 8, "nodes": 10, "memory_gb": 120})
+picks each partition's ODM settings so the array is predicted to finish
+within the budget, see odm_budget.py; --history passes the metrics of
+earlier runs the cost model is fitted to.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import geopandas as gpd
+import shapely
+from pyproj import CRS
+from shapely import wkt
+
+from downloader import manifest_checks
+from gcp_store import cached_store
+from manifest_filter import filter_manifest, manifest_xy
+from metrics import load_records
+from odm_budget import OdmCostModel, plan_settings
+from photo_subset import coverage_target, format_report, gcp_images, select_subset
+from partition import optimize_voronoi_complexity, optimize_partition, balanced_partition, size_report
+from survey_utils import download_file, load_kml, expand_to_gcps, expand_to_gcps_exact, filter_gcp_list, copy_to_gcs, copy_from_gcs
+
+PLAN_VERSION = 1
+
+crs_source = CRS.from_epsg(4326)
+crs_target = CRS.from_epsg(26911)
+
+def load_config(config_url):
+    config_file = config_url
+    if not os.path.exists(config_url):
+        config_file = os.path.basename(config_url)
+        download_file(config_url, config_file)
+
+    with open(config_file, 'r') as json_file:
+        return json.load(json_file)
+
+def fetch_inputs(config, branch='main', dest_dir='.'):
+    # download everything the partitioning depends on into `dest_dir` (the working directory by default)
+    gcp_grid_url = f"https://raw.githubusercontent.com/samsoe/mpg_aerial_survey/{branch}/gcp_kmls/upland_gcps_{config['gcp_res']}m.kml"
+    urls = {
+        'gcp_grid': gcp_grid_url,
+        'flight_plan': config['flight_plan_url'],
+        'photo_manifest': config['photo_manifest_url'],
+        'gcp_list': config['gcp_editor_url'],
+    }
+
+    paths = {}
+    for name, url in urls.items():
+        if url is None:
+            paths[name] = None
+            continue
+        file = os.path.basename(url)
+        if name == 'gcp_list':
+            # the trimmed list is written under the original name later
+            file = file.replace('.txt', '_init.txt')
+        paths[name] = os.path.join(dest_dir, file)
+        download_file(url, paths[name])
+    return paths
+
+def plan_params(config, seed=0, step_sz=30):
+    return {
+        'version': PLAN_VERSION,
+        'compute_array_sz': config['compute_array_sz'],
+        'gcp_res': config['gcp_res'],
+        'partition_engine': config.get('partition_engine', 'descent'), # 'lloyd', or 'balanced' by photo count
+        'voronoi_kernel': config.get('voronoi_kernel', 'legacy'), # 'vectorized' for a faster descent
+        'compactness': config.get('partition_compactness', 0.1), # shape penalty of the balanced engine
+        'seed': seed,
+        'gcp_buffer': config.get('gcp_buffer', 'step'), # 'exact' for the distance to the k-th nearest GCP
+        'step_sz': step_sz,
+        # e.g. {"altitude": 90, "front_overlap": 0.7, "side_overlap": 0.6} to thin redundant photos
+        'photo_subset': config.get('photo_subset'),
+        # e.g. {"hours": 8, "nodes": 10} to fit ODM's settings to a wall-clock budget
+        'odm_budget': dict(config['odm_budget'], ortho_res=config['survey_res']) if config.get('odm_budget') else None,
+    }
+
+def plan_key(paths, params):
+    h = hashlib.sha256()
+    for name in sorted(paths):
+        if paths[name] is None:
+            continue
+        h.update(name.encode())
+        with open(paths[name], 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+def load_geometry(paths):
+    # projected flight polygon and the GCPs within it, from the cached binary store of the grid
+    flight_roi = load_kml(paths['flight_plan'])
+    flight_roi.crs = crs_source
+    flight_projected_src = flight_roi.to_crs(crs_target)
+
+    store = cached_store(paths['gcp_grid'])
+    gcps_flight = store.select(store.within(flight_projected_src.geometry.union_all()))
+    return flight_projected_src.geometry[0], gcps_flight
+
+def build_plan(paths, params, indices=None, history=()):
+    """
+    Partition the flight plan and resolve each requested partition (all of
+    them by default) to its buffered polygon, photo URLs and GCP list.
+    With an odm_budget the metrics records in `history` calibrate the ODM
+    cost model.
+    """
+    poly, gcps_flight = load_geometry(paths)
+    if params['partition_engine'] == 'balanced':
+        gcp_xy = shapely.get_coordinates(gcps_flight.geometry.values) if params['gcp_buffer'] == 'exact' else None
+        parts, means = balanced_partition(poly, params['compute_array_sz'], manifest_xy(paths['photo_manifest']),
+                                          gcp_xy, compactness=params['compactness'], seed=params['seed'])
+    elif params['partition_engine'] == 'lloyd':
+        parts, means = optimize_partition(poly, params['compute_array_sz'], seed=params['seed'])
+    else:
+        parts, means = optimize_voronoi_complexity(poly, params['compute_array_sz'],
+                                                   learning_rate=30, max_iterations=1000, seed=params['seed'],
+                                                   method=params['voronoi_kernel'])
+
+    # the array starts compute_array_sz nodes, each expecting its own non-empty partition
+    empty = [i for i, part in enumerate(parts) if part.is_empty or part.area <= 0]
+    if len(parts) != params['compute_array_sz'] or empty:
+        raise ValueError(f"The {params['partition_engine']} partition has {len(parts)} cells for compute_array_sz "
+                         f"{params['compute_array_sz']}" + (f', empty cells {empty}' if empty else ''))
+
+    indices = range(len(parts)) if indices is None else indices
+    buffered, buffer_m = {}, {}
+    for idx in indices:
+        base_poly = gpd.GeoDataFrame(geometry=[parts[idx]], crs=crs_target)
+        if params['gcp_buffer'] == 'exact':
+            buffered[idx], buffer_m[idx] = expand_to_gcps_exact(base_poly, gcps_flight)
+        else:
+            buffered[idx], buffer_m[idx] = expand_to_gcps(base_poly, gcps_flight, step_sz=params['step_sz']), None
+
+    # one pass over the manifest selects the photos of every partition
+    subset = params.get('photo_subset')
+    selections = filter_manifest(paths['photo_manifest'], [b.geometry.iloc[0] for b in buffered.values()],
+                                 keep_xy=subset is not None)
+
+    partitions = []
+    for (idx, buffered_poly), selected in zip(buffered.items(), selections):
+        gcp_list = None
+        if paths['gcp_list'] is not None:
+            with tempfile.TemporaryDirectory() as tmp:
+                trimmed = os.path.join(tmp, 'gcp_list.txt')
+                filter_gcp_list(paths['gcp_list'], buffered_poly.to_crs(crs_source), trimmed)
+                with open(trimmed) as f:
+                    gcp_list = f.read()
+
+        report = None
+        if subset is not None:
+            # capture order (DJI file names start with the timestamp) for the flight-line headings
+            selected = selected.sort_values('url', kind='stable')
+            target = coverage_target(subset.get('front_overlap', 0.7), subset.get('side_overlap', 0.6))
+            keep, report = select_subset(selected, parts[idx], gcp_images(gcp_list) if gcp_list else (), target,
+                                         subset.get('altitude'), subset.get('camera', 'm3m'))
+            selected = selected[keep]
+
+        partitions.append({
+            'index': int(idx),
+            'cutline': parts[idx],
+            'buffered': buffered_poly.geometry.iloc[0],
+            'buffer_m': buffer_m[idx],
+            'photos': selected['url'].tolist(),
+            'gcp_list': gcp_list,
+            'checks': manifest_checks(selected),
+            'subset': report,
+        })
+
+    budget = params.get('odm_budget')
+    if budget is not None:
+        memory_mb = budget['memory_gb'] * 1024 if budget.get('memory_gb') else None
+        settings, _ = plan_settings({part['index']: len(part['photos']) for part in partitions}, budget['hours'] * 3600,
+                                    OdmCostModel().fit(history), budget['ortho_res'], budget.get('nodes'), memory_mb)
+        for part in partitions:
+            part['odm'] = settings[part['index']]
+    return partitions
+
+def partition_record(part, key=None):
+    # JSON-serializable form of a partition, geometries as WKT
+    return dict(part, cutline=part['cutline'].wkt, buffered=part['buffered'].wkt,
+                version=PLAN_VERSION, key=key, crs=crs_target.to_string())
+
+def partition_from_record(record):
+    if record.get('version') != PLAN_VERSION:
+        raise ValueError(f"Partition record has version {record.get('version')}, expected {PLAN_VERSION}")
+    return dict(record, cutline=wkt.loads(record['cutline']), buffered=wkt.loads(record['buffered']))
+
+def write_plan(partitions, key, params, out_dir='.'):
+    plan_dir = os.path.join(out_dir, key)
+    os.makedirs(plan_dir, exist_ok=True)
+
+    summary = []
+    for part in partitions:
+        record = partition_record(part, key)
+        with open(os.path.join(plan_dir, f"partition_{part['index']}.json"), 'w') as f:
+            json.dump(record, f)
+
+        n_gcps = 0 if part['gcp_list'] is None else len(part['gcp_list'].splitlines()) - 1
+        summary.append({'index': part['index'], 'n_photos': len(part['photos']), 'n_gcps': n_gcps,
+                        'buffer_m': part['buffer_m'], 'subset': part.get('subset'), 'odm': part.get('odm')})
+
+    with open(os.path.join(plan_dir, 'plan.json'), 'w') as f:
+        json.dump({'version': PLAN_VERSION, 'key': key, 'params': params, 'partitions': summary}, f, indent=4)
+    return plan_dir
+
+def load_partition(path):
+    with open(path) as f:
+        return partition_from_record(json.load(f))
+
+def fetch_partition(plan_uri, array_idx, dest_dir='.'):
+    # plan_uri may be a gs:// prefix, an https URL or a local directory
+    file = os.path.join(dest_dir, f'partition_{array_idx}.json')
+    source = f"{plan_uri.rstrip('/')}/partition_{array_idx}.json"
+    if plan_uri.startswith('gs://'):
+        copy_from_gcs(source, file)
+    elif plan_uri.startswith(('http://', 'https://')):
+        download_file(source, file)
+    else:
+        file = source
+    return load_partition(file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the survey partition once and write a job plan.')
+    parser.add_argument('config', help='config_file.json path or URL')
+    parser.add_argument('--out', default='.', help='directory the plan is written to')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--branch', default='main')
+    parser.add_argument('--upload', action='store_true', help='copy the plan to <output_bucket>/plans')
+    parser.add_argument('--size-report', type=int, nargs='+', metavar='N',
+                        help='print the predicted photos per node of a balanced partition into N parts instead of planning')
+    parser.add_argument('--history', nargs='*', default=[],
+                        help='metrics_*.jsonl files of earlier runs for the odm_budget cost model (globs are expanded)')
+    args = parser.parse_args()
+
+    config_url = os.path.abspath(args.config) if os.path.exists(args.config) else args.config
+    out_dir = os.path.abspath(args.out)
+    os.chdir(tempfile.mkdtemp())
+
+    config = load_config(config_url)
+
+    paths = fetch_inputs(config, args.branch)
+    params = plan_params(config, seed=args.seed)
+
+    if args.size_report:
+        poly, gcps_flight = load_geometry(paths)
+        gcp_xy = shapely.get_coordinates(gcps_flight.geometry.values) if params['gcp_buffer'] == 'exact' else None
+        for row in size_report(poly, manifest_xy(paths['photo_manifest']), args.size_report, gcp_xy,
+                               compactness=params['compactness'], seed=args.seed):
+            print(f"compute_array_sz {row['compute_array_sz']}: {row['max_photos']} max / {row['mean_photos']:.0f} mean / "
+                  f"{row['min_photos']} min photos per node, imbalance {row['imbalance']:.0%}, "
+                  f"buffer overhead {row['overhead']:.0%}")
+        raise SystemExit
+    key = plan_key(paths, params)
+    history = load_records(sorted(p for pattern in args.history for p in glob.glob(pattern)))
+    partitions = build_plan(paths, params, history=history)
+    plan_dir = write_plan(partitions, key, params, out_dir)
+
+    for part in partitions:
+        if part.get('subset'):
+            line = f"partition {part['index']}: {format_report(part['subset'])}"
+        else:
+            line = f"partition {part['index']}: {len(part['photos'])} photos"
+        if part.get('odm'):
+            options = part['odm']['options']
+            line += (f"; ODM {options['feature_quality']}, resize {options['resize_to'] or 'full'}, "
+                     f"fast-orthophoto {options['fast_orthophoto']}, predicted {part['odm']['predicted_s'] / 3600:.1f} h")
+        print(line)
+
+    if args.upload:
+        copy_to_gcs(plan_dir, config['output_bucket'] + '/plans')
+        print(f"gs://{config['output_bucket']}/plans/{key}")
+    else:
+        print(plan_dir)
@@ -1,12 +1,8 @@
 import subprocess
+import bootstrap
 
-subprocess.run(['pip3', 'install', '--upgrade', 'pip'], check=True)
-subprocess.run(['sudo', 'apt-get', 'install', 'gdal-bin', 'libgdal-dev', 'libspatialindex-dev'], check=True, input=b'y\n')
-
-packages = ['cython','pyproj','geopandas','pandas','numpy','shapely','fiona','rasterio','scipy', 'rtree','pygeos']
-
-for p in packages:
-  subprocess.check_call(['pip3', 'install', p])
+# installs only what is missing or outdated, from the local wheelhouse when there is one
+bootstrap.ensure_requirements()
 
 import os
 import shutil
@@ -14,15 +10,12 @@ import tempfile
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-from shapely.geometry import Point, Polygon, box, mapping
+from shapely.geometry import Polygon, box, mapping
 from pyproj import CRS
 import fiona
 import requests
 import json
-import rasterio
-from rasterio.mask import mask
-from rasterio.enums import Resampling
-from scipy.spatial import Voronoi
+from manifest_filter import select_urls
 
 fiona.drvsupport.supported_drivers['KML'] = 'rw'
 
@@ -65,6 +58,9 @@ def copy_to_gcs(local_file_path, bucket_name):
         print(e)
 
 def mask_to_gdf(gdf, raster_path, output_path):
+    import rasterio
+    from rasterio.mask import mask
+
     # Read the raster file
     src = rasterio.open(raster_path)
 
@@ -210,14 +206,11 @@ gcps.crs = crs_source
 flight_projected_src = flight_roi.to_crs(crs_target)
 gcps_projected_src = gcps.to_crs(crs_target)
 
-gcps_flight = gpd.sjoin(gcps_projected_src, flight_projected_src, how='inner', op='within')
+gcps_flight = gpd.sjoin(gcps_projected_src, flight_projected_src, how='inner', predicate='within')
 
 base_poly = gpd.read_file('job_polys.shp').set_crs(32611).to_crs(crs_target).loc[array_idx,'geometry']
 buffered_poly = base_poly.buffer(10)
-manifest_df = pd.read_csv(photo_manifest)
-manifest_df['geometry'] = manifest_df.apply(lambda row: Point(row['longitude'], row['latitude']), axis=1)
-manifest_gpd = gpd.GeoDataFrame(manifest_df, geometry='geometry', crs=crs_source).to_crs(crs_target)
-target_photos = gpd.sjoin(manifest_gpd, gpd.GeoDataFrame(geometry=[buffered_poly]), op='within')['url']
+target_photos = select_urls(photo_manifest, buffered_poly, crs=crs_target)
 
 log_progress(f'started_post_processing_{array_idx}.txt', log_bucket)
 
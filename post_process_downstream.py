@@ -1,153 +1,177 @@
 import subprocess
+import bootstrap
 
-subprocess.run(['pip3', 'install', '--upgrade', 'pip'], check=True)
-subprocess.run(['sudo', 'apt-get', 'install', 'gdal-bin', 'libgdal-dev', 'libspatialindex-dev'], check=True, input=b'y\n')
-
-packages = ['cython','pyproj','geopandas','pandas','numpy','shapely','fiona','rasterio','scipy', 'rtree','pygeos']
-
-for p in packages:
-  subprocess.check_call(['pip3', 'install', p])
+if __name__ == '__main__':
+    # installs only what is missing or outdated, from the local wheelhouse when there is one;
+    # importing this module (local_executor.py, the benchmarks) leaves the environment alone
+    bootstrap.ensure_requirements()
 
 import os
 import shutil
 import tempfile
 import geopandas as gpd
-import pandas as pd
-import numpy as np
-from shapely.geometry import Point, Polygon, box, mapping
-from pyproj import CRS
+from shapely.geometry import box, mapping
 import fiona
-import requests
 import json
-import rasterio
-from rasterio.mask import mask
-from rasterio.enums import Resampling
-from scipy.spatial import Voronoi
+from survey_utils import download_file, get_metadata, copy_to_gcs
+from downloader import download_batch
+from image_cache import ImageCache, fetch_images, preflight
+from plan_job import fetch_inputs, plan_params, build_plan, fetch_partition, crs_target, partition_record, partition_from_record
+from checkpoint import input_hash, NullCheckpointStore, LocalCheckpointStore, GCSCheckpointStore
+from metrics import MetricsRecorder, NullMetricsRecorder
+from odm_budget import DEFAULT_OPTIONS, odm_args
+from work_queue import open_queue, Heartbeat
+from uploader import Uploader, GCSBackend
 
 fiona.drvsupport.supported_drivers['KML'] = 'rw'
 
-def download_file(url, save_path):
-    response = requests.get(url)
-    if response.status_code == 200:
-        with open(save_path, 'wb') as file:
-            file.write(response.content)
-        print(f"File downloaded successfully and saved as '{save_path}'.")
-    else:
-        print(f"Error occurred while downloading file from '{url}'.")
-        
-def get_metadata(attribute):
-    curl_command = [
-        "curl",
-        "-H",
-        "Metadata-Flavor: Google",
-        f"http://metadata/computeMetadata/v1/instance/attributes/{attribute}"
-    ]
-    result = subprocess.run(curl_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    output = result.stdout.strip()
-    return output
-
-def expand_to_gcps(focal_poly, gcps, gcp_cutoff=5, step_sz=30, base_buffer=50):
-    focal_poly = focal_poly.buffer(base_buffer)
-    count = sum(gcps.within(focal_poly.geometry.iloc[0]))
-    
-    if count < gcp_cutoff:
-        while count < gcp_cutoff:
-            focal_poly = focal_poly.buffer(step_sz)
-            count = sum(gcps.within(focal_poly.geometry.iloc[0]))
-    
-    return focal_poly
-
-def load_kml(path):
-  df = gpd.GeoDataFrame()
-
-  # iterate over layers
-  for layer in fiona.listlayers(path):
-      s = gpd.read_file(path, driver='KML', layer=layer)
-      df = pd.concat([df, s], ignore_index=True)
-  return df
-
-def copy_to_gcs(local_file_path, bucket_name):
-    command = ['gsutil', 'cp', '-r', local_file_path, 'gs://{}/'.format(bucket_name)]
-    try:
-        subprocess.run(command, check=True)
-        print('File copied to Google Cloud Storage successfully.')
-    except subprocess.CalledProcessError as e:
-        print('Error occurred while copying the file to Google Cloud Storage:')
-        print(e)
-
 def mask_to_gdf(gdf, raster_path, output_path):
-    # Read the raster file
-    src = rasterio.open(raster_path)
-
-    # Reproject the GeoDataFrame to match the projection of the raster, if needed
-    gdf = gdf.to_crs(src.crs)
+    # In-memory variant, see ortho_mask.mask_to_cog for the windowed one used by process_images
+    import rasterio
+    from rasterio.mask import mask
 
-    # Mask the raster using the GeoDataFrame's geometry
-    out_image, out_transform = mask(src, gdf.geometry, crop=True)
-
-    # Update the metadata of the cropped raster
-    out_meta = src.meta.copy()
-    out_meta.update({
-        "driver": "GTiff",
-        "height": out_image.shape[1],
-        "width": out_image.shape[2],
-        "transform": out_transform,
-        "dtype": out_image.dtype,
-        "compress": src.compression.value if src.compression else "none"
-    })
+    # Read the raster file
+    with rasterio.open(raster_path) as src:
+        # Reproject the GeoDataFrame to match the projection of the raster, if needed
+        gdf = gdf.to_crs(src.crs)
+
+        # Mask the raster using the GeoDataFrame's geometry
+        out_image, out_transform = mask(src, gdf.geometry, crop=True)
+
+        # Update the metadata of the cropped raster
+        out_meta = src.meta.copy()
+        out_meta.update({
+            "driver": "GTiff",
+            "height": out_image.shape[1],
+            "width": out_image.shape[2],
+            "transform": out_transform,
+            "dtype": out_image.dtype,
+            "compress": src.compression.value if src.compression else "none"
+        })
 
     # Save the cropped raster to a new file
     with rasterio.open(output_path, 'w', **out_meta) as dst:
         # Use the original raster's block size and resampling method for better compression
         dst.write(out_image)
 
-def process_images(batch, output_bucket, ortho_res, cutline, suffix, gcp_list_path):
-   # Create a temporary directory
-    temp_dir = tempfile.mkdtemp()
+def run_odm_docker(project_dir, odm_flags, docker_options=()):
+    # ODM in its docker image on `project_dir`; docker_options (e.g. --cpuset-cpus) go to `docker run`
+    docker_command = [
+        "sudo", "docker", "run", "--rm", *docker_options,
+        "-v", "{}:/datasets/code".format(project_dir),
+        "opendronemap/odm", "--project-path", "/datasets",
+    ] + list(odm_flags)
+    subprocess.run(docker_command, check=True)
+
+def process_images(batch, output_bucket, ortho_res, cutline, suffix, gcp_list_path, checks=None,
+                   project_dir=None, checkpoints=None, metrics=None, uploader=None, cog_options=None,
+                   odm_options=None, cache=None, odm_runner=None, download_pool=None, num_threads='ALL_CPUS'):
+    # With a fixed project_dir and a checkpoint store a restarted worker skips the
+    # stages it already finished and reuses its downloaded images and ODM outputs.
+    # With an uploader the results upload in the background: the returned futures
+    # finish once they are in the bucket. odm_options (see odm_budget.LADDER) pick the
+    # feature quality, resize and fast-orthophoto settings; the defaults are the full-quality run.
+    # With an image cache (see image_cache.py) images/ is filled with hardlinks to cached photos.
+    # odm_runner(project_dir, odm_flags) replaces run_odm_docker (local_executor.py passes one
+    # pinned to a CPU set, or a stub) and download_pool is a thread pool shared with other partitions;
+    # num_threads caps the COG compression threads, e.g. at a slot's cores
+    checkpoints = checkpoints or NullCheckpointStore()
+    metrics = metrics or NullMetricsRecorder()
+    key = input_hash(sorted(batch), checks, ortho_res, suffix, odm_options)
+
+    # Create a temporary directory
+    temp_dir = project_dir or tempfile.mkdtemp()
 
     # Create an 'images' subdirectory
     images_dir = os.path.join(temp_dir, 'images')
-    os.mkdir(images_dir)
+    os.makedirs(images_dir, exist_ok=True)
 
     if gcp_list_path is not None:
-        shutil.move(gcp_list_path, temp_dir)
-
-    for url in batch:
-        try:
-            subprocess.run(['wget', '-P', images_dir, url], check=True)
-            print(f"File downloaded successfully from {url}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error occurred while downloading file from {url}:")
-            print(e)
-
-    # Execute OpenDroneMap Docker command
-    docker_command = [
-        "sudo", "docker", "run", "--rm",
-        "-v", "{}:/datasets/code".format(temp_dir),
-        "opendronemap/odm", "--project-path", "/datasets",
-        "--orthophoto-resolution", f"{ortho_res}",
-        "--feature-quality", "ultra",
-        #"--fast-orthophoto",
-        "--force-gps"
-    ]
-
-    process = subprocess.run(docker_command, check=True)
+        shutil.move(gcp_list_path, os.path.join(temp_dir, os.path.basename(gcp_list_path)))
+
+    if checkpoints.get('download', key) is None:
+        with metrics.stage('download', photos=len(batch), since_start_s=bootstrap.elapsed(),
+                           since_boot_s=bootstrap.since_boot()) as record:
+            if cache is None:
+                summary = download_batch(batch, images_dir, checks=checks, pool=download_pool)
+            else:
+                summary = fetch_images(batch, images_dir, cache, checks=checks, pool=download_pool)
+                record.update({k: summary[k] for k in ['cache_hits', 'cache_hit_ratio', 'bytes_saved']})
+            record.update(bytes=summary['bytes'], failed=len(summary['failed']), mb_per_s=summary['mb_per_s'])
+        if not summary['failed']:
+            checkpoints.put('download', key, {'files': summary['files'], 'bytes': summary['bytes']})
+
+    if checkpoints.get('odm', key) is None:
+        # fail before ODM rather than when its outputs fill the disk hours in
+        preflight(temp_dir, sum(e.stat().st_size for e in os.scandir(images_dir)), cache)
+        # ODM skips its own stages whose outputs are already in the project directory
+        # (its memory is not in the recorded peak RSS: the container runs under dockerd,
+        # but peak_host_mem_mb covers it). odm_budget.py fits its cost model to these records
+        with metrics.stage('odm', photos=len(os.listdir(images_dir)), ortho_res=ortho_res,
+                           **dict(DEFAULT_OPTIONS, **(odm_options or {}))):
+            (odm_runner or run_odm_docker)(temp_dir, odm_args(odm_options, ortho_res))
+        checkpoints.put('odm', key)
     
     ortho = os.path.join(temp_dir,'odm_orthophoto/odm_orthophoto.tif')
     report = os.path.join(temp_dir,'odm_report/report.pdf')
     ortho_new = ortho.replace('.tif',f'_{suffix}.tif')
     report_new = report.replace('.pdf',f'_{suffix}.pdf')
+    if os.path.exists(report):
+        os.replace(report, report_new)
+
+    uploads = []
+    uploaded = checkpoints.get('upload', key) is not None
+    if uploader is not None and not uploaded and os.path.exists(report_new):
+        # the report is final once ODM is done, so it uploads while the mask is computed
+        uploads.append(uploader.submit(report_new, output_bucket))
     
-    mask_to_gdf(cutline, ortho, ortho_new)
-    os.rename(report, report_new)
+    if checkpoints.get('mask', key) is None:
+        from ortho_mask import mask_to_cog # rasterio is only imported once a node gets this far
+
+        # cog_options (block_size, compress, predictor, overview_resampling) come from the config's 'cog' entry
+        with metrics.stage('mask', input_bytes=os.path.getsize(ortho)) as record:
+            # the report compares the COG with the same cropped, masked raster before publishing
+            report = mask_to_cog(cutline, ortho, ortho_new, num_threads=num_threads, report=True, **(cog_options or {}))
+            record['bytes'] = os.path.getsize(ortho_new)
+            record.update({k: report[k] for k in ['size_ratio', 'zoom_in_gain', 'zoom_out_gain']})
+        checkpoints.put('mask', key)
 
     focal_files = [ortho_new, report_new]
     
-    for f in focal_files:
-        copy_to_gcs(f, output_bucket)
+    if not uploaded and uploader is None:
+        with metrics.stage('upload', files=len(focal_files)) as record:
+            for f in focal_files:
+                copy_to_gcs(f, output_bucket)
+            record['bytes'] = sum(os.path.getsize(f) for f in focal_files if os.path.exists(f))
+        checkpoints.put('upload', key)
+    elif not uploaded:
+        uploads.append(uploader.submit(ortho_new, output_bucket))
+        for future in uploads:
+            future.add_done_callback(lambda f: record_upload(metrics, suffix, f))
+        uploader.when_done(uploads, lambda: checkpoints.put('upload', key))
     
     # Cleanup: Remove temporary directory
-    shutil.rmtree(temp_dir)
+    if project_dir is None and uploader is None:
+        shutil.rmtree(temp_dir)
+    elif project_dir is None:
+        cleanup = lambda *_: shutil.rmtree(temp_dir)
+        uploader.when_done(uploads, cleanup, cleanup)
+    return uploads
+
+def record_upload(metrics, array_idx, future):
+    # metrics record of one background upload
+    if future.exception() is not None:
+        metrics.record('upload', array_idx=array_idx, status='error', error=repr(future.exception()))
+        return
+    result = future.result()
+    metrics.record('upload', array_idx=array_idx, wall_s=result['seconds'], bytes=result['bytes'],
+                   files=1, skipped=result['skipped'])
+
+def partition_counts(partition):
+    # item counts recorded with the partitioning stage; the GCP list has a CRS header line
+    gcp_lines = partition['gcp_list'].splitlines() if partition['gcp_list'] else []
+    return {'photos': len(partition['photos']), 'gcps': max(len(gcp_lines) - 1, 0),
+            'buffer_m': partition['buffer_m']}
 
 def stop_instance(instance_name):
     # Construct the gsutil command to stop the instance
@@ -161,268 +185,148 @@ def stop_instance(instance_name):
         print(f'Error stopping instance: {instance_name}')
         print(e)
 
-def voronoi_finite_polygons_2d(vor, radius=None):
-    """
-    Reconstruct infinite voronoi regions in a 2D diagram to finite
-    regions.
-
-    Source: https://gist.github.com/pv/8036995
-    """
-
-    if vor.points.shape[1] != 2:
-        raise ValueError("Requires 2D input")
-
-    new_regions = []
-    new_vertices = vor.vertices.tolist()
-
-    center = vor.points.mean(axis=0)
-    if radius is None:
-        radius = vor.points.ptp().max()*2
-
-    # Construct a map containing all ridges for a given point
-    all_ridges = {}
-    for (p1, p2), (v1, v2) in zip(vor.ridge_points, vor.ridge_vertices):
-        all_ridges.setdefault(p1, []).append((p2, v1, v2))
-        all_ridges.setdefault(p2, []).append((p1, v1, v2))
-
-    # Reconstruct infinite regions
-    for p1, region in enumerate(vor.point_region):
-        vertices = vor.regions[region]
-
-        if all(v >= 0 for v in vertices):
-            # finite region
-            new_regions.append(vertices)
-            continue
-
-        # reconstruct a non-finite region
-        ridges = all_ridges[p1]
-        new_region = [v for v in vertices if v >= 0]
-
-        for p2, v1, v2 in ridges:
-            if v2 < 0:
-                v1, v2 = v2, v1
-            if v1 >= 0:
-                # finite ridge: already in the region
+def run_partition(array_idx, config, plan_uri, work_root, metrics, branch='main', uploader=None,
+                  plan_checkpoints=None, odm_runner=None, download_pool=None, num_threads='ALL_CPUS'):
+    # A fixed work directory on the boot disk (rather than mkdtemp) survives preemption,
+    # so a restarted worker finds its checkpoints, images and ODM outputs again.
+    # Paths are absolute so several partitions can run side by side in one process
+    temp_work = os.path.join(os.path.abspath(work_root), f'array_{array_idx}')
+    os.makedirs(temp_work, exist_ok=True)
+
+    log_bucket = config['output_bucket'] + '/logs'
+
+    # Local records cover the stages tied to this disk (images, ODM outputs); the
+    # partition record is also kept in the log bucket so a replacement disk can reuse it
+    checkpoints = LocalCheckpointStore(os.path.join(temp_work, 'checkpoints'))
+    if plan_checkpoints is None:
+        plan_checkpoints = GCSCheckpointStore(log_bucket + '/checkpoints', os.path.join(temp_work, 'checkpoints'))
+    partition_key = input_hash(config, plan_uri, array_idx)
+    record = plan_checkpoints.get('partition', partition_key)
+
+    if record is not None:
+        partition = partition_from_record(record['partition'])
+    elif plan_uri:
+        # just fetch this node's slice of the published plan
+        with metrics.stage('fetch_partition') as stage:
+            partition = fetch_partition(plan_uri, array_idx, temp_work)
+            stage.update(partition_counts(partition))
+    else:
+        with metrics.stage('fetch_inputs'):
+            paths = fetch_inputs(config, branch, temp_work)
+        # partitioning, GCP buffering and the manifest filter run together in build_plan
+        with metrics.stage('partition') as stage:
+            partition = build_plan(paths, plan_params(config), indices=[array_idx])[0]
+            stage.update(partition_counts(partition))
+
+    if record is None:
+        plan_checkpoints.put('partition', partition_key, {'partition': partition_record(partition)})
+
+    base_poly = gpd.GeoDataFrame(geometry=[partition['cutline']], crs=crs_target)
+    target_photos = partition['photos']
+
+    if partition['gcp_list'] is not None:
+        gcp_list = os.path.join(temp_work, os.path.basename(config['gcp_editor_url']))
+        with open(gcp_list, 'w') as f:
+            f.write(partition['gcp_list'])
+    else:
+        gcp_list = None
+
+    # outside temp_work, so cached photos outlive the partition for its neighbours and reruns
+    cache_config = config.get('image_cache') or {}
+    max_gb = cache_config.get('max_gb')
+    cache = ImageCache(cache_config.get('path', os.path.join(work_root, 'image_cache')),
+                       None if max_gb is None else int(max_gb * 1e9))
+
+    uploads = []
+    finished = plan_checkpoints.get('finished', partition_key) is not None
+    if not finished:
+        uploads = process_images(batch=target_photos, output_bucket=config['output_bucket'],
+                        ortho_res=config['survey_res'], cutline=base_poly ,suffix=array_idx,
+                        gcp_list_path=gcp_list, checks=partition.get('checks'),
+                        project_dir=os.path.join(temp_work, 'project'), checkpoints=checkpoints,
+                        metrics=metrics, uploader=uploader, cog_options=config.get('cog'),
+                        odm_options=(partition.get('odm') or {}).get('options'), cache=cache,
+                        odm_runner=odm_runner, download_pool=download_pool, num_threads=num_threads)
+
+    def finish():
+        # only once the results are in the bucket; a failed upload leaves the work directory for a rerun
+        if not finished:
+            plan_checkpoints.put('finished', partition_key)
+        shutil.rmtree(temp_work)
+
+    if uploader is None:
+        finish()
+    else:
+        uploader.when_done(uploads, finish)
+    return uploads
+
+if __name__ == '__main__':
+    branch = 'main'
+    # survey = '230601_spurgepoly'
+    # array_idx = 0
+    # config_url = f'https://raw.githubusercontent.com/samsoe/mpg_aerial_survey/{branch}/surveys/{survey}/config_file.json'
+
+    array_idx = int(get_metadata('array_idx')) #dynamic production version
+    config_url = get_metadata('config_url')#dynamic production version
+    instance_name = f'odm-array-{array_idx}' #name of instance inferred from index
+    queue_uri = get_metadata('queue_uri') # set to pull partitions from a work queue (see work_queue.py)
+
+    work_root = '/var/tmp/mpg_aerial_survey'
+    os.makedirs(work_root, exist_ok=True)
+    os.chdir(work_root)
+
+    # One JSON line per stage; the config stage is recorded once the log bucket is known
+    metrics_file = f'metrics_{array_idx}.jsonl'
+    metrics = MetricsRecorder(os.path.join(work_root, metrics_file), array_idx=array_idx, node=instance_name)
+
+    with metrics.stage('config'):
+        config_file = os.path.basename(config_url)
+        download_file(config_url, config_file)
+
+        with open(config_file, 'r') as json_file:
+            # Load the JSON data into a Python object
+            config = json.load(json_file)
+
+    log_bucket = config['output_bucket'] + '/logs'
+    plan_uri = get_metadata('plan_uri') # set when the partition was computed once by plan_job.py
+
+    # results and logs upload in the background while the next stage runs
+    uploader = Uploader(GCSBackend())
+
+    # the metrics file replaces the per-stage marker files in the log bucket
+    metrics.on_record = lambda path: uploader.submit(path, log_bucket)
+    metrics.on_record(metrics.path)
+
+    if queue_uri:
+        # lease partitions until the queue is drained; a preempted node's lease
+        # expires and its partition goes to whichever node asks next
+        queue = open_queue(queue_uri)
+        while (task := queue.lease(instance_name)) is not None:
+            task_idx = task['payload']['array_idx']
+            metrics.context['array_idx'] = task_idx
+            beat = Heartbeat(queue, task['task_id'], instance_name)
+            beat.start()
+            try:
+                uploads = run_partition(task_idx, config, task['payload'].get('plan_uri') or plan_uri,
+                                        work_root, metrics, branch, uploader)
+            except Exception as e:
+                print(f'Partition {task_idx} failed: {e!r}')
+                beat.stop()
+                queue.fail(task['task_id'], instance_name, repr(e))
                 continue
 
-            # Compute the missing endpoint of an infinite ridge
-
-            t = vor.points[p2] - vor.points[p1] # tangent
-            t /= np.linalg.norm(t)
-            n = np.array([-t[1], t[0]])  # normal
-
-            midpoint = vor.points[[p1, p2]].mean(axis=0)
-            direction = np.sign(np.dot(midpoint - center, n)) * n
-            far_point = vor.vertices[v2] + direction * radius
+            # the lease is held until the results are uploaded, while the next partition starts
+            def complete(task=task, beat=beat):
+                beat.stop()
+                queue.complete(task['task_id'], instance_name)
 
-            new_region.append(len(new_vertices))
-            new_vertices.append(far_point.tolist())
+            def fail(error, task=task, beat=beat):
+                beat.stop()
+                queue.fail(task['task_id'], instance_name, repr(error))
 
-        # sort region counterclockwise
-        vs = np.asarray([new_vertices[v] for v in new_region])
-        c = vs.mean(axis=0)
-        angles = np.arctan2(vs[:,1] - c[1], vs[:,0] - c[0])
-        new_region = np.array(new_region)[np.argsort(angles)]
-
-        # finish
-        new_regions.append(new_region.tolist())
-
-    return new_regions, np.asarray(new_vertices)
-
-def generate_points(poly, num, seed=None):
-    np.random.seed(seed)
-    points = []
-    minx, miny, maxx, maxy = poly.bounds
-    while len(points) < num:
-        random_point = Point(np.random.uniform(minx, maxx), np.random.uniform(miny, maxy))
-        if (random_point.within(poly)):
-            points.append(random_point)
-    return [point.coords[0] for point in points]
-
-def calculate_voronoi_complexity(poly, points):
-    # compute Voronoi tesselation
-    vor = Voronoi(points)
-    
-    # create finite Voronoi polygons
-    regions, vertices = voronoi_finite_polygons_2d(vor)
-    
-    # construct the polygons and intersect with the original one
-    voronoi_polygons = [poly.intersection(Polygon(vertices[region])) for region in regions]
-    
-    # return only the valid ones (completely inside the original polygon)
-    valid_polygons = [p for p in voronoi_polygons if p.is_valid]
-
-    # calculate the perimeter and areas of each valid polygon
-    perimeters = [p.length for p in valid_polygons]
-    areas = [p.area for p in valid_polygons]
-    complexity = [x / y for x, y in zip(perimeters, areas)]
-    
-    return complexity, valid_polygons
-
-def optimize_voronoi_complexity(poly, num, max_iterations=1000, learning_rate=0.1, seed=None):
-    points = generate_points(poly, num, seed)
-    np.random.seed(seed)
-    mns = [] # to store complexity means at each iteration
-    
-    for i in range(max_iterations):
-        complexity, polygons = calculate_voronoi_complexity(poly, points)
-        mn = np.mean(complexity)
-        mns.append(mn) # append current std dev to the list
-
-        # randomly select a point
-        point_idx = np.random.randint(0, len(points))
-        current_point = Point(points[point_idx])
-        
-        # Compute gradients by trying small movements in each direction
-        min_mn = mn
-        min_mn_direction = None
-        for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-            new_point = Point(current_point.x + dx * learning_rate, current_point.y + dy * learning_rate)
-            new_points = points.copy()
-            new_points[point_idx] = (new_point.x, new_point.y)
-            
-            new_complexity, _ = calculate_voronoi_complexity(poly, new_points)
-            new_mn = np.mean(new_complexity)
-            
-            if new_mn < min_mn:
-                min_mn = new_mn
-                min_mn_direction = (dx, dy)
-        
-        # If we found a direction that decreases the mean complexity, move the point
-        if min_mn_direction is not None:
-            dx, dy = min_mn_direction
-            points[point_idx] = (current_point.x + dx * learning_rate, current_point.y + dy * learning_rate)
-    
-    return polygons, mns
-
-def log_progress(file, bucket):
-    with open(file, 'w') as f:
-        f.write('done')
-    copy_to_gcs(file, bucket)
-
-def filter_gcp_list(file_path, polygon_gdf, output_file_path):
-    # Check that the polygon_gdf contains a single geometry
-    if len(polygon_gdf) != 1 or not isinstance(polygon_gdf.geometry.iloc[0], Polygon):
-        raise ValueError('polygon_gdf must contain a single Polygon geometry')
-
-    # Extract the Polygon object
-    polygon = polygon_gdf.geometry.iloc[0]
-
-    # Read header and data
-    with open(file_path, 'r') as file:
-        header = file.readline().strip()
-
-    # Assuming the header contains the EPSG code in a format like "EPSG:XXXX"
-    epsg_code = header.split(":")[-1]
-
-    # Read data skipping the header
-    data = pd.read_csv(file_path, delimiter='\t', skiprows=1, header=None)
-
-    # Create a GeoDataFrame
-    geometry = [Point(xy) for xy in zip(data[0], data[1])]
-    geo_data = gpd.GeoDataFrame(data, geometry=geometry, crs=f'EPSG:{epsg_code}')
-
-    # Filter points within the polygon
-    mask = geo_data.within(polygon)
-    filtered_geo_data = geo_data[mask]
-
-    # Convert back to DataFrame
-    filtered_data = pd.DataFrame(filtered_geo_data)
-    filtered_data.drop(columns='geometry', inplace=True)
-
-    # Write the data to a new file
-    with open(output_file_path, 'w') as file:
-        file.write(header + '\n')
-
-    filtered_data.to_csv(output_file_path, sep='\t', header=False, index=False, mode='a')
-
-temp_work = tempfile.mkdtemp()
-os.chdir(temp_work)
-
-branch = 'main'
-# survey = '230601_spurgepoly'
-# array_idx = 0
-# config_url = f'https://raw.githubusercontent.com/samsoe/mpg_aerial_survey/{branch}/surveys/{survey}/config_file.json'
-
-array_idx = int(get_metadata('array_idx')) #dynamic production version
-config_url = get_metadata('config_url')#dynamic production version
-instance_name = f'odm-array-{array_idx}' #name of instance inferred from index
-
-config_file = os.path.basename(config_url)
-download_file(config_url, config_file)
-
-with open(config_file, 'r') as json_file:
-    # Load the JSON data into a Python object
-    config = json.load(json_file)
-
-gcp_res = str(config['gcp_res'])
-gcp_grid_url = f'https://raw.githubusercontent.com/samsoe/mpg_aerial_survey/{branch}/gcp_kmls/upland_gcps_{gcp_res}m.kml'
-
-survey_res = config['survey_res']
-compute_array_sz = config['compute_array_sz']
-flight_plan_url = config['flight_plan_url']
-photo_manifest_url = config['photo_manifest_url']
-output_bucket =  config['output_bucket']
-gcp_editor_url = config['gcp_editor_url']
-log_bucket = output_bucket + '/logs'
-
-log_progress(f'loaded_config_{array_idx}.txt', log_bucket)
-
-gcp_grid = os.path.basename(gcp_grid_url)
-flight_plan = os.path.basename(flight_plan_url)
-photo_manifest = os.path.basename(photo_manifest_url)
-
-download_file(gcp_grid_url, gcp_grid)
-download_file(flight_plan_url, flight_plan)
-download_file(photo_manifest_url, photo_manifest)
-
-if gcp_editor_url is not None:
-    gcp_list = os.path.basename(gcp_editor_url)
-    gcp_list_init = os.path.basename(gcp_list.replace('.txt','_init.txt'))
-    download_file(gcp_editor_url, gcp_list_init)
-else:
-    gcp_list = None
-
-log_progress(f'downloaded_supporting_dat_{array_idx}.txt', log_bucket)
-
-flight_roi = load_kml(flight_plan)
-gcps = load_kml(gcp_grid)
-
-crs_source = CRS.from_epsg(4326)
-crs_target = CRS.from_epsg(26911)
-
-# Set the source CRS of the GeoDataFrame
-flight_roi.crs = crs_source
-gcps.crs = crs_source
-
-# Reproject the GeoDataFrame to the target CRS
-flight_projected_src = flight_roi.to_crs(crs_target)
-gcps_projected_src = gcps.to_crs(crs_target)
-
-gcps_flight = gpd.sjoin(gcps_projected_src, flight_projected_src, how='inner', op='within')
-
-parts, means = optimize_voronoi_complexity(flight_projected_src.geometry[0], compute_array_sz, 
-                                         learning_rate=30, max_iterations=1000, seed=0)
-
-log_progress(f'partitioned_area_{array_idx}.txt', log_bucket)
-
-base_poly = gpd.GeoDataFrame(geometry=[parts[array_idx]], crs = 26911)
-buffered_poly = expand_to_gcps(base_poly, gcps_flight, step_sz=30)
-manifest_df = pd.read_csv(photo_manifest)
-manifest_df['geometry'] = manifest_df.apply(lambda row: Point(row['longitude'], row['latitude']), axis=1)
-manifest_gpd = gpd.GeoDataFrame(manifest_df, geometry='geometry', crs=crs_source).to_crs(crs_target)
-target_photos = gpd.sjoin(manifest_gpd, gpd.GeoDataFrame(geometry=buffered_poly), op='within')['url']
-
-if gcp_editor_url is not None:
-    filter_gcp_list(gcp_list_init, buffered_poly.to_crs(crs_source), gcp_list)
-    os.remove(gcp_list_init)
-
-log_progress(f'started_post_processing_{array_idx}.txt', log_bucket)
-
-process_images(batch=target_photos, output_bucket=output_bucket,
-                ortho_res=survey_res, cutline=base_poly ,suffix=array_idx,
-                gcp_list_path=gcp_list)
+            uploader.when_done(uploads, complete, fail)
+    else:
+        run_partition(array_idx, config, plan_uri, work_root, metrics, branch, uploader)
 
-log_progress(f'stopping_{array_idx}.txt', log_bucket)
-shutil.rmtree(temp_work)
-stop_instance(instance_name)
\ No newline at end of file
+    uploader.close()
+    stop_instance(instance_name)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import subprocess
+import geopandas as gpd
+import pandas as pd
+import fiona
+import numpy as np
+import requests
+from shapely.geometry import Point, Polygon
+
+fiona.drvsupport.supported_drivers['KML'] = 'rw'
+
+def download_file(url, save_path):
+    response = requests.get(url)
+    if response.status_code == 200:
+        with open(save_path, 'wb') as file:
+            file.write(response.content)
+        print(f"File downloaded successfully and saved as '{save_path}'.")
+    else:
+        print(f"Error occurred while downloading file from '{url}'.")
+
+def get_metadata(attribute):
+    curl_command = [
+        "curl",
+        "-f", # empty output instead of an error page for unset attributes
+        "-H",
+        "Metadata-Flavor: Google",
+        f"http://metadata/computeMetadata/v1/instance/attributes/{attribute}"
+    ]
+    result = subprocess.run(curl_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    output = result.stdout.strip()
+    return output
+
+def expand_to_gcps(focal_poly, gcps, gcp_cutoff=5, step_sz=30, base_buffer=50):
+    focal_poly = focal_poly.buffer(base_buffer)
+    count = sum(gcps.within(focal_poly.geometry.iloc[0]))
+    
+    if count < gcp_cutoff:
+        while count < gcp_cutoff:
+            focal_poly = focal_poly.buffer(step_sz)
+            count = sum(gcps.within(focal_poly.geometry.iloc[0]))
+    
+    return focal_poly
+
+def expand_to_gcps_exact(focal_poly, gcps, gcp_cutoff=5, base_buffer=50, quad_segs=16):
+    """
+    Closed-form alternative to expand_to_gcps: buffers `focal_poly` (a
+    one-row GeoDataFrame) by the smallest distance >= `base_buffer` that
+    puts `gcp_cutoff` GCPs within it, instead of growing it in `step_sz`
+    increments. The GCP grid's spatial index narrows the search to the
+    nearest candidates. Returns the buffered polygon and the distance used.
+    """
+    if len(gcps) < gcp_cutoff:
+        raise ValueError(f'Only {len(gcps)} GCPs available, {gcp_cutoff} required')
+
+    poly = focal_poly.geometry.iloc[0]
+    tree = gcps.sindex
+
+    # widen the search radius until at least gcp_cutoff candidates are found
+    radius = max(base_buffer, 1.0)
+    candidates = tree.query(poly, predicate='dwithin', distance=radius)
+    while len(candidates) < gcp_cutoff:
+        radius *= 2
+        candidates = tree.query(poly, predicate='dwithin', distance=radius)
+
+    distances = np.sort(gcps.geometry.iloc[candidates].distance(poly).to_numpy())
+    # buffers approximate arcs with chords, so pad the k-th distance by the
+    # worst-case chord error to keep that GCP strictly inside
+    distance = max(base_buffer, distances[gcp_cutoff - 1] / np.cos(np.pi / (4 * quad_segs)) + 1e-6)
+
+    # counting among the candidates is enough: any other GCP only adds to the count
+    nearest = gcps.geometry.iloc[candidates]
+    buffered = focal_poly.buffer(distance, quad_segs=quad_segs)
+    while sum(nearest.within(buffered.geometry.iloc[0])) < gcp_cutoff:
+        distance += 1e-3 * distance
+        buffered = focal_poly.buffer(distance, quad_segs=quad_segs)
+    return buffered, distance
+
+def load_kml(path):
+    # every layer of the KML in one GeoDataFrame; single-layer files are returned as read
+    layers = [gpd.read_file(path, driver='KML', layer=layer) for layer in fiona.listlayers(path)]
+    if len(layers) == 1:
+        return layers[0]
+    if not layers:
+        return gpd.GeoDataFrame()
+    # one concat of all layers instead of growing the frame layer by layer
+    return gpd.GeoDataFrame(pd.concat(layers, ignore_index=True), crs=layers[0].crs)
+
+def copy_to_gcs(local_file_path, bucket_name):
+    command = ['gsutil', 'cp', '-r', local_file_path, 'gs://{}/'.format(bucket_name)]
+    try:
+        subprocess.run(command, check=True)
+        print('File copied to Google Cloud Storage successfully.')
+    except subprocess.CalledProcessError as e:
+        print('Error occurred while copying the file to Google Cloud Storage:')
+        print(e)
+
+def copy_from_gcs(gcs_uri, local_path):
+    command = ['gsutil', 'cp', gcs_uri, local_path]
+    subprocess.run(command, check=True)
+
+def log_progress(file, bucket):
+    with open(file, 'w') as f:
+        f.write('done')
+    copy_to_gcs(file, bucket)
+
+def filter_gcp_list(file_path, polygon_gdf, output_file_path):
+    # Check that the polygon_gdf contains a single geometry
+    if len(polygon_gdf) != 1 or not isinstance(polygon_gdf.geometry.iloc[0], Polygon):
+        raise ValueError('polygon_gdf must contain a single Polygon geometry')
+
+    # Extract the Polygon object
+    polygon = polygon_gdf.geometry.iloc[0]
+
+    # Read header and data
+    with open(file_path, 'r') as file:
+        header = file.readline().strip()
+
+    # Assuming the header contains the EPSG code in a format like "EPSG:XXXX"
+    epsg_code = header.split(":")[-1]
+
+    # Read data skipping the header
+    data = pd.read_csv(file_path, delimiter='\t', skiprows=1, header=None)
+
+    # Create a GeoDataFrame
+    geometry = [Point(xy) for xy in zip(data[0], data[1])]
+    geo_data = gpd.GeoDataFrame(data, geometry=geometry, crs=f'EPSG:{epsg_code}')
+
+    # Filter points within the polygon
+    mask = geo_data.within(polygon)
+    filtered_geo_data = geo_data[mask]
+
+    # Convert back to DataFrame
+    filtered_data = pd.DataFrame(filtered_geo_data)
+    filtered_data.drop(columns='geometry', inplace=True)
+
+    # Write the data to a new file
+    with open(output_file_path, 'w') as file:
+        file.write(header + '\n')
+
+    filtered_data.to_csv(output_file_path, sep='\t', header=False, index=False, mode='a')
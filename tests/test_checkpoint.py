@@ -0,0 +1,75 @@
+import json
+import os
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+from checkpoint import LocalCheckpointStore, input_hash
+from local_executor import StubOdm
+from metrics import MetricsRecorder
+from plan_job import crs_target
+from post_process_downstream import process_images
+from uploader import Uploader, LocalBackend
+
+def test_put_get_round_trip(tmp_path):
+    store = LocalCheckpointStore(str(tmp_path / 'checkpoints'))
+    assert store.get('download', 'abc') is None
+
+    path = store.put('download', 'abc', {'files': 3, 'bytes': 1024})
+    assert store.get('download', 'abc') == json.load(open(path))
+    record = store.get('download', 'abc')
+    assert record['files'] == 3 and record['bytes'] == 1024
+    assert record['stage'] == 'download' and record['key'] == 'abc' and 'completed_at' in record
+    assert store.get('download', 'other') is None and store.get('odm', 'abc') is None
+    assert not any(name.endswith('.tmp') for name in os.listdir(tmp_path / 'checkpoints'))
+
+    # a new store on the same directory (a restarted worker) sees the record
+    assert LocalCheckpointStore(str(tmp_path / 'checkpoints')).get('download', 'abc') == record
+
+def test_input_hash_is_stable():
+    assert input_hash(['b', 'a'], {'x': 1, 'y': 2}) == input_hash(['b', 'a'], {'y': 2, 'x': 1})
+    assert input_hash(['a', 'b']) != input_hash(['b', 'a'])
+
+def test_resumed_run_skips_finished_stages(tmp_path):
+    bounds = (0, 0, 64, 64)
+    cutline = gpd.GeoDataFrame(geometry=[box(8, 8, 56, 56)], crs=crs_target)
+    batch = ['https://example.com/DJI_0001.JPG', 'https://example.com/DJI_0002.JPG']
+    project_dir = str(tmp_path / 'project')
+    checkpoints = LocalCheckpointStore(str(tmp_path / 'checkpoints'))
+    metrics = MetricsRecorder(str(tmp_path / 'metrics_0.jsonl'), array_idx=0)
+    # the photos were downloaded before the preemption
+    checkpoints.put('download', input_hash(sorted(batch), None, 1.0, 0, None))
+
+    def run(odm, **cog_options):
+        uploader = Uploader(LocalBackend(str(tmp_path / 'bucket')))
+        try:
+            process_images(batch, 'out', 1.0, cutline, 0, None, project_dir=project_dir, checkpoints=checkpoints,
+                           metrics=metrics, uploader=uploader, cog_options=cog_options, odm_runner=odm)
+        finally:
+            uploader.close()
+
+    def stages():
+        with open(metrics.path) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(metrics.path)
+        return [(r['stage'], r['status']) for r in records]
+
+    # preempted (here: a bad COG option) after ODM finished
+    first = StubOdm(bounds, resolution=0.5)
+    with pytest.raises(TypeError):
+        run(first, no_such_option=True)
+    assert len(first.calls) == 1
+    assert ('odm', 'ok') in stages()
+
+    # the rerun goes straight to the mask and uploads
+    second = StubOdm(bounds, resolution=0.5)
+    run(second)
+    assert second.calls == []
+    assert [stage for stage, _ in stages()] == ['mask', 'upload', 'upload']
+    assert os.path.exists(tmp_path / 'bucket' / 'out' / 'odm_orthophoto_0.tif')
+
+    # and once everything is done, nothing runs again
+    third = StubOdm(bounds, resolution=0.5)
+    run(third)
+    assert third.calls == [] and not os.path.exists(metrics.path)
@@ -0,0 +1,96 @@
+import functools
+import http.server
+import json
+import os
+import threading
+
+import ortho_mask
+import pytest
+from shapely.geometry import box
+
+from checkpoint import LocalCheckpointStore
+from local_executor import run_local, slot_resources
+from plan_job import write_plan
+from uploader import Uploader, LocalBackend
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def photo_server(tmp_path):
+    # serves tmp_path/photos over HTTP, as the bucket serves the survey photos
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    handler = functools.partial(QuietHandler, directory=str(photos))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield photos, f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+def write_stub_plan(tmp_path, photos, url, sizes):
+    partitions = []
+    for idx, n in enumerate(sizes):
+        urls = []
+        for j in range(n):
+            name = f'DJI_{idx}_{j:04d}.JPG'
+            (photos / name).write_bytes(os.urandom(1024))
+            urls.append(f'{url}/{name}')
+        cutline = box(idx * 100, 0, idx * 100 + 100, 100)
+        partitions.append({'index': idx, 'cutline': cutline, 'buffered': cutline.buffer(20), 'photos': urls,
+                           'checks': {u: {'size': 1024} for u in urls}, 'gcp_list': None, 'buffer_m': 20})
+    return write_plan(partitions, 'stubplan', {}, str(tmp_path / 'plans'))
+
+def test_slot_resources_split_cores_and_memory():
+    slots = slot_resources(3, cpus=range(8), memory_mb=3000, memory_fraction=0.9)
+    assert [s['cpus'] for s in slots] == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert all(s['memory_mb'] == 900 for s in slots)
+    with pytest.raises(ValueError):
+        slot_resources(3, cpus=[0, 1], memory_mb=3000)
+    assert [s['cpus'] for s in slot_resources(3, cpus=[0, 1], memory_mb=3000, oversubscribe=True)] == [[0], [1], [0]]
+
+def test_stub_odm_flow_end_to_end(tmp_path, photo_server, monkeypatch):
+    photos, url = photo_server
+    plan_uri = write_stub_plan(tmp_path, photos, url, [5, 3, 4])
+    config = {'compute_array_sz': 3, 'output_bucket': 'gs://survey-out', 'survey_res': 1.0,
+              'image_cache': {'path': str(tmp_path / 'cache'), 'max_gb': 1}}
+    work_root = tmp_path / 'work'
+    output_root = tmp_path / 'out'
+
+    threads = []
+    def mask_to_cog(*args, num_threads=None, **kwargs):
+        threads.append(num_threads)
+        return real_mask_to_cog(*args, num_threads=num_threads, **kwargs)
+    real_mask_to_cog = ortho_mask.mask_to_cog
+    monkeypatch.setattr(ortho_mask, 'mask_to_cog', mask_to_cog)
+
+    cwd = os.getcwd()
+    uploader = Uploader(LocalBackend(str(output_root)))
+    resources = [{'cpus': [0, 1], 'memory_mb': 1024}, {'cpus': [2], 'memory_mb': 1024}]
+    errors, _ = run_local(config, plan_uri, str(work_root), uploader=uploader, stub_seconds=0.05,
+                          plan_checkpoints=LocalCheckpointStore(str(work_root / 'checkpoints')), resources=resources)
+    uploader.close()
+
+    assert errors == {0: None, 1: None, 2: None}
+    assert os.getcwd() == cwd
+    assert sorted(threads) in ([1, 1, 2], [1, 2, 2]) # the slot's cores, not ALL_CPUS
+    for idx in range(3):
+        assert (output_root / 'survey-out' / f'odm_orthophoto_{idx}.tif').exists()
+        assert (output_root / 'survey-out' / f'report_{idx}.pdf').exists()
+        assert (output_root / 'survey-out' / 'logs' / f'metrics_{idx}.jsonl').exists()
+        assert not (work_root / f'array_{idx}').exists() # cleaned up once uploaded
+
+    with open(work_root / 'metrics_0.jsonl') as f:
+        stages = [json.loads(line) for line in f]
+    assert [r['stage'] for r in stages if r['stage'] != 'upload'] == ['fetch_partition', 'download', 'odm', 'mask']
+    assert all(r['status'] == 'ok' for r in stages)
+    download = stages[1]
+    assert download['photos'] == 5 and download['failed'] == 0 and download['cache_hits'] == 0
+
+    # a rerun of the plan finds every partition finished
+    uploader = Uploader(LocalBackend(str(output_root)))
+    errors, uploads = run_local(config, plan_uri, str(work_root), uploader=uploader, stub_seconds=0.0,
+                                plan_checkpoints=LocalCheckpointStore(str(work_root / 'checkpoints')),
+                                resources=resources)
+    uploader.close()
+    assert errors == {0: None, 1: None, 2: None} and uploads == []
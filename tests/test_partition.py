@@ -0,0 +1,22 @@
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from partition import lloyd_relaxation, optimize_partition
+
+FLIGHT = Polygon([(0, 0), (1000, 0), (1000, 400), (500, 700), (0, 400)])
+
+def complexity(cells):
+    return np.mean(shapely.length(cells) / shapely.area(cells))
+
+def test_lloyd_returns_num_cells_and_their_complexity():
+    cells, mns, best_mn = lloyd_relaxation(FLIGHT, 8, max_iterations=30, seed=1)
+    assert len(cells) == 8 and (shapely.area(cells) > 0).all()
+    assert np.isclose(best_mn, complexity(cells))
+    assert best_mn >= np.min(mns)
+
+def test_optimize_partition_keeps_the_best_returned_polygons():
+    runs = [lloyd_relaxation(FLIGHT, 8, max_iterations=30, seed=s)
+            for s in np.random.SeedSequence(3).spawn(3)]
+    cells, mns = optimize_partition(FLIGHT, 8, restarts=3, max_iterations=30, seed=3, processes=1)
+    assert np.isclose(complexity(cells), min(best_mn for _, _, best_mn in runs))
@@ -0,0 +1,85 @@
+import threading
+
+from uploader import Uploader, LocalBackend
+
+class BlockingBackend(LocalBackend):
+    # holds every put until `release` is set, so later submissions find the first one queued
+    def __init__(self, root):
+        super().__init__(root)
+        self.release = threading.Event()
+        self.puts = []
+
+    def put(self, path, dest):
+        self.release.wait(10)
+        self.puts.append(dest)
+        super().put(path, dest)
+
+def write(path, content):
+    path.write_text(content)
+    return str(path)
+
+def test_submit_after_close_runs_inline(tmp_path):
+    uploader = Uploader(LocalBackend(str(tmp_path / 'bucket')))
+    uploader.close()
+    path = write(tmp_path / 'metrics_0.jsonl', '{}\n')
+
+    result = [None]
+    thread = threading.Thread(target=lambda: result.__setitem__(0, uploader.submit(path, 'logs').result()),
+                              daemon=True) # a deadlock fails the test instead of hanging it
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert result[0]['dest'] == 'logs/metrics_0.jsonl' and not result[0]['skipped']
+    assert (tmp_path / 'bucket' / 'logs' / 'metrics_0.jsonl').read_text() == '{}\n'
+
+def test_resubmitted_queued_file_uploads_once_with_latest_content(tmp_path):
+    backend = BlockingBackend(str(tmp_path / 'bucket'))
+    uploader = Uploader(backend, workers=1)
+    first = write(tmp_path / 'first.tif', 'a')
+    log = write(tmp_path / 'metrics_0.jsonl', 'stage 1\n')
+
+    uploader.submit(first, 'out') # occupies the only worker
+    queued = uploader.submit(log, 'logs')
+    write(tmp_path / 'metrics_0.jsonl', 'stage 1\nstage 2\n')
+    assert uploader.submit(log, 'logs') is queued
+
+    backend.release.set()
+    uploader.close()
+    assert backend.puts == ['out/first.tif', 'logs/metrics_0.jsonl']
+    assert (tmp_path / 'bucket' / 'logs' / 'metrics_0.jsonl').read_text() == 'stage 1\nstage 2\n'
+
+def test_matching_checksum_skips_upload(tmp_path):
+    uploader = Uploader(LocalBackend(str(tmp_path / 'bucket')))
+    path = write(tmp_path / 'odm_orthophoto_0.tif', 'ortho')
+
+    first = uploader.submit(path, 'out').result()
+    again = uploader.submit(path, 'out').result()
+    write(tmp_path / 'odm_orthophoto_0.tif', 'ortho, rerun')
+    changed = uploader.submit(path, 'out').result()
+    uploader.close()
+
+    assert not first['skipped'] and first['bytes'] == 5
+    assert again['skipped'] and again['bytes'] == 0
+    assert not changed['skipped']
+    assert (tmp_path / 'bucket' / 'out' / 'odm_orthophoto_0.tif').read_text() == 'ortho, rerun'
+
+def test_when_done_success_and_failure(tmp_path):
+    uploader = Uploader(LocalBackend(str(tmp_path / 'bucket')))
+    path = write(tmp_path / 'report_0.pdf', 'report')
+    calls = []
+
+    ok = [uploader.submit(path, 'out')]
+    uploader.when_done(ok, lambda: calls.append('ok'), lambda e: calls.append(e))
+    missing = [uploader.submit(path, 'out', name='copy.pdf'), uploader.submit(str(tmp_path / 'missing.tif'), 'out')]
+    uploader.when_done(missing, lambda: calls.append('ok'), lambda e: calls.append(e))
+    uploader.close()
+
+    assert sorted(map(type, calls), key=str) == [FileNotFoundError, str]
+    assert 'ok' in calls
+
+def test_when_done_without_futures_runs_immediately(tmp_path):
+    uploader = Uploader(LocalBackend(str(tmp_path / 'bucket')))
+    calls = []
+    uploader.when_done([], lambda: calls.append('ok'))
+    uploader.close()
+    assert calls == ['ok']
@@ -0,0 +1,73 @@
+import time
+
+from work_queue import SQLiteWorkQueue, Heartbeat, open_queue
+
+def make_queue(tmp_path, **kwargs):
+    queue = SQLiteWorkQueue(str(tmp_path / 'queue.sqlite'), **kwargs)
+    queue.add({i: {'array_idx': i} for i in range(3)})
+    return queue
+
+def states(queue):
+    return {row['task_id']: row['state'] for row in queue.status()}
+
+def test_lease_hands_out_each_task_once(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.add({0: {'array_idx': 99}}) == 0 # existing ids are kept
+
+    leased = [queue.lease(f'node-{i}') for i in range(3)]
+    assert [t['payload']['array_idx'] for t in leased] == [0, 1, 2]
+    assert all(t['attempts'] == 1 for t in leased)
+    assert queue.lease('node-3') is None
+    assert set(states(queue).values()) == {'leased'}
+
+def test_expired_lease_is_requeued(tmp_path):
+    queue = make_queue(tmp_path, lease_s=0.05)
+    task = queue.lease('preempted')
+    assert not queue.heartbeat(task['task_id'], 'other')
+    time.sleep(0.1)
+
+    # untried tasks go first, then the expired one on its second attempt
+    assert [queue.lease('replacement')['attempts'] for _ in range(2)] == [1, 1]
+    again = queue.lease('replacement')
+    assert again['task_id'] == task['task_id'] and again['attempts'] == 2
+    assert not queue.heartbeat(task['task_id'], 'preempted')
+    assert not queue.complete(task['task_id'], 'preempted')
+    assert queue.heartbeat(task['task_id'], 'replacement')
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    queue = make_queue(tmp_path, lease_s=0.2)
+    task = queue.lease('node')
+    with Heartbeat(queue, task['task_id'], 'node', interval=0.05) as beat:
+        time.sleep(0.4)
+    assert not beat.lost.is_set()
+    assert queue.complete(task['task_id'], 'node')
+
+def test_max_attempts_gives_up(tmp_path):
+    queue = open_queue(str(tmp_path / 'queue.sqlite'), max_attempts=2)
+    queue.add({'only': {}})
+    for attempt in [1, 2]:
+        task = queue.lease('node')
+        assert task['attempts'] == attempt
+        assert queue.fail(task['task_id'], 'node', 'RuntimeError()')
+    assert queue.lease('node') is None
+    row = queue.status()[0]
+    assert row['state'] == 'failed' and row['attempts'] == 2 and row['error'] == 'RuntimeError()'
+
+def test_expired_leases_also_give_up(tmp_path):
+    queue = SQLiteWorkQueue(str(tmp_path / 'queue.sqlite'), lease_s=0.01, max_attempts=1)
+    queue.add({'only': {}})
+    assert queue.lease('node') is not None
+    time.sleep(0.05)
+    assert queue.lease('node') is None
+    assert states(queue) == {'only': 'failed'}
+
+def test_done_tasks_are_not_leased_again(tmp_path):
+    queue = make_queue(tmp_path, lease_s=0.05)
+    task = queue.lease('node')
+    assert queue.complete(task['task_id'], 'node', {'uploads': 2})
+    time.sleep(0.1)
+    assert not queue.fail(task['task_id'], 'node')
+
+    leased = {queue.lease('node')['task_id'], queue.lease('node')['task_id']}
+    assert task['task_id'] not in leased and queue.lease('node') is None
+    assert states(queue)[task['task_id']] == 'done'
@@ -0,0 +1,165 @@
+"""
+Background uploads of results and logs.
+
+    uploader = Uploader(GCSBackend())
+    future = uploader.submit('odm_orthophoto_3.tif', output_bucket)
+    ...                          # next stage runs while the file uploads
+    uploader.close()             # wait for everything before shutting down
+
+Uploads run on a thread pool and return futures whose result describes the
+transfer. An object whose checksum already matches the local file is not
+uploaded again, so reruns after a preemption skip finished artifacts. A
+file that is resubmitted while its previous upload is still queued (e.g.
+the metrics log after every stage) is uploaded once, with its latest
+content.
+
+Backends implement checksum(path), remote_checksum(dest) and put(path,
+dest), where dest is '<bucket>/<prefix>/<name>'. GCSBackend uses gsutil with
+parallel composite uploads above `composite_threshold` and compares CRC32C
+hashes (composite objects have no MD5). LocalBackend mirrors destinations
+into a directory and is meant for single-host runs (see local_executor.py).
+"""
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+class LocalBackend:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, dest):
+        return os.path.join(self.root, dest.replace('gs://', '', 1))
+
+    def checksum(self, path):
+        h = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def remote_checksum(self, dest):
+        path = self._path(dest)
+        return self.checksum(path) if os.path.exists(path) else None
+
+    def put(self, path, dest):
+        target = self._path(dest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target + '.tmp')
+        os.replace(target + '.tmp', target)
+
+class GCSBackend:
+    def __init__(self, composite_threshold='150M'):
+        self.composite_threshold = composite_threshold
+
+    def _uri(self, dest):
+        return dest if dest.startswith('gs://') else f'gs://{dest}'
+
+    def _crc32c(self, output):
+        match = re.search(r'Hash \(crc32c\):\s+(\S+)', output)
+        return match.group(1) if match else None
+
+    def checksum(self, path):
+        result = subprocess.run(['gsutil', 'hash', '-c', path], capture_output=True, text=True, check=True)
+        return self._crc32c(result.stdout)
+
+    def remote_checksum(self, dest):
+        result = subprocess.run(['gsutil', 'ls', '-L', self._uri(dest)], capture_output=True, text=True)
+        return self._crc32c(result.stdout) if result.returncode == 0 else None
+
+    def put(self, path, dest):
+        subprocess.run(['gsutil', '-o', f'GSUtil:parallel_composite_upload_threshold={self.composite_threshold}',
+                        'cp', path, self._uri(dest)], check=True)
+
+class Uploader:
+    def __init__(self, backend, workers=4):
+        self.backend = backend
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._queued = {} # (path, dest) -> future not yet started
+        self._futures = []
+        self._closed = False
+
+    def _upload(self, path, dest):
+        with self._lock:
+            self._queued.pop((path, dest), None)
+        start = time.perf_counter()
+        size = os.path.getsize(path)
+
+        # only hash the local file when there is something to compare it with
+        remote = self.backend.remote_checksum(dest)
+        skipped = remote is not None and remote == self.backend.checksum(path)
+        if not skipped:
+            self.backend.put(path, dest)
+        return {'path': path, 'dest': dest, 'bytes': 0 if skipped else size,
+                'skipped': skipped, 'seconds': time.perf_counter() - start}
+
+    def submit(self, path, prefix, name=None):
+        # upload `path` to <prefix>/<name>, the file's own name by default
+        dest = f"{prefix.rstrip('/')}/{name or os.path.basename(path)}"
+        with self._lock:
+            future = self._queued.get((path, dest))
+            closed = self._closed
+            if future is None and not closed:
+                future = self._pool.submit(self._upload, path, dest)
+                self._queued[(path, dest)] = future
+                self._futures.append(future)
+        if future is None:
+            # late submissions (e.g. from a callback during close) run inline, outside the lock _upload takes
+            future = Future()
+            try:
+                future.set_result(self._upload(path, dest))
+            except Exception as e:
+                future.set_exception(e)
+        return future
+
+    def when_done(self, futures, on_success, on_failure=None):
+        """
+        Call on_success() once all `futures` succeeded, or on_failure(error)
+        once they finished and one of them failed. Runs immediately when
+        they are already done; otherwise on the thread finishing the last.
+        """
+        futures = list(futures)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def finished(_=None):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if not errors:
+                on_success()
+            elif on_failure is not None:
+                on_failure(errors[0])
+
+        if not futures:
+            remaining[0] = 1
+            finished()
+        for future in futures:
+            future.add_done_callback(finished)
+
+    def close(self):
+        # wait for every upload, including those submitted by callbacks meanwhile;
+        # failures are reported, not raised, so a node still shuts down
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            wait(futures)
+            with self._lock:
+                if len(self._futures) == len(futures):
+                    self._closed = True
+                    break
+        self._pool.shutdown(wait=True)
+        results = []
+        for future in self._futures:
+            if future.exception() is not None:
+                print(f'Upload failed: {future.exception()}')
+            else:
+                results.append(future.result())
+        return results
@@ -0,0 +1,321 @@
+"""
+Pull-based work queue for the odm-array nodes.
+
+Instead of pinning partition N to instance odm-array-N, the partitions of a
+plan become tasks. A worker leases the next queued task, keeps the lease
+alive with heartbeats while it runs, and completes it; a lease whose
+heartbeats stop (preempted or dead node) expires and the task is handed to
+the next worker that asks. A node that finishes early simply leases
+another task, so a plan can be over-partitioned (e.g. 40 tasks on 10
+nodes) to shorten the tail.
+
+SQLiteWorkQueue keeps the queue in one SQLite file and is what single-host
+runs use. GCSWorkQueue keeps one object per task, lease and
+result under a bucket prefix and relies on generation preconditions for
+atomic leases, so nodes need nothing but gsutil.
+
+    python3 work_queue.py <queue> fill 40 --plan-uri gs://<output_bucket>/plans/<key>
+    python3 work_queue.py <queue> status
+
+where <queue> is a local .sqlite path or a gs:// prefix; pass the same value
+to the nodes as the `queue_uri` instance metadata.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+class SQLiteWorkQueue:
+    def __init__(self, path, lease_s=900, max_attempts=3):
+        self.path = path
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued', -- queued, leased, done or failed
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT
+                )""")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can
+        # never both see the same task as queued
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            yield db
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+    def add(self, tasks):
+        # tasks maps task ids to JSON-serializable payloads; existing ids are kept as they are
+        with self._transaction() as db:
+            cursor = db.executemany('INSERT OR IGNORE INTO tasks (task_id, payload) VALUES (?, ?)',
+                                    [(str(task_id), json.dumps(payload)) for task_id, payload in tasks.items()])
+            return cursor.rowcount
+
+    def lease(self, worker):
+        """
+        Lease the next queued task to `worker`, requeueing expired leases
+        first. Returns a dict with task_id, payload and attempts, or None
+        when nothing is left to do.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE tasks SET state = 'queued', worker = NULL "
+                       "WHERE state = 'leased' AND lease_expires < ?", (now,))
+            db.execute("UPDATE tasks SET state = 'failed' WHERE state = 'queued' AND attempts >= ?",
+                       (self.max_attempts,))
+            row = db.execute("SELECT task_id, payload, attempts FROM tasks WHERE state = 'queued' "
+                             "ORDER BY attempts, rowid LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                       "WHERE task_id = ?", (worker, now + self.lease_s, row[0]))
+        return {'task_id': row[0], 'payload': json.loads(row[1]), 'attempts': row[2] + 1}
+
+    def heartbeat(self, task_id, worker):
+        # extend the lease; False once the worker no longer holds it
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE tasks SET lease_expires = ? "
+                                "WHERE task_id = ? AND worker = ? AND state = 'leased'",
+                                (time.time() + self.lease_s, task_id, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, task_id, worker, result=None):
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE tasks SET state = 'done', result = ?, lease_expires = NULL "
+                                "WHERE task_id = ? AND worker = ? AND state = 'leased'",
+                                (json.dumps(result), task_id, worker))
+            return cursor.rowcount == 1
+
+    def fail(self, task_id, worker, error=None):
+        # hand the task back right away; it fails for good after max_attempts leases
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                                "worker = NULL, lease_expires = NULL, error = ? "
+                                "WHERE task_id = ? AND worker = ? AND state = 'leased'",
+                                (self.max_attempts, error, task_id, worker))
+            return cursor.rowcount == 1
+
+    def status(self):
+        with self._transaction() as db:
+            rows = db.execute('SELECT task_id, state, worker, lease_expires, attempts, error FROM tasks '
+                              'ORDER BY rowid').fetchall()
+        keys = ['task_id', 'state', 'worker', 'lease_expires', 'attempts', 'error']
+        return [dict(zip(keys, row)) for row in rows]
+
+class GCSWorkQueue:
+    """
+    Queue under gs://<prefix>/ with tasks/<id>.json (payloads),
+    leases/<id>.json (worker, expiry, attempts) and done/<id>.json (results).
+    A lease is taken by creating its object with x-goog-if-generation-match:0,
+    or by overwriting an expired one conditionally on the generation that was
+    read, so only one of several racing workers wins.
+    """
+    def __init__(self, prefix, lease_s=900, max_attempts=3):
+        self.prefix = prefix.rstrip('/')
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self._generations = {} # task_id -> generation of the lease this worker holds
+
+    def _gsutil(self, *args):
+        return subprocess.run(['gsutil', '-q'] + list(args), capture_output=True, text=True)
+
+    def _list(self, folder):
+        # {task_id: generation} of the objects in a folder, {} when it is empty
+        result = self._gsutil('ls', '-a', f'{self.prefix}/{folder}/')
+        listing = {}
+        for line in result.stdout.split():
+            uri, _, generation = line.partition('#')
+            task_id = os.path.basename(uri)[:-len('.json')]
+            listing[task_id] = max(listing.get(task_id, 0), int(generation or 0))
+        return listing
+
+    def _read(self, folder, task_id, generation=None):
+        uri = f'{self.prefix}/{folder}/{task_id}.json' + (f'#{generation}' if generation else '')
+        result = self._gsutil('cat', uri)
+        return json.loads(result.stdout) if result.returncode == 0 else None
+
+    def _write(self, folder, task_id, record, if_generation=None):
+        # returns the new generation, or None when the precondition failed
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(record, f)
+        uri = f'{self.prefix}/{folder}/{task_id}.json'
+        try:
+            header = [] if if_generation is None else ['-h', f'x-goog-if-generation-match:{if_generation}']
+            result = subprocess.run(['gsutil', '-q'] + header + ['cp', f.name, uri], capture_output=True, text=True)
+        finally:
+            os.remove(f.name)
+        if result.returncode != 0:
+            if 'Precondition' in result.stderr or '412' in result.stderr:
+                return None
+            raise RuntimeError(f'gsutil cp to {uri} failed: {result.stderr.strip()}')
+        return self._list_one(folder, task_id)
+
+    def _list_one(self, folder, task_id):
+        result = self._gsutil('ls', '-a', f'{self.prefix}/{folder}/{task_id}.json')
+        generations = [int(line.partition('#')[2]) for line in result.stdout.split()]
+        return max(generations) if generations else None
+
+    def add(self, tasks):
+        existing = self._list('tasks')
+        added = 0
+        for task_id, payload in tasks.items():
+            if str(task_id) not in existing:
+                self._write('tasks', task_id, payload, if_generation=0)
+                added += 1
+        return added
+
+    def lease(self, worker):
+        done, leases = self._list('done'), self._list('leases')
+        now = time.time()
+        for task_id in sorted(self._list('tasks'), key=lambda t: (len(t), t)):
+            if task_id in done:
+                continue
+            attempts, generation = 0, 0
+            if task_id in leases:
+                generation = leases[task_id]
+                current = self._read('leases', task_id, generation)
+                if current is None or current['expires'] >= now or current['attempts'] >= self.max_attempts:
+                    continue
+                attempts = current['attempts']
+
+            record = {'worker': worker, 'expires': now + self.lease_s, 'attempts': attempts + 1}
+            new_generation = self._write('leases', task_id, record, if_generation=generation)
+            if new_generation is None:
+                continue # another worker won the race
+            self._generations[task_id] = new_generation
+            return {'task_id': task_id, 'payload': self._read('tasks', task_id), 'attempts': attempts + 1}
+        return None
+
+    def _update_lease(self, task_id, worker, **fields):
+        if task_id not in self._generations:
+            return False
+        current = self._read('leases', task_id, self._generations[task_id])
+        if current is None or current['worker'] != worker:
+            return False
+        generation = self._write('leases', task_id, dict(current, **fields), if_generation=self._generations[task_id])
+        if generation is None:
+            self._generations.pop(task_id)
+            return False
+        self._generations[task_id] = generation
+        return True
+
+    def heartbeat(self, task_id, worker):
+        return self._update_lease(task_id, worker, expires=time.time() + self.lease_s)
+
+    def complete(self, task_id, worker, result=None):
+        if not self.heartbeat(task_id, worker):
+            return False
+        self._write('done', task_id, {'worker': worker, 'result': result})
+        self._gsutil('rm', f'{self.prefix}/leases/{task_id}.json')
+        self._generations.pop(task_id)
+        return True
+
+    def fail(self, task_id, worker, error=None):
+        # an already expired lease is requeued by the next lease() call
+        return self._update_lease(task_id, worker, expires=0, error=error)
+
+    def status(self):
+        done, leases = self._list('done'), self._list('leases')
+        rows = []
+        for task_id in sorted(self._list('tasks'), key=lambda t: (len(t), t)):
+            lease = self._read('leases', task_id, leases[task_id]) if task_id in leases else None
+            if task_id in done:
+                state = 'done'
+            elif lease is None:
+                state = 'queued'
+            elif lease['expires'] >= time.time():
+                state = 'leased'
+            else:
+                state = 'failed' if lease['attempts'] >= self.max_attempts else 'queued'
+            rows.append({'task_id': task_id, 'state': state,
+                         'worker': lease and lease['worker'], 'lease_expires': lease and lease['expires'],
+                         'attempts': lease['attempts'] if lease else 0, 'error': lease and lease.get('error')})
+        return rows
+
+def open_queue(uri, **kwargs):
+    # a gs:// prefix or a local SQLite file
+    if uri.startswith('gs://'):
+        return GCSWorkQueue(uri, **kwargs)
+    return SQLiteWorkQueue(uri, **kwargs)
+
+class Heartbeat(threading.Thread):
+    """
+    Renews a lease every `interval` seconds (a third of the lease by
+    default) while the task runs:
+
+        with Heartbeat(queue, task['task_id'], worker) as beat:
+            ...
+        beat.lost.is_set() # the lease expired or was taken over meanwhile
+    """
+    def __init__(self, queue, task_id, worker, interval=None):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.task_id = task_id
+        self.worker = worker
+        self.interval = queue.lease_s / 3 if interval is None else interval
+        self.lost = threading.Event()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            try:
+                held = self.queue.heartbeat(self.task_id, self.worker)
+            except Exception as e:
+                print(f'Heartbeat for task {self.task_id} failed, retrying: {e}')
+                continue
+            if not held:
+                print(f'Lost the lease on task {self.task_id}')
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill or inspect a partition work queue.')
+    parser.add_argument('queue', help='SQLite path or gs:// prefix')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    fill = subparsers.add_parser('fill', help='add one task per partition index')
+    fill.add_argument('tasks', type=int, help='number of partitions (compute_array_sz of the plan)')
+    fill.add_argument('--plan-uri', default=None, help='plan the workers fetch their partition from')
+    subparsers.add_parser('status', help='print the state of every task')
+    args = parser.parse_args()
+
+    queue = open_queue(args.queue)
+    if args.command == 'fill':
+        added = queue.add({i: {'array_idx': i, 'plan_uri': args.plan_uri} for i in range(args.tasks)})
+        print(f'{added} tasks added to {args.queue}')
+    else:
+        rows = queue.status()
+        for row in rows:
+            print(f"{row['task_id']}\t{row['state']}\t{row['worker'] or ''}\tattempts={row['attempts']}"
+                  + (f"\t{row['error']}" if row['error'] else ''))
+        states = [row['state'] for row in rows]
+        print(', '.join(f'{states.count(s)} {s}' for s in ['queued', 'leased', 'done', 'failed']))